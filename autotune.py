@@ -0,0 +1,240 @@
+import json
+import math
+import os
+import threading
+import time
+from metrics import percentile
+from output_writer import atomic_write
+
+# Profile files are read and rewritten under this lock, so that documents
+# of one process sharing a file (e.g. both pipeline stages) never lose samples
+_file_lock = threading.Lock()
+
+def fit_latency(samples):
+    """Least-squares fit of latency = overhead + per_token * completion_tokens
+
+    samples are (completion_tokens, latency) pairs. Both coefficients are
+    kept non-negative; with too little spread in the sizes the overhead is
+    taken as zero and per_token as the mean time per completion token.
+    """
+    n = len(samples)
+    mean_x = sum(x for x, _ in samples) / n
+    mean_y = sum(y for _, y in samples) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in samples)
+    if var_x > 0:
+        per_token = sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x
+        overhead = mean_y - per_token * mean_x
+        if per_token > 0 and overhead >= 0:
+            return overhead, per_token
+    total_x = sum(x for x, _ in samples)
+    return 0.0, (sum(y for _, y in samples) / total_x if total_x else 0.0)
+
+class ChunkAutotuner:
+    """Learns the chunk size and completion cap that give the most tokens per second.
+
+    Fed as a metrics sink, it keeps for every task ("processing",
+    "translation"), model and endpoint the last MAX_SAMPLES requests: chunk
+    tokens, completion tokens, latency, whether the response was cut off
+    by max_tokens (finish_reason "length") and the token budget the chunk
+    was split with. The samples are saved in a JSON profile file, so every
+    run starts from what earlier runs measured.
+
+    recommend() turns them into a chunk size in tokens and a max_tokens for
+    responses. Latency is modelled as a fixed overhead (queueing, prompt
+    processing, first token) plus a time per completion token, so tokens
+    per second grow with the chunk size; the size is therefore the largest
+    one that stays clear of every limit:
+
+    - the 95th percentile output/input ratio must fit in max_output_tokens
+      with OUTPUT_HEADROOM to spare, and sizes that were truncated before
+      are avoided
+    - the predicted latency must stay under max_latency, if given
+    - a size past which the measured throughput dropped again is not exceeded
+    - it grows by at most max_growth over the largest size (or split budget,
+      since chunks end on paragraph boundaries below it) measured without
+      truncation, so a profile with only small chunks is extended gradually
+
+    max_tokens is then set with COMPLETION_HEADROOM over the largest ratio
+    seen, which also keeps the tokens/min reservations of the rate limiter
+    close to what requests really use.
+
+    Args:
+        path: JSON profile file, created if missing
+        task: Which documents' events to learn from (ChunkedDocument.noun)
+        max_output_tokens: Largest max_tokens the model accepts
+        min_chunk_tokens: Smallest chunk size ever recommended
+        max_latency: Longest acceptable request, in seconds (None for no limit)
+        min_samples: Requests needed before a profile is used
+        max_growth: Largest step over the biggest chunk measured so far
+    """
+    MAX_SAMPLES = 500
+    # Share of max_output_tokens a typical response may use
+    OUTPUT_HEADROOM = 0.8
+    # max_tokens over the largest output/input ratio seen
+    COMPLETION_HEADROOM = 1.5
+    # Chunk sizes that were truncated are avoided by this factor
+    TRUNCATION_BACKOFF = 0.8
+    # A bucket of larger chunks this much slower than the best one caps the size
+    THROUGHPUT_DROP = 0.9
+
+    def __init__(self, path, task, max_output_tokens=8192, min_chunk_tokens=256, max_latency=None,
+                 min_samples=5, max_growth=1.5):
+        self.path = path
+        self.task = task
+        self.max_output_tokens = max_output_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        self.max_latency = max_latency
+        self.min_samples = min_samples
+        self.max_growth = max_growth
+
+        self._lock = threading.Lock()
+        self.profiles = self._load().get("profiles", {})
+        # Samples not saved yet, by profile key
+        self._new_samples = {}
+        # Recommendations already given, so that every document of a run is split alike
+        self.recommendations = {}
+
+    def _key(self, model, endpoint):
+        return f"{self.task}|{model}|{endpoint}"
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, event):
+        """Metrics sink entry point: record the requests of this task's chunk events"""
+        if event.get("event") != "chunk" or event.get("task") != self.task:
+            return
+        if event.get("cache_hit") or event.get("dedup_hit") or event.get("protected") or event.get("failed"):
+            return
+        chunk_tokens = event.get("chunk_tokens")
+        completion_tokens = event.get("completion_tokens")
+        model = event.get("model")
+        if not chunk_tokens or not completion_tokens or model is None:
+            return
+        latency = event.get("latency")
+        sample = [chunk_tokens, completion_tokens, round(latency, 3) if latency is not None else None,
+                  int(bool(event.get("truncated")) or event.get("finish_reason") == "length"),
+                  event.get("chunk_budget")]
+        key = self._key(model, event.get("endpoint"))
+        with self._lock:
+            self._new_samples.setdefault(key, []).append(sample)
+            profile = self.profiles.setdefault(key, {"samples": []})
+            profile["samples"] = (profile["samples"] + [sample])[-self.MAX_SAMPLES:]
+
+    def estimate(self, samples, max_chunk_tokens=None):
+        """Return the best settings for samples, or None if there are too few of them"""
+        complete = [s for s in samples if not s[3]]
+        if len(complete) < self.min_samples:
+            return None
+        # After a cut-off response the chunk was requested again with the full max_tokens,
+        # so truncated samples still tell how long the output is (at least)
+        ratios = [completion / chunk for chunk, completion, _, _, _ in samples]
+        ratio = percentile(ratios, 0.95)
+        timed = [(chunk, completion, latency) for chunk, completion, latency, _, _ in complete if latency]
+
+        limit = max_chunk_tokens or math.inf
+        limit = min(limit, self.max_output_tokens * self.OUTPUT_HEADROOM / ratio)
+        truncated = [chunk for chunk, _, _, was_truncated, _ in samples if was_truncated]
+        if truncated:
+            limit = min(limit, min(truncated) * self.TRUNCATION_BACKOFF)
+        overhead = per_token = None
+        if len(timed) >= self.min_samples:
+            overhead, per_token = fit_latency([(completion, latency) for _, completion, latency in timed])
+            if self.max_latency is not None and per_token > 0:
+                limit = min(limit, (self.max_latency - overhead) / (per_token * ratio))
+            limit = min(limit, self._throughput_peak(timed))
+        limit = min(limit, max(max(chunk, budget or 0) for chunk, _, _, _, budget in complete) * self.max_growth)
+
+        chunk_tokens = max(self.min_chunk_tokens, int(limit // 50 * 50))
+        max_tokens = math.ceil(max(ratios) * chunk_tokens * self.COMPLETION_HEADROOM / 256) * 256
+        max_tokens = max(256, min(self.max_output_tokens, max_tokens))
+        tokens_per_second = None
+        if overhead is not None and overhead + per_token * ratio * chunk_tokens > 0:
+            tokens_per_second = chunk_tokens / (overhead + per_token * ratio * chunk_tokens)
+        return {
+            "chunk_tokens": chunk_tokens,
+            "max_completion_tokens": max_tokens,
+            "output_ratio": ratio,
+            "tokens_per_second": tokens_per_second,
+            "samples": len(samples),
+            "truncations": len(truncated),
+        }
+
+    def _throughput_peak(self, timed):
+        """Upper edge of the best chunk size bucket if larger chunks measured slower, else infinity
+
+        Buckets are half powers of two wide; each needs min_samples requests.
+        """
+        buckets = {}
+        for chunk, _, latency in timed:
+            bucket = buckets.setdefault(round(2 * math.log2(chunk)), [0, 0.0, 0])
+            bucket[0] += chunk
+            bucket[1] += latency
+            bucket[2] += 1
+        throughput = {b: tokens / seconds for b, (tokens, seconds, count) in buckets.items()
+                      if count >= self.min_samples and seconds > 0}
+        if not throughput:
+            return math.inf
+        best = max(throughput, key=throughput.get)
+        if any(b > best and value < throughput[best] * self.THROUGHPUT_DROP for b, value in throughput.items()):
+            return 2 ** ((best + 0.5) / 2)
+        return math.inf
+
+    def recommend(self, targets, max_chunk_tokens=None):
+        """Settings for requests spread over targets, a list of (model, endpoint name)
+
+        The most conservative settings of the targets with enough samples
+        are returned, or None when none of them has. The answer is kept for
+        the lifetime of the tuner, so documents of one run are split alike.
+        """
+        name = "|".join(f"{model}@{endpoint}" for model, endpoint in targets) + f"|{max_chunk_tokens}"
+        with self._lock:
+            if name in self.recommendations:
+                return self.recommendations[name]
+            estimates = [self.estimate(self.profiles[key]["samples"], max_chunk_tokens)
+                         for key in (self._key(model, endpoint) for model, endpoint in targets)
+                         if key in self.profiles]
+            estimates = [e for e in estimates if e is not None]
+            recommendation = None
+            if estimates:
+                recommendation = min(estimates, key=lambda e: e["chunk_tokens"])
+                recommendation = dict(recommendation, max_completion_tokens=min(
+                    e["max_completion_tokens"] for e in estimates))
+            self.recommendations[name] = recommendation
+            return recommendation
+
+    def save(self):
+        """Add the new samples to the profile file, keeping what other runs saved meanwhile"""
+        with self._lock:
+            new_samples, self._new_samples = self._new_samples, {}
+        if not new_samples:
+            return
+        with _file_lock:
+            data = self._load()
+            profiles = data.setdefault("profiles", {})
+            for key, samples in new_samples.items():
+                profile = profiles.setdefault(key, {"samples": []})
+                profile["samples"] = (profile["samples"] + samples)[-self.MAX_SAMPLES:]
+                profile["updated"] = time.time()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            atomic_write(self.path, json.dumps(data, indent=1))
+        with self._lock:
+            for key, profile in profiles.items():
+                if key.startswith(self.task + "|"):
+                    self.profiles[key] = profile
+
+    def close(self):
+        self.save()
+
+def format_recommendation(recommendation):
+    """One line describing ChunkAutotuner.recommend()"""
+    speed = recommendation["tokens_per_second"]
+    return (f"chunks of {recommendation['chunk_tokens']} tokens, max_tokens {recommendation['max_completion_tokens']} "
+            f"(output/input ratio {recommendation['output_ratio']:.2f}, "
+            f"{f'~{speed:.0f} input tokens/s per request, ' if speed else ''}"
+            f"{recommendation['samples']} samples, {recommendation['truncations']} truncated)")
@@ -0,0 +1,424 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from batch_runner import BatchRunner
+from metrics import create_recorder
+from output_writer import atomic_write
+from registry import load_prompt
+
+class BatchJobError(Exception):
+    """A request to the batch API that failed, with the HTTP status when there was one"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class BatchAPI:
+    """Client for the files and batches endpoints of an OpenAI-compatible provider.
+
+    The endpoints are found next to the endpoint's chat-completions path:
+    /v1/chat/completions gives /v1/files and /v1/batches, and a query
+    string such as an api-version is sent with every request.
+    """
+    # Statuses after which a batch no longer changes
+    TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        path, _, query = endpoint.path.partition('?')
+        # Path written in every line of the batch file
+        self.completions_path = path
+        self.root = path[:-len('/chat/completions')]
+        self.query = '?' + query if query else ''
+
+    def _request(self, method, path, body=None, content_type='application/json', sink=None):
+        """Send a request and return the parsed JSON answer, or write the answer to sink"""
+        headers = {'Authorization': 'Bearer ' + self.endpoint.api_key}
+        if body is not None:
+            headers['Content-Type'] = content_type
+        pool = self.endpoint.pool
+        conn, response = pool.request(method, self.root + path + self.query, body, headers)
+        try:
+            if response.status == 200 and sink is not None:
+                shutil.copyfileobj(response, sink)
+                data = None
+            else:
+                data = response.read()
+        except Exception:
+            pool.discard(conn)
+            raise
+        if response.will_close:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
+
+        if response.status != 200:
+            raise BatchJobError(f"{method} {path} failed with status {response.status}: "
+                                f"{data.decode('utf-8', errors='replace')[:500]}", response.status)
+        return None if sink is not None else json.loads(data.decode('utf-8'))
+
+    def upload(self, path):
+        """Upload a batch request file and return its file id"""
+        boundary = uuid.uuid4().hex
+        with open(path, 'rb') as f:
+            data = f.read()
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                f'filename="{os.path.basename(path)}"\r\nContent-Type: application/jsonl\r\n\r\n').encode()
+        body += data + f'\r\n--{boundary}--\r\n'.encode()
+        return self._request("POST", "/files", body, f'multipart/form-data; boundary={boundary}')["id"]
+
+    def create(self, input_file_id, completion_window="24h", metadata=None):
+        """Start a batch over an uploaded file and return the batch object"""
+        payload = {
+            "input_file_id": input_file_id,
+            "endpoint": self.completions_path,
+            "completion_window": completion_window,
+        }
+        if metadata:
+            payload["metadata"] = metadata
+        return self._request("POST", "/batches", json.dumps(payload))
+
+    def retrieve(self, batch_id):
+        """Return the current batch object, with its status and request counts"""
+        return self._request("GET", f"/batches/{batch_id}")
+
+    def download(self, file_id, path):
+        """Save the content of a file (batch output or errors) to path"""
+        partial_path = path + '.part'
+        try:
+            with open(partial_path, 'wb') as f:
+                self._request("GET", f"/files/{file_id}/content", sink=f)
+            os.replace(partial_path, path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+def parse_batch_result(record):
+    """Turn one line of a batch output or error file into the result _iter_batch() expects"""
+    response = record.get("response") or {}
+    status = response.get("status_code")
+    body = response.get("body") or {}
+    choices = body.get("choices") or []
+    if status == 200 and choices:
+        return {
+            "content": choices[0]["message"]["content"],
+            "status": status,
+            "usage": body.get("usage"),
+            "finish_reason": choices[0].get("finish_reason"),
+            "error": None,
+        }
+    error = record.get("error") or body.get("error") or {}
+    message = error.get("message") if isinstance(error, dict) else str(error)
+    return {"content": None, "status": status, "error": message or f"status {status}"}
+
+class OfflineBatchRunner(BatchRunner):
+    """Run papers through the provider's batch API instead of one request per chunk.
+
+    Every chunk of every paper is written to JSONL request files (split
+    at max_batch_requests lines or max_batch_bytes), which are uploaded
+    and submitted as batch jobs; the jobs are then polled every
+    poll_interval seconds until they are done, and each paper is written
+    from the results in chunk order. Batch APIs cost about half as much
+    and do not count against the interactive rate limits, at the price of
+    answering within completion_window instead of seconds.
+
+    No result is known when the request files are written, so every chunk
+    gets the previous source chunk as context, as in concurrent mode.
+    Chunks the batch did not answer, and results failing validation, are
+    requested directly while the papers are assembled.
+
+    Progress is kept in work_dir (default: .batch_job below the root): the
+    request files, the ids of the uploaded files and batches, the
+    downloaded results and those of the chunks requested directly. Started again with the same inputs, prompt and
+    options, the runner picks up where it stopped, e.g. polls the batches
+    it had submitted; if anything changed, a new batch is planned.
+
+    Args:
+        work_dir: Folder for request files, state and results
+        poll_interval: Seconds between two status checks
+        completion_window: Completion window asked of the provider
+        max_batch_requests: Most requests in one batch job
+        max_batch_bytes: Largest request file of one batch job
+    """
+    STATE_NAME = 'state.json'
+
+    def __init__(self, document_class, input_name, output_name, base_url, prompt_path, api_key,
+                 model="gpt-4o-mini", work_dir=None, poll_interval=60, completion_window="24h",
+                 max_batch_requests=50000, max_batch_bytes=190 * 1024 * 1024, **options):
+        super().__init__(document_class, input_name, output_name, base_url, prompt_path, api_key,
+                         model, **options)
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_batch_requests = max_batch_requests
+        self.max_batch_bytes = max_batch_bytes
+        # Output paths of documents given explicitly; others follow output_name
+        self.outputs = {}
+
+    def output_path(self, input_path):
+        return self.outputs.get(input_path) or super().output_path(input_path)
+
+    def run(self, root, report_path=None, documents=None, outputs=None):
+        """Process every paper below root (or the given documents) as offline batches
+
+        Args:
+            root: Folder the papers are found in, and where work_dir and the report go by default
+            report_path: Path of the JSON summary report (default: batch_report.json in root)
+            documents: Input paths to process instead of searching root
+            outputs: Dict of output paths by input path, for documents not named output_name
+        """
+        if documents is None:
+            documents = self.find_documents(root)
+            print(f"Found {len(documents)} documents named '{self.input_name}' below '{root}'")
+        if not documents:
+            return []
+        self.outputs = dict(outputs or {})
+
+        work_dir = self.work_dir or os.path.join(root, '.batch_job')
+        os.makedirs(work_dir, exist_ok=True)
+        state_path = os.path.join(work_dir, self.STATE_NAME)
+
+        system_prompt = load_prompt(self.prompt_path)
+        llm_client = self._create_client(root)
+        metrics = create_recorder(self.metrics_log, self.metrics_sink)
+        autotuner = self._create_autotuner(llm_client, metrics)
+        # Request files are written with the glossary as it is when planning
+        glossary = self._create_glossary()
+        api = BatchAPI(llm_client.endpoints[0])
+
+        started = time.monotonic()
+        fingerprint = self._fingerprint(documents, system_prompt, llm_client)
+        state = self._load_state(state_path)
+        if state is not None and state.get("fingerprint") == fingerprint:
+            print(f"Resuming the batch planned in {work_dir}")
+            # Chunks must be split as when the request files were written
+            if autotuner is not None:
+                autotuner.recommendations = state.get("autotune") or {}
+        else:
+            if state is not None:
+                print("Inputs, prompt or options changed since the last batch, planning a new one")
+            state = self._plan(root, documents, llm_client, system_prompt, metrics, autotuner, glossary, api,
+                               work_dir, fingerprint)
+            self._save_state(state_path, state)
+
+        self._submit(api, state, state_path, work_dir)
+        self._wait(api, state, state_path)
+        results = self._collect(api, state, work_dir)
+        # Chunks requested directly by an earlier run are not requested again
+        direct = state.setdefault("direct", {})
+        for custom_id, result in direct.items():
+            number, index = map(int, custom_id.split('-'))
+            results.setdefault(number, {})[index] = dict(result, direct=True)
+        state_lock = threading.Lock()
+
+        def record_direct(number, index, response, info):
+            with state_lock:
+                direct[f"{number}-{index}"] = {"content": response, "error": None, "status": info.get("status"),
+                                               "usage": info.get("usage"), "finish_reason": info.get("finish_reason"),
+                                               "model": info.get("model")}
+                self._save_state(state_path, state)
+
+        # Chunks without a usable result are requested from the document threads
+        with ThreadPoolExecutor(max_workers=self.max_documents) as drivers:
+            futures = [
+                drivers.submit(self._run_document, root, path, llm_client, system_prompt, None, metrics, autotuner,
+                               glossary, lambda document, number=number: document.run_batch_results(
+                                   results.get(number, {}),
+                                   lambda index, response, info, number=number: record_direct(number, index,
+                                                                                              response, info)))
+                for number, path in enumerate(documents)
+            ]
+            reports = [future.result() for future in futures]
+        wall_time = time.monotonic() - started
+
+        report = self._build_report(root, documents, reports, wall_time, llm_client, metrics, glossary)
+        report["offline_batches"] = state["jobs"]
+        return self._save_report(report, root, report_path)
+
+    def _fingerprint(self, documents, system_prompt, llm_client):
+        """Digest of everything the request files depend on"""
+        digest = hashlib.sha256()
+        endpoint = llm_client.endpoints[0]
+        digest.update(json.dumps([endpoint.base_url, endpoint.model, self.model, system_prompt,
+                                  self.max_completion_tokens, self.glossary, sorted(self.document_options.items())],
+                                 default=repr).encode('utf-8'))
+        for input_path in documents:
+            digest.update(f"\0{os.path.abspath(input_path)}\0{self.output_path(input_path)}\0".encode('utf-8'))
+            with open(input_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def _load_state(self, state_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, state_path, state):
+        # Ids of submitted batches must survive a crash, so the state is synced to disk
+        atomic_write(state_path, json.dumps(state, ensure_ascii=False, indent=2), fsync=True)
+
+    def _plan(self, root, documents, llm_client, system_prompt, metrics, autotuner, glossary, api, work_dir,
+              fingerprint):
+        """Write the request files of every paper and return the new state"""
+        model = llm_client.endpoints[0].model
+        jobs = []
+        request_file = None
+        try:
+            for number, input_path in enumerate(documents):
+                document = self._make_document(root, input_path, llm_client, system_prompt, None, metrics, autotuner,
+                                               glossary)
+                requests = 0
+                for index, body in document.batch_requests():
+                    body["model"] = model
+                    line = json.dumps({
+                        "custom_id": f"{number}-{index}",
+                        "method": "POST",
+                        "url": api.completions_path,
+                        "body": body,
+                    }, ensure_ascii=False) + "\n"
+                    size = len(line.encode('utf-8'))
+
+                    # Start a new job when the current file is full
+                    job = jobs[-1] if jobs else None
+                    if (job is None or job["requests"] >= self.max_batch_requests
+                            or job["bytes"] + size > self.max_batch_bytes):
+                        if request_file is not None:
+                            self._close_request_file(request_file, work_dir, job)
+                        job = {
+                            "file": f"requests_{len(jobs) + 1:04d}.jsonl",
+                            "requests": 0,
+                            "bytes": 0,
+                            "input_file_id": None,
+                            "batch_id": None,
+                            "status": "planned",
+                            "request_counts": None,
+                            "output_file_id": None,
+                            "error_file_id": None,
+                        }
+                        jobs.append(job)
+                        request_file = open(os.path.join(work_dir, job["file"] + '.tmp'), 'w', encoding='utf-8')
+
+                    request_file.write(line)
+                    job["requests"] += 1
+                    job["bytes"] += size
+                    requests += 1
+                print(f"[{self.paper_name(root, input_path)}] {requests} chunks in the batch")
+            if request_file is not None:
+                self._close_request_file(request_file, work_dir, jobs[-1])
+        finally:
+            if request_file is not None and not request_file.closed:
+                request_file.close()
+
+        total = sum(job["requests"] for job in jobs)
+        print(f"Planned {total} requests in {len(jobs)} batch jobs")
+        return {
+            "fingerprint": fingerprint,
+            "documents": documents,
+            "autotune": autotuner.recommendations if autotuner is not None else None,
+            "jobs": jobs,
+        }
+
+    def _close_request_file(self, request_file, work_dir, job):
+        request_file.close()
+        os.replace(request_file.name, os.path.join(work_dir, job["file"]))
+
+    def _submit(self, api, state, state_path, work_dir):
+        """Upload and start every job not submitted yet, saving the state after each step"""
+        for job in state["jobs"]:
+            if job["input_file_id"] is None:
+                print(f"Uploading {job['file']} ({job['requests']} requests, "
+                      f"{job['bytes'] / (1024 * 1024):.1f} MiB)...")
+                job["input_file_id"] = api.upload(os.path.join(work_dir, job["file"]))
+                self._save_state(state_path, state)
+            if job["batch_id"] is None:
+                batch = api.create(job["input_file_id"], self.completion_window,
+                                   metadata={"request_file": job["file"]})
+                job["batch_id"] = batch["id"]
+                job["status"] = batch.get("status")
+                self._save_state(state_path, state)
+                print(f"Submitted batch {job['batch_id']} for {job['file']}")
+
+    def _wait(self, api, state, state_path):
+        """Poll the jobs until every one of them is finished"""
+        while True:
+            pending = [job for job in state["jobs"] if job["status"] not in BatchAPI.TERMINAL]
+            if not pending:
+                return
+            for job in pending:
+                try:
+                    batch = api.retrieve(job["batch_id"])
+                except (BatchJobError, OSError) as e:
+                    # Server errors and dropped connections are not worth losing a night over
+                    if isinstance(e, BatchJobError) and e.status is not None and e.status < 500 and e.status != 429:
+                        raise
+                    print(f"ERROR: Checking batch {job['batch_id']} failed: {e}; trying again later")
+                    continue
+                job["status"] = batch.get("status")
+                job["request_counts"] = batch.get("request_counts")
+                job["output_file_id"] = batch.get("output_file_id")
+                job["error_file_id"] = batch.get("error_file_id")
+            self._save_state(state_path, state)
+
+            counts = [job["request_counts"] or {} for job in state["jobs"]]
+            done = sum(c.get("completed", 0) + c.get("failed", 0) for c in counts)
+            total = sum(job["requests"] for job in state["jobs"])
+            statuses = ', '.join(f"{job['batch_id']}: {job['status']}" for job in state["jobs"])
+            print(f"Batch progress: {done}/{total} requests answered ({statuses})")
+
+            if any(job["status"] not in BatchAPI.TERMINAL for job in state["jobs"]):
+                time.sleep(self.poll_interval)
+
+    def _collect(self, api, state, work_dir):
+        """Download the results of every job and return them by document number and chunk index
+
+        Each result also gets the messages of its request, under which it is cached.
+        """
+        results = {}
+        for job in state["jobs"]:
+            if job["status"] != "completed":
+                print(f"WARNING: Batch {job['batch_id']} ended as {job['status']}; "
+                      f"its unanswered chunks are requested directly")
+            for kind in ("output", "error"):
+                file_id = job.get(f"{kind}_file_id")
+                if not file_id:
+                    continue
+                path = os.path.join(work_dir, f"{job['file'][:-len('.jsonl')]}.{kind}.jsonl")
+                if not os.path.exists(path):
+                    api.download(file_id, path)
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        number, index = map(int, record["custom_id"].split('-'))
+                        results.setdefault(number, {})[index] = parse_batch_result(record)
+            self._attach_messages(results, os.path.join(work_dir, job["file"]))
+        return results
+
+    def _attach_messages(self, results, request_path):
+        """Add the messages each answered request was submitted with, from its request file"""
+        with open(request_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                number, index = map(int, record["custom_id"].split('-'))
+                result = results.get(number, {}).get(index)
+                if result is not None:
+                    result["messages"] = record["body"]["messages"]
+
+    def _print_report(self, report):
+        super()._print_report(report)
+        for job in report["offline_batches"]:
+            counts = job["request_counts"] or {}
+            print(f"Batch {job['batch_id']}: {job['status']}, {counts.get('completed', 0)} completed, "
+                  f"{counts.get('failed', 0)} failed of {job['requests']} requests")
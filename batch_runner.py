@@ -0,0 +1,275 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from endpoints import format_endpoint_stats
+from llm_client import LLMClient
+from response_cache import ResponseCache
+from dedup_cache import DedupCache, format_dedup_stats
+from metrics import create_recorder, format_summary
+from autotune import ChunkAutotuner
+from glossary import Glossary, format_glossary_stats
+from registry import load_prompt
+
+class BatchRunner:
+    """Run many papers through one shared worker pool.
+
+    Every directory below the root that contains `input_name` is one paper.
+    All papers share a single LLMClient (one tokenizer, one connection pool,
+    one response cache), the prompt is read once, and every chunk of every
+    paper is submitted to one executor, so `concurrency` is a global limit
+    on requests in flight. Each paper still writes its chunks in order.
+    """
+    def __init__(self, document_class, input_name, output_name, base_url, prompt_path, api_key,
+                 model="gpt-4o-mini", concurrency=4, max_documents=None, pool_size=4, pool_idle_timeout=60,
+                 stream=False, resume=False, cache_dir=None, cache_max_mb=512, use_cache=True,
+                 requests_per_minute=None, tokens_per_minute=None, max_backoff=60,
+                 metrics_log=None, metrics_sink=None, cache_hint=None, endpoints=None, hedge_percentile=None,
+                 dedup_cache=None, max_completion_tokens=None, autotune=None, glossary=None, **document_options):
+        self.document_class = document_class
+        self.input_name = input_name
+        self.output_name = output_name
+        self.base_url = base_url
+        self.prompt_path = prompt_path
+        self.api_key = api_key
+        self.model = model
+        self.concurrency = max(1, int(concurrency))
+        self.max_documents = max_documents or self.concurrency
+        self.pool_size = max(pool_size, self.concurrency)
+        self.pool_idle_timeout = pool_idle_timeout
+        self.stream = stream
+        self.resume = resume
+        self.cache_dir = cache_dir
+        self.cache_max_mb = cache_max_mb
+        self.use_cache = use_cache
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_backoff = max_backoff
+        self.metrics_log = metrics_log
+        self.metrics_sink = metrics_sink
+        self.cache_hint = cache_hint
+        self.endpoints = endpoints
+        self.hedge_percentile = hedge_percentile
+        self.dedup_cache = dedup_cache
+        self.max_completion_tokens = max_completion_tokens
+        self.autotune = autotune
+        self.glossary = glossary
+
+        # Everything else (chunk sizes, ...) is passed through to each document
+        self.document_options = document_options
+
+    def find_documents(self, root):
+        """Return every input file below root, skipping hidden folders such as .tmp_*"""
+        documents = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            if self.input_name in filenames:
+                documents.append(os.path.join(dirpath, self.input_name))
+        return documents
+
+    def paper_name(self, root, input_path):
+        """Name of a paper in logs and the report: its folder below root"""
+        paper = os.path.relpath(os.path.dirname(input_path), root)
+        return os.path.basename(input_path) if paper == '.' else paper
+
+    def output_path(self, input_path):
+        return os.path.join(os.path.dirname(input_path), self.output_name)
+
+    def _make_document(self, root, input_path, llm_client, system_prompt, executor, metrics, autotuner=None,
+                       glossary=None):
+        """Create the document of one paper, sharing the batch's client, pool, metrics, autotuner and glossary"""
+        return self.document_class(
+            input_path,
+            self.output_path(input_path),
+            self.base_url,
+            self.prompt_path,
+            self.api_key,
+            self.model,
+            concurrency=self.concurrency,
+            stream=self.stream,
+            llm_client=llm_client,
+            system_prompt=system_prompt,
+            executor=executor,
+            metrics=metrics,
+            log_prefix=self.paper_name(root, input_path),
+            max_completion_tokens=self.max_completion_tokens,
+            autotune=autotuner,
+            glossary=glossary,
+            **self.document_options
+        )
+
+    def _run_document(self, root, input_path, llm_client, system_prompt, executor, metrics, autotuner=None,
+                      glossary=None, run=None):
+        """Run one paper and return its report entry; failures are recorded, not raised
+
+        run(document) returns the document's summary (default: document.run()).
+        """
+        paper = self.paper_name(root, input_path)
+        output_path = self.output_path(input_path)
+        started = time.monotonic()
+        try:
+            document = self._make_document(root, input_path, llm_client, system_prompt, executor, metrics, autotuner,
+                                           glossary)
+            summary = run(document) if run is not None else document.run()
+            summary["paper"] = paper
+            summary["error"] = None
+            return summary
+        except Exception as e:
+            print(f"ERROR: [{paper}] {e}")
+            return {
+                "paper": paper,
+                "input_path": input_path,
+                "output_path": output_path,
+                "error": str(e),
+                "wall_time": time.monotonic() - started,
+            }
+
+    def run(self, root, report_path=None):
+        """Process every paper below root and write a JSON summary report"""
+        documents = self.find_documents(root)
+        print(f"Found {len(documents)} documents named '{self.input_name}' below '{root}'")
+        if not documents:
+            return []
+
+        system_prompt = load_prompt(self.prompt_path)
+        llm_client = self._create_client(root)
+        # One event log for the whole batch; events are tagged with their paper
+        metrics = create_recorder(self.metrics_log, self.metrics_sink)
+        autotuner = self._create_autotuner(llm_client, metrics)
+        glossary = self._create_glossary()
+
+        started = time.monotonic()
+        # Documents are driven from their own threads so that ordered writing
+        # never occupies a request worker
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor, \
+                ThreadPoolExecutor(max_workers=self.max_documents) as drivers:
+            futures = [drivers.submit(self._run_document, root, path, llm_client, system_prompt, executor, metrics,
+                                      autotuner, glossary)
+                       for path in documents]
+            reports = [future.result() for future in futures]
+        wall_time = time.monotonic() - started
+
+        report = self._build_report(root, documents, reports, wall_time, llm_client, metrics, glossary)
+        return self._save_report(report, root, report_path)
+
+    def _create_autotuner(self, llm_client, metrics):
+        """One autotuner for every paper, so all are split alike; it is saved when the metrics are closed"""
+        if not self.autotune:
+            return None
+        autotuner = ChunkAutotuner(self.autotune, self.document_class.noun,
+                                   max_output_tokens=llm_client.max_completion_tokens)
+        metrics.add_sink(autotuner)
+        return autotuner
+
+    def _create_glossary(self):
+        """One glossary for every paper, so terms learnt in one are used in the next; saved with the report"""
+        if not self.glossary or not self.document_class.term_glossary:
+            return None
+        return Glossary(self.glossary)
+
+    def _create_client(self, root):
+        """Create the LLMClient, response cache and dedup cache shared by every paper"""
+        response_cache = None
+        if self.use_cache:
+            cache_dir = self.cache_dir or os.path.join(root, '.cache')
+            response_cache = ResponseCache(cache_dir, max_bytes=int(self.cache_max_mb * 1024 * 1024))
+        # Boilerplate repeated across papers is answered once for the whole batch
+        dedup_cache = DedupCache(self.dedup_cache) if self.dedup_cache else None
+        return LLMClient(self.api_key, self.base_url, self.model,
+                         pool_size=self.pool_size,
+                         pool_idle_timeout=self.pool_idle_timeout,
+                         stream=self.stream,
+                         response_cache=response_cache,
+                         resume=self.resume,
+                         requests_per_minute=self.requests_per_minute,
+                         tokens_per_minute=self.tokens_per_minute,
+                         max_concurrency=self.concurrency,
+                         max_backoff=self.max_backoff,
+                         cache_hint=self.cache_hint,
+                         endpoints=self.endpoints,
+                         hedge_percentile=self.hedge_percentile,
+                         dedup_cache=dedup_cache,
+                         max_completion_tokens=self.max_completion_tokens)
+
+    def _build_report(self, root, documents, reports, wall_time, llm_client, metrics, glossary=None):
+        """Close the shared client, caches and glossary and return the batch report"""
+        response_cache = llm_client.response_cache
+        dedup_cache = llm_client.dedup_cache
+        pool_stats = llm_client.pool_stats()
+        endpoint_stats = llm_client.endpoint_stats()
+        llm_client.close()
+        cache_stats = None
+        if response_cache is not None:
+            response_cache.flush()
+            cache_stats = response_cache.stats()
+        dedup_stats = None
+        if dedup_cache is not None:
+            dedup_stats = dedup_cache.stats()
+            dedup_cache.close()
+        glossary_stats = None
+        if glossary is not None:
+            glossary_stats = glossary.stats()
+            glossary.close()
+
+        report = {
+            "root": root,
+            "documents": len(documents),
+            "failed_documents": sum(1 for r in reports if r["error"] or r.get("failed_chunks")
+                                    or r.get("failed_requests") or r.get("invalid_chunks")),
+            "wall_time": wall_time,
+            "input_tokens": sum(r.get("input_tokens", 0) for r in reports),
+            "output_tokens": sum(r.get("output_tokens", 0) for r in reports),
+            "clean_chunks": sum(r.get("clean_chunks", 0) for r in reports),
+            "clean_tokens": sum(r.get("clean_tokens", 0) for r in reports),
+            "connection_pool": pool_stats,
+            "endpoints": endpoint_stats,
+            "rate_limiting": llm_client.scheduler.stats(),
+            "response_cache": cache_stats,
+            "dedup_cache": dedup_stats,
+            "glossary": glossary_stats,
+            "metrics": metrics.summary(),
+            "papers": reports,
+        }
+        metrics.close()
+        return report
+
+    def _save_report(self, report, root, report_path):
+        """Print the report, save it as JSON and return the entries of the papers"""
+        self._print_report(report)
+
+        if report_path is None:
+            report_path = os.path.join(root, 'batch_report.json')
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Batch report saved to {report_path}")
+        return report["papers"]
+
+    def _print_report(self, report):
+        print("")
+        print(f"{'Paper':<40} {'Time (s)':>9} {'Chunks':>7} {'In tok':>9} {'Out tok':>9}  Status")
+        for entry in report["papers"]:
+            if entry["error"]:
+                status = f"FAILED: {entry['error']}"
+            elif entry.get("failed_chunks"):
+                status = f"{entry['failed_chunks']} chunks not written"
+            elif entry.get("failed_requests") or entry.get("invalid_chunks"):
+                status = (f"{entry['failed_requests']} chunks kept as source, "
+                          f"{entry['invalid_chunks']} failing validation")
+            else:
+                status = "ok"
+            print(f"{entry['paper'][:40]:<40} {entry['wall_time']:>9.1f} {entry.get('chunks', 0):>7} "
+                  f"{entry.get('input_tokens', 0):>9} {entry.get('output_tokens', 0):>9}  {status}")
+        print(f"{report['documents']} documents in {report['wall_time']:.1f}s, "
+              f"{report['failed_documents']} with failures, "
+              f"{report['input_tokens']} input / {report['output_tokens']} output tokens (estimated)")
+        if report["clean_chunks"]:
+            print(f"Pre-cleaning: {report['clean_chunks']} chunks needed no request "
+                  f"(~{report['clean_tokens']} input tokens saved)")
+        if len(report["endpoints"]) > 1:
+            for stats in report["endpoints"]:
+                print(format_endpoint_stats(stats))
+        if report["dedup_cache"] is not None:
+            print(format_dedup_stats(report["dedup_cache"]))
+        if report["glossary"] is not None:
+            print(format_glossary_stats(report["glossary"]))
+        print(f"Metrics: {format_summary(report['metrics'])}")
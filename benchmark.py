@@ -0,0 +1,401 @@
+# benchmark.py
+"""Offline benchmarks for splitting, context selection and the request path.
+
+Every scenario runs on synthetic OCR Markdown and against a local
+MockChatServer, so no API key or network access is needed (tiktoken's
+encoding file must already be cached). Each job runs in its own child
+process so that its peak RSS is reported on its own.
+
+    python benchmark.py
+    python benchmark.py --sizes small --scenarios split,process --latency 0.2
+    python benchmark.py --output after.json --baseline before.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module; peak RSS is then not reported
+    resource = None
+
+from metrics import MetricsRecorder, percentile
+from mock_server import MockChatServer
+
+# Corpus sizes in characters
+CORPUS_SIZES = {"small": 30000, "medium": 250000, "large": 1200000}
+CORPUS_KINDS = ("prose", "math", "code", "cjk")
+SCENARIOS = ("split", "context", "client", "process", "translate")
+SPLIT_MODES = ("words", "tokens", "markdown")
+
+WORDS = ("the", "of", "model", "results", "we", "propose", "method", "data", "training", "loss",
+         "network", "layer", "table", "figure", "shows", "that", "in", "a", "is", "for", "with",
+         "performance", "baseline", "experiments", "dataset", "accuracy", "function", "parameters",
+         "which", "are", "on", "this", "approach", "learning", "representation", "section", "error")
+CJK_CHARS = "的是在了不和有大这主中人上为们地个用工时要动国产以我到他会作来分生对于学下级义就年阶发成部民可出能方进同行面说种过命度革而多子后自社加小机也经力线本电高量长党得实家定深法表着水理化争现所二起政三好十战无农使性前等反体合斗路图把结第里正新开论之物从当两些还天资事队批点育重其思与间内去因件日利相由压员气业代全组数果期导平各基或月毛然如应形想制心样干都向变关问比展那它最及外没看治提五解系林者米群头意只明四道马认次文通但条较克又公孔领军流入接席位情运器并飞原油放立题质指建区验活众很教决特此常石强极土少已根共直团统式转别造切九你取西持总料连任志观调七么山程百报更见必真保热委手改管处己将修支识病象几先老光专什六型具示复安带每东增则完风回南广劳轮科北打积车计给节做务被整联步类集号列温装即毫知轴研单色坚据速防史拉世设达尔场织历花受求传口断况采精金界品判参层止边清至万确究书"
+CODE_LINES = ("for i in range(n):", "    total += weights[i] * inputs[i]", "return total / n",
+              "x = np.zeros((batch, dim))", "loss = criterion(outputs, labels)", "optimizer.step()",
+              "if epoch % 10 == 0:", "    print(f'epoch {epoch}: {loss:.4f}')", "def forward(self, x):",
+              "    return self.linear(self.dropout(x))")
+
+def _sentence(rng, math=False):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 22))]
+    if math and rng.random() < 0.5:
+        words.insert(rng.randrange(len(words)), f"$x_{{{rng.randint(1, 9)}}} = \\alpha \\beta_{rng.randint(1, 9)}$")
+    if rng.random() < 0.1:
+        # OCR hyphenation across a line break
+        words.insert(rng.randrange(len(words)), "repre-\nsentation")
+    return " ".join(words).capitalize() + "."
+
+def _paragraph(rng, math=False):
+    return " ".join(_sentence(rng, math) for _ in range(rng.randint(3, 8)))
+
+def _cjk_paragraph(rng):
+    sentences = []
+    for _ in range(rng.randint(3, 7)):
+        text = "".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(15, 40)))
+        if rng.random() < 0.3:
+            text += f" Transformer {rng.choice(CJK_CHARS)}"
+        sentences.append(text + "。")
+    return "".join(sentences)
+
+def _display_math(rng):
+    terms = " + ".join(f"\\frac{{\\partial L}}{{\\partial w_{{{i}}}}}" for i in range(rng.randint(2, 6)))
+    return f"$$\n\\sum_{{i=1}}^{{N}} {terms} = 0\n$$"
+
+def _code_block(rng):
+    lines = [rng.choice(CODE_LINES) for _ in range(rng.randint(4, 25))]
+    return "```python\n" + "\n".join(lines) + "\n```"
+
+def _table(rng):
+    rows = ["| Method | Accuracy | F1 |", "| --- | --- | --- |"]
+    for _ in range(rng.randint(3, 12)):
+        rows.append(f"| {rng.choice(WORDS).capitalize()} | {rng.uniform(50, 99):.1f} | {rng.uniform(0.4, 0.99):.2f} |")
+    return "\n".join(rows)
+
+def synthetic_document(kind, size, seed=0):
+    """Return synthetic OCR'd Markdown of about `size` characters
+
+    Args:
+        kind: "prose", "math" (inline and display math), "code" (fenced code)
+            or "cjk" (Chinese text with some English terms)
+        size: Target length in characters
+        seed: Seed so that every run benchmarks the same text
+
+    Returns:
+        str: The document
+    """
+    rng = random.Random(f"{kind}-{size}-{seed}")
+    blocks = ["# " + " ".join(rng.choice(WORDS) for _ in range(6)).title()]
+    length = len(blocks[0])
+    section = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.06:
+            section += 1
+            block = f"## {section} " + " ".join(rng.choice(WORDS) for _ in range(4)).title()
+        elif roll < 0.14:
+            block = _table(rng)
+        elif kind == "math" and roll < 0.45:
+            block = _display_math(rng)
+        elif kind == "code" and roll < 0.5:
+            block = _code_block(rng)
+        elif kind == "cjk":
+            block = _display_math(rng) if roll < 0.2 else _cjk_paragraph(rng)
+        else:
+            block = _paragraph(rng, math=kind == "math")
+        blocks.append(block)
+        length += len(block) + 2
+    return "\n\n".join(blocks)
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _quiet_status(msg, is_error=False):
+    pass
+
+def _timed_repeats(func, min_time=0.5, max_repeats=20):
+    """Call func until min_time has passed (at least once); return the durations"""
+    durations = []
+    started = time.perf_counter()
+    while not durations or (time.perf_counter() - started < min_time and len(durations) < max_repeats):
+        t = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - t)
+    return durations, result
+
+def run_split(job):
+    """TextSplitter throughput in one chunking mode"""
+    from text_splitter import TextSplitter
+    document = synthetic_document(job["kind"], CORPUS_SIZES[job["size"]])
+    splitter = TextSplitter(max_words=job["chunk_words"],
+                            max_tokens=job["chunk_tokens"] if job["mode"] == "tokens" else None,
+                            markdown=job["mode"] == "markdown")
+    durations, chunks = _timed_repeats(lambda: splitter.split_document(document))
+    median = percentile(durations, 0.5)
+    return {
+        "throughput": len(document.encode("utf-8")) / median / 1e6,
+        "unit": "MB/s",
+        "p50": median,
+        "p99": percentile(durations, 0.99),
+        "items": len(chunks),
+        "notes": f"{len(durations)} runs",
+    }
+
+def run_context(job):
+    """ContextManager cost of adding a chunk pair and selecting the context window"""
+    from context_manager import ContextManager
+    from text_splitter import TextSplitter
+    document = synthetic_document(job["kind"], CORPUS_SIZES[job["size"]])
+    chunks = TextSplitter(max_words=job["chunk_words"]).split_document(document)
+
+    manager = ContextManager()
+    durations = []
+    started = time.perf_counter()
+    for chunk in chunks:
+        t = time.perf_counter()
+        manager.add_user_message(chunk)
+        manager.add_response(chunk)
+        manager.get_limited_combined_messages(20000)
+        manager.get_limited_user_messages(10000)
+        manager.get_latest_conversation_pair_tokens()
+        durations.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    return {
+        "throughput": len(chunks) / elapsed,
+        "unit": "steps/s",
+        "p50": percentile(durations, 0.5),
+        "p99": percentile(durations, 0.99),
+        "items": len(chunks),
+        "notes": "",
+    }
+
+def run_client(job):
+    """LLMClient request throughput and latency against the mock server"""
+    from context_manager import ContextManager
+    from llm_client import LLMClient
+    from text_splitter import TextSplitter
+    document = synthetic_document(job["kind"], CORPUS_SIZES["small"])
+    chunks = TextSplitter(max_words=300).split_document(document)
+    client = LLMClient("benchmark", job["base_url"],
+                       pool_size=job["concurrency"],
+                       stream=job["stream"],
+                       max_concurrency=job["concurrency"],
+                       max_backoff=job["max_backoff"])
+
+    def send(i):
+        t = time.perf_counter()
+        client.process_with_context_of_user("You are a benchmark.", ContextManager(), chunks[i % len(chunks)],
+                                            status_callback=_quiet_status)
+        return time.perf_counter() - t
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=job["concurrency"]) as executor:
+        durations = list(executor.map(send, range(job["requests"])))
+    elapsed = time.perf_counter() - started
+    stats = client.pool_stats()
+    client.close()
+    return {
+        "throughput": len(durations) / elapsed,
+        "unit": "req/s",
+        "p50": percentile(durations, 0.5),
+        "p99": percentile(durations, 0.99),
+        "items": len(durations),
+        "notes": f"{stats['hits']} reused / {stats['misses']} new connections",
+    }
+
+def run_document(job):
+    """DocumentProcessor or DocumentTranslator end to end, with per-chunk latency"""
+    if job["scenario"] == "process":
+        from document_processor import DocumentProcessor as document_class
+    else:
+        from document_translator import DocumentTranslator as document_class
+    document = synthetic_document(job["kind"], CORPUS_SIZES[job["size"]])
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = os.path.join(folder, "complete.md")
+        prompt_path = os.path.join(folder, "prompt.md")
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write(document)
+        with open(prompt_path, 'w', encoding='utf-8') as f:
+            f.write("You are a benchmark.")
+
+        metrics = MetricsRecorder()
+        runner = document_class(input_path, os.path.join(folder, "output.md"), job["base_url"], prompt_path,
+                                "benchmark", concurrency=job["concurrency"], stream=job["stream"],
+                                use_cache=False, chunk_words=job["chunk_words"], max_backoff=job["max_backoff"],
+                                metrics=metrics)
+        if runner.validator is not None:
+            # The mock server echoes the source, which is never a Chinese translation
+            runner.validator.target_language = None
+        summary = runner.run()
+
+    latencies = [e["total_time"] if e.get("total_time") is not None else e["latency"]
+                 for e in metrics.chunk_events if e.get("latency") is not None]
+    return {
+        "throughput": len(document) / summary["wall_time"] / 1000,
+        "unit": "kchar/s",
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "items": summary["chunks"],
+        "notes": f"{summary['metrics']['retries']} retries, {summary['revalidations']} re-requested",
+    }
+
+JOB_RUNNERS = {
+    "split": run_split,
+    "context": run_context,
+    "client": run_client,
+    "process": run_document,
+    "translate": run_document,
+}
+
+def run_job(job):
+    """Run one job with its output silenced and return its result row"""
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = JOB_RUNNERS[job["scenario"]](job)
+    result.update({
+        "scenario": job["scenario"],
+        "corpus": f"{job['kind']}-{job['size']}",
+        "mode": job.get("mode", ""),
+        "seconds": time.perf_counter() - started,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+def build_jobs(args, base_url):
+    """Expand the command line options into the list of jobs to run"""
+    common = {
+        "base_url": base_url,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "chunk_words": args.chunk_words,
+        "chunk_tokens": args.chunk_tokens,
+        "max_backoff": args.max_backoff,
+        "requests": args.requests,
+    }
+    jobs = []
+    for scenario in args.scenarios:
+        if scenario == "client":
+            jobs.append(dict(common, scenario=scenario, kind=args.kinds[0], size="small"))
+            continue
+        for size in args.sizes:
+            for kind in args.kinds:
+                if scenario == "split":
+                    for mode in SPLIT_MODES:
+                        jobs.append(dict(common, scenario=scenario, kind=kind, size=size, mode=mode))
+                else:
+                    jobs.append(dict(common, scenario=scenario, kind=kind, size=size))
+    return jobs
+
+def run_in_child(job):
+    """Run a job in a fresh interpreter so that peak RSS is per job"""
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--job", json.dumps(job)],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark job {job['scenario']} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def _row_key(row):
+    return (row["scenario"], row["corpus"], row["mode"])
+
+def _format_seconds(value):
+    if value is None:
+        return "n/a"
+    return f"{value * 1000:.1f}ms" if value < 1 else f"{value:.2f}s"
+
+def print_results(results, baseline=None):
+    """Print the results table, with the throughput change against a baseline if given"""
+    previous = {_row_key(row): row for row in baseline or []}
+    print("")
+    print(f"{'Scenario':<10} {'Corpus':<14} {'Mode':<9} {'Throughput':>17} {'p50':>9} {'p99':>9} "
+          f"{'Peak RSS':>9} {'Change':>8}  Notes")
+    for row in results:
+        rss = f"{row['peak_rss_mb']:.0f}MiB" if row["peak_rss_mb"] is not None else "n/a"
+        change = ""
+        old = previous.get(_row_key(row))
+        if old and old["throughput"]:
+            change = f"{(row['throughput'] / old['throughput'] - 1) * 100:+.1f}%"
+        print(f"{row['scenario']:<10} {row['corpus']:<14} {row['mode']:<9} "
+              f"{row['throughput']:>10.2f} {row['unit']:<6} {_format_seconds(row['p50']):>9} "
+              f"{_format_seconds(row['p99']):>9} {rss:>9} {change:>8}  {row['items']} items {row['notes']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline performance benchmarks against a mock server")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated scenarios ({', '.join(SCENARIOS)})")
+    parser.add_argument("--sizes", default="small,medium", help=f"Comma separated corpus sizes ({', '.join(CORPUS_SIZES)})")
+    parser.add_argument("--kinds", default=",".join(CORPUS_KINDS), help=f"Comma separated corpus kinds ({', '.join(CORPUS_KINDS)})")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight for the client and document scenarios")
+    parser.add_argument("--stream", action="store_true", help="Stream responses")
+    parser.add_argument("--chunk-words", type=int, default=1500, help="Words per chunk")
+    parser.add_argument("--chunk-tokens", type=int, default=1500, help="Tokens per chunk in the 'tokens' split mode")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests in the client scenario")
+    parser.add_argument("--max-backoff", type=float, default=0.5, help="Upper bound for retry delays, kept short for benchmarks")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock server: seconds before the first byte")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Mock server: generation speed (default: instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock server: share of 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Mock server: share of 429 responses")
+    parser.add_argument("--seed", type=int, default=0, help="Mock server: seed for injected failures")
+    parser.add_argument("--in-process", action="store_true", help="Run every job in this process (peak RSS is then cumulative)")
+    parser.add_argument("--output", default=None, help="Save the results as JSON")
+    parser.add_argument("--baseline", default=None, help="Results JSON of an earlier run to compare throughput against")
+    parser.add_argument("--job", default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.job:
+        # Child process: run one job and report it as the last line of output
+        print(json.dumps(run_job(json.loads(args.job))))
+        return
+
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    args.sizes = [s for s in args.sizes.split(",") if s]
+    args.kinds = [k for k in args.kinds.split(",") if k]
+    for name, allowed in ((args.scenarios, SCENARIOS), (args.sizes, CORPUS_SIZES), (args.kinds, CORPUS_KINDS)):
+        unknown = set(name) - set(allowed)
+        if unknown:
+            raise ValueError(f"Unknown benchmark option(s): {', '.join(sorted(unknown))}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+
+    with MockChatServer(latency=args.latency,
+                        tokens_per_second=args.tokens_per_second,
+                        error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate,
+                        seed=args.seed,
+                        keep_requests=False) as server:
+        jobs = build_jobs(args, server.base_url)
+        print(f"Running {len(jobs)} benchmark jobs against mock server {server.base_url}")
+        results = []
+        for job in jobs:
+            label = f"{job['scenario']} {job['kind']}-{job['size']} {job.get('mode', '')}".strip()
+            print(f"  {label}...")
+            results.append(run_job(job) if args.in_process else run_in_child(job))
+        server_stats = {"requests": server.request_count, "status_counts": server.status_counts}
+
+    print_results(results, baseline)
+    print(f"Mock server answered {server_stats['requests']} requests "
+          f"({server_stats['status_counts'][429]} with 429, {server_stats['status_counts'][500]} with 500)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"options": vars(args), "server": server_stats, "results": results}, f, indent=2)
+        print(f"Benchmark results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
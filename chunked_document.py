@@ -0,0 +1,842 @@
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from text_splitter import TextSplitter, iter_paragraphs
+from llm_client import LLMClient, LLMRequestError
+from response_validator import ResponseValidator
+from endpoints import format_endpoint_stats
+from output_writer import BufferedOutputWriter, ChunkFileWriter
+from context_manager import ContextManager
+from response_cache import ResponseCache
+from dedup_cache import DedupCache, format_dedup_stats
+from metrics import create_recorder, format_summary
+from registry import load_prompt, measure_prompt
+from context_policies import GlossaryPolicy, SourceOnlyPolicy, get_policy
+from protected_blocks import BlockClassifier, ProtectedBlock
+from autotune import ChunkAutotuner, format_recommendation
+from pre_cleaner import PreCleaner
+from glossary import Glossary, format_glossary_stats
+
+class ChunkedDocument:
+    """Shared chunk loop behind DocumentProcessor and DocumentTranslator.
+
+    Subclasses only describe the job (temporary folder, context budget and
+    the wording used in progress messages); splitting, sending and writing
+    chunks in order lives here.
+    """
+    tmp_folder_name = '.tmp_process'
+    context_max_tokens = 20000
+    action = "Processing"
+    action_done = "processed"
+    noun = "processing"
+
+    # Inputs at least this large are read and split lazily unless stream_input says otherwise
+    STREAM_INPUT_BYTES = 8 * 1024 * 1024
+
+    # Blocks that skip the LLM, by kind (see BlockClassifier), with the local
+    # formatter applied to them (None keeps them as they are)
+    protected_blocks = {}
+    # Shorter code, math and link blocks are sent with the surrounding text
+    MIN_PROTECTED_CHARS = 2000
+
+    # Whether the mechanical fixes of PreCleaner may replace requests for this task
+    pre_cleaning = False
+
+    # Whether a glossary of the terms in finished results may replace the context of earlier chunks
+    term_glossary = False
+
+    # Validation problem of a response that reached max_tokens
+    CUT_OFF = "response cut off by max_tokens"
+
+    # Language the results must be written in, checked by ResponseValidator
+    target_language = None
+
+    def __init__(self, input_path, output_path, base_url, prompt_path, api_key, model="gpt-4o-mini",
+                 concurrency=1, pool_size=4, pool_idle_timeout=60, stream=False,
+                 resume=False, cache_dir=None, cache_max_mb=512, use_cache=True, response_cache=None,
+                 llm_client=None, system_prompt=None, executor=None, log_prefix=None, on_chunk=None,
+                 chunk_words=1500, chunk_tokens=None, markdown_chunks=False,
+                 requests_per_minute=None, tokens_per_minute=None, max_backoff=60,
+                 metrics=None, metrics_log=None, metrics_sink=None, stream_input=None,
+                 context_policy="latest", prefix_cache=False, cache_hint=None,
+                 endpoints=None, hedge_percentile=None, buffer_output=False, dedup_cache=None,
+                 protect_blocks=True, validate_responses=True, fallback_model=None, revalidate_attempts=1,
+                 max_completion_tokens=None, autotune=None, pre_clean=False, glossary=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.api_key = api_key
+        self.base_url = base_url
+        self.concurrency = max(1, int(concurrency))
+        self.stream = stream
+
+        # None decides from the input size, see STREAM_INPUT_BYTES
+        self.stream_input = stream_input
+
+        # Keep results in memory and write the output once, without chunk files
+        self.buffer_output = buffer_output
+
+        # Reference lists, code, math and links are kept away from the LLM when the subclass allows it
+        self.protect_blocks = protect_blocks and bool(self.protected_blocks)
+
+        # Only when asked for (and the subclass allows it), mechanical fixes are made
+        # locally and chunks left clean skip the LLM's general corrections
+        self.pre_clean = pre_clean and self.pre_cleaning
+        self.pre_cleaner = None
+
+        # In batch mode chunks are submitted to a pool shared by many documents
+        self.executor = executor
+        self.log_prefix = log_prefix
+
+        # Called with (index, response) after each chunk is written, e.g. to feed a next stage
+        self.on_chunk = on_chunk
+        
+        # Per-chunk events go to a recorder shared by the caller, or to our own
+        self.owns_metrics = metrics is None
+        if metrics is None:
+            metrics = create_recorder(metrics_log, metrics_sink)
+        self.metrics = metrics
+
+        # Initialize components
+        # Chunks are budgeted in real tokens when chunk_tokens is given, otherwise in words
+        self.text_splitter = TextSplitter(max_words=chunk_words, max_tokens=chunk_tokens,
+                                          markdown=markdown_chunks)
+        self.owns_llm_client = llm_client is None
+        if llm_client is None:
+            # Responses are cached next to the output unless a shared cache directory is given
+            if use_cache and response_cache is None:
+                if cache_dir is None:
+                    cache_dir = os.path.join(os.path.dirname(output_path), '.cache')
+                response_cache = ResponseCache(cache_dir, max_bytes=int(cache_max_mb * 1024 * 1024))
+            # Repeated chunks are looked up in a store that may be shared with other runs
+            if isinstance(dedup_cache, str):
+                dedup_cache = DedupCache(dedup_cache)
+            llm_client = LLMClient(api_key, base_url, model,
+                                   pool_size=max(pool_size, self.concurrency),
+                                   pool_idle_timeout=pool_idle_timeout,
+                                   stream=stream,
+                                   response_cache=response_cache,
+                                   resume=resume,
+                                   requests_per_minute=requests_per_minute,
+                                   tokens_per_minute=tokens_per_minute,
+                                   max_concurrency=self.concurrency,
+                                   max_backoff=max_backoff,
+                                   cache_hint=cache_hint,
+                                   endpoints=endpoints,
+                                   hedge_percentile=hedge_percentile,
+                                   dedup_cache=dedup_cache,
+                                   max_completion_tokens=max_completion_tokens)
+        self.llm_client = llm_client
+        self.response_cache = llm_client.response_cache
+        # Context of sequential requests; concurrent requests always use the source only.
+        # The history is only kept as far back as the policy can use it. With
+        # prefix_cache the context is laid out so that requests share a prefix.
+        if context_policy == "glossary" and not self.term_glossary:
+            # Only translations name their terms, so such a glossary would stay empty
+            self._log("The glossary context policy only applies to translation; using 'latest' instead.")
+            context_policy = "latest"
+        self.context_policy = get_policy(context_policy, prefix_cache=prefix_cache)
+        self.source_policy = SourceOnlyPolicy()
+        # With a glossary (a JSON path, or a Glossary shared by the caller) the
+        # context is only the entries of the terms in the chunk. It never waits
+        # for the previous result, so concurrent requests use it too.
+        shared_glossary = isinstance(glossary, Glossary)
+        if isinstance(glossary, str) and self.term_glossary:
+            glossary = Glossary(glossary)
+        if glossary is not None and self.term_glossary:
+            self.context_policy = GlossaryPolicy(glossary)
+        self.glossary = getattr(self.context_policy, "glossary", None)
+        self.owns_glossary = self.glossary is not None and not shared_glossary
+        if self.glossary is not None:
+            self.source_policy = self.context_policy
+        self.context_manager = ContextManager(max_messages=self.context_policy.history_messages)
+
+        # Load prompt unless it was already loaded by the caller; either way its
+        # token count is measured once per process, not on every request
+        if system_prompt is None:
+            system_prompt = load_prompt(prompt_path)
+        if self.glossary is not None and self.term_glossary:
+            # Only then are results asked to name their terms, which the glossary learns from
+            system_prompt = system_prompt + GlossaryPolicy.PROMPT_SECTION
+        self.system_prompt = measure_prompt(system_prompt)
+
+        # Responses that fail the local checks are requested again, on fallback_model if given
+        self.validator = None
+        if validate_responses:
+            self.validator = ResponseValidator(self.system_prompt, target_language=self.target_language)
+        self.fallback_model = fallback_model
+        self.revalidate_attempts = revalidate_attempts
+
+        # max_tokens of this document's requests; None uses the client's
+        self.max_completion_tokens = max_completion_tokens
+
+        # The autotuner learns from this document's requests and may pick
+        # the chunk size and max_tokens from earlier runs. A profile path is
+        # opened here; a shared ChunkAutotuner is fed and saved by its owner.
+        self.owns_autotuner = isinstance(autotune, str)
+        if self.owns_autotuner:
+            autotune = ChunkAutotuner(autotune, self.noun, max_output_tokens=llm_client.max_completion_tokens)
+            self.metrics.add_sink(autotune)
+        self.autotuner = autotune
+        if autotune is not None:
+            self._apply_autotune(markdown_chunks)
+
+    def _apply_autotune(self, markdown_chunks):
+        """Split by the tuned token budget and ask for the tuned max_tokens, if the profile has enough data"""
+        targets = [(endpoint.model, endpoint.name) for endpoint in self.llm_client.endpoints]
+        # Leave at least half of the prompt budget to the system prompt and context
+        max_chunk_tokens = (self.context_max_tokens - self.system_prompt.token_count) // 2
+        recommendation = self.autotuner.recommend(targets, max_chunk_tokens)
+        if recommendation is None:
+            self._log("Autotune: not enough measurements for this model yet, keeping the configured chunk size")
+            return
+        self.text_splitter = TextSplitter(max_tokens=recommendation["chunk_tokens"], markdown=markdown_chunks)
+        self.max_completion_tokens = recommendation["max_completion_tokens"]
+        self._log(f"Autotune: {format_recommendation(recommendation)}")
+
+    def _log(self, msg):
+        """Print a progress message, tagged with the document in batch mode"""
+        if self.log_prefix:
+            print(f"[{self.log_prefix}] {msg}")
+        else:
+            print(msg)
+
+    def _chunk_status_callback(self, index):
+        """Status callback that tags every message with its chunk number.
+
+        With several chunks in flight the plain STATUS lines would interleave
+        and become impossible to attribute.
+        """
+        label = f"{self.log_prefix} chunk {index}" if self.log_prefix else f"chunk {index}"
+
+        def status_callback(msg, is_error=False):
+            print(f"{'ERROR: ' if is_error else 'STATUS: '}[{label}] {msg}")
+        return status_callback
+
+    def _stream_writer(self, writer, index):
+        """Return a writer for streamed tokens, or None when streaming is off"""
+        if not self.stream:
+            return None
+        return writer.stream_writer(index)
+
+    def _request_with_latest_context(self, index, chunk, stream_writer=None, model=None, bypass_cache=False,
+                                     max_completion_tokens=None):
+        """Sequential mode: context_policy picks from the previous chunks and their results
+        
+        With the default "latest" policy this is the previous source chunk and its result.
+        """
+        return self.llm_client.process(
+            self.system_prompt,
+            self.context_manager,
+            chunk,
+            self.context_policy,
+            max_tokens=self.context_max_tokens,
+            stream_writer=stream_writer,
+            model=model,
+            bypass_cache=bypass_cache,
+            max_completion_tokens=max_completion_tokens
+        )
+
+    def _request_with_source_context(self, index, chunk, previous_chunk, stream_writer=None, model=None,
+                                     bypass_cache=False, max_completion_tokens=None):
+        """Concurrent policy: only the previous *source* chunk is used as context.
+
+        The previous result may still be in flight, so waiting for it would
+        serialize the requests again. The source text is known up front and
+        still gives the model the surrounding headings and terminology.
+        With a glossary its entries are sent instead.
+        """
+        return self.llm_client.process(
+            self.system_prompt,
+            self._source_context(previous_chunk),
+            chunk,
+            self.source_policy,
+            max_tokens=self.context_max_tokens,
+            status_callback=self._chunk_status_callback(index),
+            stream_writer=stream_writer,
+            model=model,
+            bypass_cache=bypass_cache,
+            max_completion_tokens=max_completion_tokens
+        )
+
+    def _source_context(self, previous_chunk):
+        """Context holding only the previous source chunk, known before any result is"""
+        source_context = ContextManager()
+        if previous_chunk is not None:
+            source_context.add_user_message(previous_chunk)
+        return source_context
+
+    def _source_messages(self, chunk, previous_chunk):
+        """Messages that _request_with_source_context() sends for chunk"""
+        messages, _ = self.llm_client.build_messages(self.system_prompt, self._source_context(previous_chunk),
+                                                     chunk, self.source_policy, self.context_max_tokens)
+        return messages
+
+    def _request_validated(self, index, chunk, request, stream_writer=None, model=None, bypass_cache=False,
+                           revalidations=0, truncated=False):
+        """Send a chunk with request(model, bypass_cache, max_completion_tokens) and ask again while the result is bad
+
+        A result failing the validator's checks, a response cut off by
+        max_tokens, or a request that failed after all its retries, is
+        re-requested up to revalidate_attempts times, bypassing the caches
+        and using fallback_model if one is set. A response cut off by a tuned
+        max_tokens is asked again with the client's full max_tokens; one cut
+        off by the full max_tokens is kept, flagged, since asking again would
+        only repeat it.
+        model and bypass_cache apply to the first request; revalidations
+        counts re-requests already made for the chunk elsewhere, and
+        truncated says that an earlier response was already cut off.
+        Returns (response, info); response is None if no request succeeded,
+        and info["validation"] lists the problems of the returned response.
+        """
+        max_completion_tokens = None if truncated else self.max_completion_tokens
+        while True:
+            cut_off_at_full_cap = False
+            try:
+                response = request(model, bypass_cache, max_completion_tokens)
+                problems = self.validator.validate(chunk, response) if self.validator is not None else []
+                if (self.llm_client.last_request_info() or {}).get("finish_reason") == "length":
+                    problems.append(self.CUT_OFF)
+                    truncated = True
+                    if not self._cap_can_be_lifted(max_completion_tokens):
+                        cut_off_at_full_cap = True
+                    max_completion_tokens = None
+            except LLMRequestError as e:
+                response = None
+                problems = [str(e)]
+            if not problems or revalidations >= self.revalidate_attempts:
+                break
+            if problems == [self.CUT_OFF] and cut_off_at_full_cap:
+                break
+
+            revalidations += 1
+            model = self.fallback_model
+            self._log(f"Chunk {index} failed validation ({'; '.join(problems)}), requesting it again"
+                      + (f" with {model}" if model else ""))
+            # Drop whatever the bad response streamed to disk
+            if stream_writer is not None:
+                stream_writer.discard()
+            bypass_cache = True
+
+        info = self._request_info()
+        info["validation"] = problems
+        info["revalidations"] = revalidations
+        info["truncated"] = truncated
+        return response, info
+
+    def _cap_can_be_lifted(self, max_completion_tokens):
+        """Whether a request capped at max_completion_tokens asked for less than the client's max_tokens"""
+        return (max_completion_tokens is not None
+                and max_completion_tokens < self.llm_client.max_completion_tokens)
+
+    def _request_info(self, queue_time=0.0):
+        """Copy the calling thread's last request details, adding the time spent queued"""
+        info = dict(self.llm_client.last_request_info() or {})
+        info["queue_time"] = queue_time
+        return info
+
+    def _run_queued(self, submitted, index, chunk, previous_chunk, stream_writer=None):
+        """Worker entry point: send the chunk and return (response, request details)"""
+        queue_time = time.monotonic() - submitted
+        response, info = self._request_validated(
+            index, chunk,
+            lambda model, bypass_cache, max_completion_tokens: self._request_with_source_context(
+                index, chunk, previous_chunk, stream_writer, model, bypass_cache, max_completion_tokens),
+            stream_writer)
+        info["queue_time"] = queue_time
+        return response, info
+
+    def _keep_block(self, block):
+        """Local result of a protected block: formatted, or the block itself"""
+        formatter = self.protected_blocks.get(block.kind)
+        return formatter(block) if formatter is not None else str(block)
+
+    def _iter_sequential(self, chunks, total, writer):
+        """Yield (index, chunk, response, stream_writer, info) one request at a time"""
+        for i, chunk in enumerate(chunks, 1):
+            if isinstance(chunk, ProtectedBlock):
+                self._log(f"Keeping chunk {i}/{total} ({chunk.kind}) without a request...")
+                yield i, chunk, self._keep_block(chunk), None, {"protected": chunk.kind}
+                continue
+            self._log(f"{self.action} chunk {i}/{total}...")
+            stream_writer = self._stream_writer(writer, i)
+            response, info = self._request_validated(
+                i, chunk,
+                lambda model, bypass_cache, max_completion_tokens: self._request_with_latest_context(
+                    i, chunk, stream_writer, model, bypass_cache, max_completion_tokens),
+                stream_writer)
+            yield i, chunk, response, stream_writer, info
+
+    def _iter_concurrent(self, chunks, total, writer):
+        """Yield (index, chunk, response, stream_writer, info) in chunk order with several requests in flight
+
+        At most `concurrency` requests run at once; the submission window is
+        kept at twice that so finished-but-unwritten results stay bounded.
+        """
+        if self.executor is not None:
+            yield from self._iter_submitted(chunks, total, writer, self.executor)
+            return
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            yield from self._iter_submitted(chunks, total, writer, executor)
+
+    def _iter_submitted(self, chunks, total, writer, executor):
+        """Submit chunks to executor and yield their results in chunk order"""
+        window = self.concurrency * 2
+        pending = deque()
+        previous_chunk = None
+        for i, chunk in enumerate(chunks, 1):
+            if isinstance(chunk, ProtectedBlock):
+                # Done already, but it still waits for its turn to be written
+                self._log(f"Keeping chunk {i}/{total} ({chunk.kind}) without a request...")
+                future = Future()
+                future.set_result((self._keep_block(chunk), {"protected": chunk.kind}))
+                pending.append((i, chunk, future, None))
+            else:
+                self._log(f"{self.action} chunk {i}/{total} (queued)...")
+                stream_writer = self._stream_writer(writer, i)
+                future = executor.submit(self._run_queued, time.monotonic(), i, chunk, previous_chunk,
+                                         stream_writer)
+                pending.append((i, chunk, future, stream_writer))
+                previous_chunk = chunk
+
+            # Drain the oldest result once the window is full
+            while len(pending) >= window:
+                index, source, future, stream_writer = pending.popleft()
+                response, info = future.result()
+                yield index, source, response, stream_writer, info
+
+        while pending:
+            index, source, future, stream_writer = pending.popleft()
+            response, info = future.result()
+            yield index, source, response, stream_writer, info
+
+    def batch_requests(self):
+        """Yield (index, request body) for every chunk an offline batch has to answer
+
+        Each chunk gets the previous source chunk as context, as in
+        concurrent mode, since no result is known when the batch is written.
+        Protected blocks, and chunks that would be answered from the dedup
+        cache or (when resuming) the response cache, are left out.
+        """
+        previous_chunk = None
+        for i, chunk in enumerate(self._load_chunks(), 1):
+            if isinstance(chunk, ProtectedBlock):
+                continue
+            messages = self._source_messages(chunk, previous_chunk)
+            previous_chunk = chunk
+            if not self.llm_client.has_result(self.system_prompt, chunk, messages):
+                yield i, self.llm_client.build_payload(messages, max_completion_tokens=self.max_completion_tokens)
+
+    def _iter_batch(self, chunks, total, batch_results, on_direct=None):
+        """Yield (index, chunk, response, stream_writer, info) from the results of an offline batch
+
+        batch_results maps chunk indices to dicts with content (None on
+        error), error, status, usage, finish_reason and the messages the
+        request was submitted with, if known. Chunks the batch did
+        not answer (failed lines, an expired batch, chunks left out of it)
+        are requested directly with the same context; results failing
+        validation are requested again like any other invalid result.
+        on_direct(index, response, info) is called with the result of every
+        direct request; passed back with direct=True, such a result is used
+        as it is, so a finished batch never sends the chunk again.
+        """
+        previous_chunk = None
+        for i, chunk in enumerate(chunks, 1):
+            if isinstance(chunk, ProtectedBlock):
+                yield i, chunk, self._keep_block(chunk), None, {"protected": chunk.kind}
+                continue
+            previous, previous_chunk = previous_chunk, chunk
+
+            result = batch_results.get(i) or {}
+            problems = []
+            truncated = False
+            if result.get("content") is not None:
+                response = result["content"]
+                problems = self.validator.validate(chunk, response) if self.validator is not None else []
+                truncated = result.get("finish_reason") == "length"
+                if truncated:
+                    problems.append(self.CUT_OFF)
+                # Only a cut-off under a tuned max_tokens is worth asking again for
+                cut_off_at_full_cap = (problems == [self.CUT_OFF]
+                                       and not self._cap_can_be_lifted(self.max_completion_tokens))
+                if (not problems or self.revalidate_attempts < 1 or result.get("direct")
+                        or cut_off_at_full_cap):
+                    if not problems:
+                        # Cached under the request that was sent; the context may have changed since
+                        messages = result.get("messages") or self._source_messages(chunk, previous)
+                        self.llm_client.store_result(self.system_prompt, chunk, messages, response,
+                                                     result.get("model"))
+                    endpoint = self.llm_client.endpoints[0]
+                    info = {key: result.get(key) for key in ("status", "usage", "finish_reason")}
+                    info.update(batch=not result.get("direct"), attempts=1, retries=0, validation=problems, truncated=truncated,
+                                endpoint=endpoint.name, model=result.get("model") or endpoint.model)
+                    yield i, chunk, response, None, info
+                    continue
+                self._log(f"Chunk {i}/{total} failed validation in the batch ({'; '.join(problems)}), "
+                          f"requesting it again" + (f" with {self.fallback_model}" if self.fallback_model else ""))
+            elif result:
+                self._log(f"Chunk {i}/{total} failed in the batch ({result.get('error')}), requesting it directly...")
+            else:
+                self._log(f"Chunk {i}/{total} has no batch result, requesting it directly...")
+
+            response, info = self._request_validated(
+                i, chunk,
+                lambda model, bypass_cache, max_completion_tokens: self._request_with_source_context(
+                    i, chunk, previous, None, model, bypass_cache, max_completion_tokens),
+                model=self.fallback_model if problems else None,
+                bypass_cache=bool(problems),
+                revalidations=1 if problems else 0,
+                truncated=truncated)
+            if on_direct is not None and response is not None:
+                on_direct(i, response, info)
+            yield i, chunk, response, None, info
+
+    @property
+    def metrics_document(self):
+        """Name that tags this document's events in a shared metrics log"""
+        return self.log_prefix or self.input_path
+
+    def _record_chunk(self, i, chunk, chunk_tokens, response, info, written):
+        """Emit the metrics event of one finished chunk (chunk_tokens is None for protected blocks)"""
+        usage = info.get("usage") or {}
+        details = usage.get("prompt_tokens_details") or {}
+        cached_tokens = details.get("cached_tokens")
+        if cached_tokens is None:
+            # Providers that do not follow OpenAI's usage layout
+            cached_tokens = usage.get("prompt_cache_hit_tokens", usage.get("cache_read_input_tokens"))
+        self.metrics.emit(
+            "chunk",
+            document=self.metrics_document,
+            index=i,
+            task=self.noun,
+            chunk_chars=len(chunk),
+            chunk_tokens=chunk_tokens,
+            chunk_budget=self.chunk_budget,
+            queue_time=info.get("queue_time"),
+            throttle_wait=info.get("throttle_wait"),
+            latency=info.get("latency"),
+            total_time=info.get("total_time"),
+            ttfb=info.get("ttfb"),
+            attempts=info.get("attempts"),
+            retries=info.get("retries"),
+            status=info.get("status"),
+            finish_reason=info.get("finish_reason"),
+            truncated=info.get("truncated", False),
+            endpoint=info.get("endpoint"),
+            model=info.get("model"),
+            cache_hit=info.get("cache_hit", False),
+            dedup_hit=info.get("dedup_hit", False),
+            protected=info.get("protected"),
+            batch=info.get("batch", False),
+            validation=info.get("validation") or None,
+            revalidations=info.get("revalidations", 0),
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cached_tokens=cached_tokens,
+            bytes_written=len(response.encode('utf-8')) if written else 0,
+            failed=not written,
+        )
+
+    def _iter_input_chunks(self):
+        """Read and split the input file lazily, one paragraph at a time
+        
+        Memory stays flat whatever the size of the input, and the first
+        request goes out before the rest of the file has been read.
+        """
+        with open(self.input_path, 'r', encoding='utf-8') as f:
+            yield from self._split_input(iter_paragraphs(f))
+
+    def _split_input(self, paragraphs):
+        """Split the input's paragraphs into chunks, pre-cleaned first if a PreCleaner is set
+
+        Chunks with nothing left to repair are passed on as "clean"
+        ProtectedBlock items, which are kept as they are without a request.
+        """
+        if self.pre_cleaner is None:
+            yield from self._split_paragraphs(paragraphs)
+            return
+        for chunk in self._split_paragraphs(self.pre_cleaner.clean_paragraphs(paragraphs)):
+            if isinstance(chunk, ProtectedBlock) or self.pre_cleaner.needs_llm(chunk):
+                yield chunk
+            else:
+                yield ProtectedBlock(chunk, "clean")
+
+    def _iter_runs(self, classified):
+        """Group (kind, paragraph) pairs into runs, handing small protected runs back to the LLM
+
+        Yields (kind, paragraphs); kind is None for text, whose paragraphs
+        are yielded lazily. Cutting a chunk around a short code block or
+        formula would cost a request more than it saves, so protected runs
+        under MIN_PROTECTED_CHARS (other than reference lists) stay text.
+        """
+        for kind, group in groupby(classified, key=itemgetter(0)):
+            if kind is None:
+                yield None, (paragraph for _, paragraph in group)
+                continue
+            paragraphs = [paragraph for _, paragraph in group]
+            if kind != "references" and sum(map(len, paragraphs)) < self.MIN_PROTECTED_CHARS:
+                kind = None
+            yield kind, paragraphs
+
+    def _split_paragraphs(self, paragraphs):
+        """Split paragraphs into chunks, with protected blocks passed through as ProtectedBlock items
+        
+        Protected blocks are found before splitting, so a chunk never mixes
+        text for the LLM with a reference list or a large code block.
+        """
+        if not self.protect_blocks:
+            yield from self.text_splitter.iter_segments(paragraphs)
+            return
+        classifier = BlockClassifier(self.protected_blocks)
+        classified = ((classifier.classify(paragraph), paragraph) for paragraph in paragraphs)
+        for is_text, runs in groupby(self._iter_runs(classified), key=lambda run: run[0] is None):
+            if is_text:
+                yield from self.text_splitter.iter_segments(
+                    paragraph for _, texts in runs for paragraph in texts)
+            else:
+                for kind, texts in runs:
+                    yield ProtectedBlock('\n\n'.join(texts), kind)
+
+    def _protect_chunks(self, chunks):
+        """Take protected blocks out of chunks that were split by a previous stage
+        
+        Chunks without any are passed on unchanged; the others are cut
+        around their protected blocks instead of being split again.
+        """
+        classifier = BlockClassifier(self.protected_blocks)
+        for chunk in chunks:
+            paragraphs = chunk.split('\n\n')
+            runs = [(kind, list(texts)) for kind, texts in
+                    self._iter_runs((classifier.classify(paragraph), paragraph) for paragraph in paragraphs)]
+            if all(kind is None for kind, _ in runs):
+                yield chunk
+                continue
+            for is_text, group in groupby(runs, key=lambda run: run[0] is None):
+                if is_text:
+                    text = '\n\n'.join(paragraph for _, texts in group for paragraph in texts)
+                    if text.strip():
+                        yield text
+                else:
+                    for kind, texts in group:
+                        yield ProtectedBlock('\n\n'.join(texts), kind)
+
+    def _should_stream_input(self):
+        if self.stream_input is not None:
+            return self.stream_input
+        return os.path.getsize(self.input_path) >= self.STREAM_INPUT_BYTES
+
+    def _open_writer(self):
+        """Results are kept in memory, or saved as chunk files that make up the output at the end"""
+        if self.buffer_output:
+            return BufferedOutputWriter(self.output_path)
+        output_dir = os.path.dirname(self.output_path)
+        tmp_folder = os.path.join(output_dir, self.tmp_folder_name)
+        os.makedirs(tmp_folder, exist_ok=True)
+        self._log(f"Created temporary folder for chunk {self.noun}: {tmp_folder}")
+        return ChunkFileWriter(self.output_path, tmp_folder)
+
+    def _load_chunks(self, chunks=None):
+        """Return the chunks to process: the input file split, or chunks from a previous stage"""
+        # Token budget the chunks were split with, for the autotuner; unknown for a previous stage's chunks
+        self.chunk_budget = self.text_splitter.max_tokens if chunks is None else None
+        if chunks is None and self.pre_clean:
+            # Headers and footers are found in a first pass over the file, read lazily
+            self.pre_cleaner = PreCleaner()
+            with open(self.input_path, 'r', encoding='utf-8') as f:
+                self.pre_cleaner.scan(iter_paragraphs(f))
+        if chunks is None and self._should_stream_input():
+            chunks = self._iter_input_chunks()
+            self._log("Reading and splitting the document while it is processed")
+        elif chunks is None:
+            # Read input document
+            with open(self.input_path, 'r', encoding='utf-8') as f:
+                document = f.read()
+
+            # Split document into chunks
+            chunks = list(self._split_input(document.split('\n\n')))
+            self._log(f"Document split into {len(chunks)} chunks")
+        elif self.protect_blocks:
+            chunks = self._protect_chunks(chunks)
+        return chunks
+
+    def run(self, chunks=None):
+        """Run the entire document through the LLM in chunks
+
+        Args:
+            chunks: Optional iterable of already split chunks, e.g. the output of a
+                previous stage. By default the input file is read and split.
+        """
+        started = time.monotonic()
+        self._log(f"Starting document {self.noun} of '{self.input_path}'...")
+        writer = self._open_writer()
+        chunks = self._load_chunks(chunks)
+
+        # Chunks fed from a previous stage arrive one by one, so the total is not known yet
+        total = len(chunks) if hasattr(chunks, '__len__') else '?'
+
+        if self.executor is not None:
+            results = self._iter_concurrent(chunks, total, writer)
+        elif self.concurrency > 1:
+            self._log(f"Running with up to {self.concurrency} concurrent requests")
+            results = self._iter_concurrent(chunks, total, writer)
+        else:
+            results = self._iter_sequential(chunks, total, writer)
+        return self._write_results(results, total, writer, started)
+
+    def run_batch_results(self, batch_results, on_direct=None):
+        """Write the document from the results of an offline batch (see batch_requests())
+
+        Args:
+            batch_results: Dict mapping chunk indices to their batch result, see _iter_batch()
+            on_direct: Called with (index, response, info) for chunks requested directly
+        """
+        started = time.monotonic()
+        self._log(f"Assembling document {self.noun} of '{self.input_path}' from batch results...")
+        writer = self._open_writer()
+        chunks = self._load_chunks()
+        total = len(chunks) if hasattr(chunks, '__len__') else '?'
+        return self._write_results(self._iter_batch(chunks, total, batch_results, on_direct), total, writer, started)
+
+    def _write_results(self, results, total, writer, started):
+        """Write results in chunk order, report on the run and return its summary"""
+        summary = {
+            "input_path": self.input_path,
+            "output_path": self.output_path,
+            "chunks": 0,
+            "failed_chunks": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "protected_blocks": 0,
+            "protected_chars": 0,
+            "failed_requests": 0,
+            "invalid_chunks": 0,
+            "revalidations": 0,
+            "clean_chunks": 0,
+            "clean_tokens": 0,
+        }
+
+        # Results arrive in chunk order regardless of the scheduling mode
+        for i, chunk, response, stream_writer, info in results:
+            summary["chunks"] += 1
+
+            summary["revalidations"] += info.get("revalidations", 0)
+            problems = info.get("validation")
+            if response is None:
+                # No request succeeded: keep the source text so that the document stays whole
+                self._log(f"Chunk {i} could not be {self.action_done} ({'; '.join(problems)}); "
+                          f"keeping the source text")
+                summary["failed_requests"] += 1
+                response = str(chunk)
+                if stream_writer is not None:
+                    stream_writer.discard()
+            elif problems:
+                self._log(f"WARNING: chunk {i} still fails validation ({'; '.join(problems)}); keeping it anyway")
+                summary["invalid_chunks"] += 1
+
+            chunk_tokens = None
+            if isinstance(chunk, ProtectedBlock) and chunk.kind == "clean":
+                # Nothing to repair: the tokens it would have cost are what pre-cleaning saved
+                summary["clean_chunks"] += 1
+                summary["clean_tokens"] += self.llm_client._count_tokens(chunk)
+            elif isinstance(chunk, ProtectedBlock):
+                # Never sent, so neither context for later chunks nor part of the token estimate
+                summary["protected_blocks"] += 1
+                summary["protected_chars"] += len(chunk)
+            elif problems:
+                # A bad result is not passed on as context; its source still counts as sent
+                chunk_tokens = self.llm_client._count_tokens(chunk)
+                summary["input_tokens"] += chunk_tokens
+            else:
+                # Add response to context for next iteration
+                self.context_manager.add_response(response)
+                self.context_manager.add_user_message(chunk)
+                # Terms the result introduces are sent with the later chunks that use them
+                if self.glossary is not None:
+                    self.glossary.learn(chunk, response)
+
+                # Local token estimate for the run summary
+                chunk_tokens = self.llm_client._count_tokens(chunk)
+                summary["input_tokens"] += chunk_tokens
+                summary["output_tokens"] += self.llm_client._count_tokens(response)
+
+            # A chunk is written whole or not at all, so a failed write is not retried
+            try:
+                writer.write_chunk(i, response, stream_writer)
+                written = True
+            except OSError as e:
+                self._log(f"Failed to write chunk {i}: {e}. Skipping this chunk.")
+                written = False
+
+            # The next stage gets the result even if it could not be saved here
+            if self.on_chunk is not None:
+                self.on_chunk(i, response)
+
+            self._record_chunk(i, chunk, chunk_tokens, response, info, written)
+
+            if not written:
+                summary["failed_chunks"] += 1
+                continue
+
+            if problems:
+                continue
+            if isinstance(chunk, ProtectedBlock):
+                self._log(f"✓ Chunk {i}/{total} kept without a request ({chunk.kind})")
+            else:
+                self._log(f"✓ Chunk {i}/{total} {self.action_done} successfully")
+
+        # The output is assembled and synced to disk once, after the last chunk
+        writer.finish()
+
+        summary["pre_clean_fixes"] = dict(self.pre_cleaner.stats) if self.pre_cleaner is not None else None
+        if self.pre_cleaner is not None:
+            fixes = summary["pre_clean_fixes"]
+            self._log(f"Pre-cleaning: {fixes['headers']} headers/footers removed, {fixes['hyphens']} hyphenations "
+                      f"joined, {fixes['headings']} heading levels and {fixes['line_numbers']} code line numbers "
+                      f"fixed; {summary['clean_chunks']} of {summary['chunks']} chunks needed no request "
+                      f"(~{summary['clean_tokens']} input tokens and as many output tokens saved)")
+
+        # A shared client is reported and closed by its owner
+        if self.owns_llm_client:
+            stats = self.llm_client.pool_stats()
+            self.llm_client.close()
+            print(f"Connection pool: {stats['hits']} reused, {stats['misses']} opened, "
+                  f"{stats['reconnects']} reconnects (~{stats['estimated_time_saved']:.2f}s of handshakes saved)")
+            if len(self.llm_client.endpoints) > 1:
+                for stats in self.llm_client.endpoint_stats():
+                    print(format_endpoint_stats(stats))
+            stats = self.llm_client.scheduler.stats()
+            print(f"Rate limiting: {stats['throttled']} throttled responses, {stats['wait_time']:.1f}s waiting, "
+                  f"final concurrency limit {stats['concurrency_limit']}")
+            if self.response_cache is not None:
+                self.response_cache.flush()
+                stats = self.response_cache.stats()
+                print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                      f"{stats['entries']} entries ({stats['bytes'] / 1024:.0f} KiB)")
+            if self.llm_client.dedup_cache is not None:
+                print(format_dedup_stats(self.llm_client.dedup_cache.stats()))
+                self.llm_client.dedup_cache.close()
+
+        # A shared glossary is reported and saved by its owner
+        summary["glossary"] = self.glossary.stats() if self.owns_glossary else None
+        if self.owns_glossary:
+            self._log(format_glossary_stats(summary["glossary"]))
+            if self.glossary.path is not None:
+                self.glossary.save()
+                self._log(f"Glossary saved: {self.glossary.path}")
+
+        summary["metrics"] = self.metrics.summary(document=self.metrics_document)
+        self._log(f"Metrics: {format_summary(summary['metrics'])}")
+        if self.owns_metrics:
+            self.metrics.close()
+        if self.owns_autotuner:
+            # Already saved if it was closed with the metrics; saving again is a no-op
+            self.autotuner.save()
+            self._log(f"Autotune profile updated: {self.autotuner.path}")
+
+        self._log(f"{self.noun.capitalize()} complete. Output saved to {self.output_path}")
+        self._log(writer.describe())
+
+        summary["wall_time"] = time.monotonic() - started
+        return summary
@@ -0,0 +1,91 @@
+def add_client_arguments(parser):
+    """Add the request/caching options shared by every entry point"""
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of chunks to keep in flight at once (default: 1, sequential)")
+    parser.add_argument("--pool-size", type=int, default=4, help="Maximum number of idle keep-alive connections to reuse")
+    parser.add_argument("--pool-idle-timeout", type=float, default=60, help="Seconds before an idle pooled connection is dropped")
+    parser.add_argument("--stream", action="store_true", help="Stream responses and write tokens to disk as they arrive")
+    parser.add_argument("--resume", action="store_true", help="Reuse cached responses and only send chunks that changed")
+    parser.add_argument("--cache-dir", default=None, help="Response cache directory (default: '.cache' next to the output file)")
+    parser.add_argument("--cache-max-mb", type=float, default=512, help="Evict least recently used responses beyond this size")
+    parser.add_argument("--no-cache", action="store_true", help="Do not store responses in the cache")
+    parser.add_argument("--chunk-words", type=int, default=1500, help="Words per chunk when splitting by word count")
+    parser.add_argument("--chunk-tokens", type=int, default=None, help="Split by real token count with this many tokens per chunk instead of words")
+    parser.add_argument("--max-completion-tokens", type=int, default=None, help="max_tokens asked for each response (default: 8192)")
+    parser.add_argument("--autotune", default=None, help="JSON profile learning latency, output/input ratio and truncations per model and endpoint; once it has enough data it picks the chunk size (overriding --chunk-words/--chunk-tokens) and max_tokens")
+    parser.add_argument("--markdown-chunks", action="store_true", help="Split on Markdown blocks without cutting code blocks, tables or display math")
+    parser.add_argument("--rpm", type=int, default=None, help="Client-side limit on requests per minute")
+    parser.add_argument("--tpm", type=int, default=None, help="Client-side limit on tokens per minute (prompt plus max completion)")
+    parser.add_argument("--max-backoff", type=float, default=60, help="Upper bound in seconds for the delay between retries")
+    parser.add_argument("--context-policy", default="latest", choices=["latest", "window", "source", "summary", "glossary"],
+                        help="Context sent with each chunk in sequential mode: the latest pair (default), as many recent messages as fit, "
+                             "the previous source chunk only, recent messages plus a summary of earlier ones, "
+                             "or, for translation, only the glossary entries of the terms in the chunk (learnt in memory; see --glossary)")
+    parser.add_argument("--glossary", default=None, help="Translation: JSON glossary of term translations learnt from finished chunks and kept across papers; each chunk is sent with the entries of the terms it contains instead of the previous chunk and its translation, in sequential and concurrent mode alike")
+    parser.add_argument("--prefix-cache", action="store_true", help="Lay out requests so that consecutive ones share a prefix for provider prompt caching")
+    parser.add_argument("--cache-hint", default=None, choices=["openai", "anthropic"], help="Also send the provider's prompt caching hint for the system prompt")
+    parser.add_argument("--dedup-cache", default=None, help="SQLite file caching results of chunks that repeat across documents and runs (boilerplate), regardless of context")
+    parser.add_argument("--endpoints", default=None, help="JSON file listing weighted endpoints (base_url, api_key, model, weight) to balance and fail over between")
+    parser.add_argument("--hedge-percentile", type=float, default=None, help="Also send a request to a second endpoint once it is slower than this latency percentile of its endpoint, e.g. 0.95")
+    parser.add_argument("--stream-input", action="store_true", help="Read and split the input lazily (automatic for inputs of 8 MiB or more)")
+    parser.add_argument("--no-protect-blocks", action="store_true", help="Send reference lists, code, display math and bare links to the LLM like any other text")
+    parser.add_argument("--pre-clean", action="store_true", help="Formatting: fix page headers, hyphenation, heading levels and code line numbers locally first, and keep chunks left without problems as they are instead of sending them to the LLM")
+    parser.add_argument("--no-validate", action="store_true", help="Do not check responses for errors, size, unbalanced fences or $$, leaked prompt tags and wrong language")
+    parser.add_argument("--fallback-model", default=None, help="Model used when a chunk is requested again after failing validation (default: the same model)")
+    parser.add_argument("--revalidate-attempts", type=int, default=1, help="How many times a chunk failing validation is requested again")
+    parser.add_argument("--buffer-output", action="store_true", help="Keep results in memory and write the output once, without chunk files (for small documents)")
+    parser.add_argument("--metrics-log", default=None, help="Append per-chunk timing and token usage events to this JSON Lines file")
+    parser.add_argument("--metrics-sink", default=None, help="Also send metrics events to a sink created by 'package.module:factory'")
+
+def client_options(args):
+    """Return the keyword arguments for ChunkedDocument built from add_client_arguments() options"""
+    return {
+        "concurrency": args.concurrency,
+        "pool_size": args.pool_size,
+        "pool_idle_timeout": args.pool_idle_timeout,
+        "stream": args.stream,
+        "resume": args.resume,
+        "cache_dir": args.cache_dir,
+        "cache_max_mb": args.cache_max_mb,
+        "use_cache": not args.no_cache,
+        "chunk_words": args.chunk_words,
+        "chunk_tokens": args.chunk_tokens,
+        "max_completion_tokens": args.max_completion_tokens,
+        "autotune": args.autotune,
+        "markdown_chunks": args.markdown_chunks,
+        "requests_per_minute": args.rpm,
+        "tokens_per_minute": args.tpm,
+        "max_backoff": args.max_backoff,
+        "context_policy": args.context_policy,
+        "glossary": args.glossary,
+        "prefix_cache": args.prefix_cache,
+        "cache_hint": args.cache_hint,
+        "dedup_cache": args.dedup_cache,
+        "endpoints": args.endpoints,
+        "hedge_percentile": args.hedge_percentile,
+        "stream_input": True if args.stream_input else None,
+        "buffer_output": args.buffer_output,
+        "protect_blocks": not args.no_protect_blocks,
+        "pre_clean": args.pre_clean,
+        "validate_responses": not args.no_validate,
+        "fallback_model": args.fallback_model,
+        "revalidate_attempts": args.revalidate_attempts,
+        "metrics_log": args.metrics_log,
+        "metrics_sink": args.metrics_sink,
+    }
+
+def add_offline_arguments(parser):
+    """Add the options of the offline batch-job mode (see OfflineBatchRunner)"""
+    parser.add_argument("--offline", action="store_true", help="Submit every chunk to the provider's batch API and poll until the batch is done, instead of sending chunks one by one (cheaper, results within the completion window)")
+    parser.add_argument("--batch-dir", default=None, help="Offline mode: folder for request files, batch state and results (default: '.batch_job' in the input folder)")
+    parser.add_argument("--poll-interval", type=float, default=60, help="Offline mode: seconds between two batch status checks")
+    parser.add_argument("--completion-window", default="24h", help="Offline mode: completion window asked of the provider")
+    parser.add_argument("--max-batch-requests", type=int, default=50000, help="Offline mode: most requests in one batch job")
+
+def offline_options(args):
+    """Return the keyword arguments for OfflineBatchRunner built from add_offline_arguments() options"""
+    return {
+        "work_dir": args.batch_dir,
+        "poll_interval": args.poll_interval,
+        "completion_window": args.completion_window,
+        "max_batch_requests": args.max_batch_requests,
+    }
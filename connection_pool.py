@@ -0,0 +1,126 @@
+import http.client
+import threading
+import time
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to a single host, shared across requests and threads.
+
+    Idle connections are reused last-in-first-out and dropped once they have
+    been idle for longer than `idle_timeout` seconds. At most `max_size` idle
+    connections are kept; extra connections opened under heavy concurrency are
+    closed when released instead of being pooled.
+    """
+
+    # Errors that mean a pooled connection was closed by the server while idle
+    STALE_CONNECTION_ERRORS = (ConnectionError, http.client.BadStatusLine, http.client.CannotSendRequest)
+
+    def __init__(self, hostname, port, scheme='https', max_size=4, idle_timeout=60, timeout=None):
+        self.hostname = hostname
+        self.port = port
+        self.scheme = scheme
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.expired = 0
+        self.connect_time = 0.0
+
+    def _new_connection(self):
+        """Open a new connection and record how long the handshake took"""
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.hostname, self.port, timeout=self.timeout)
+
+        start = time.monotonic()
+        conn.connect()
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.connect_time += elapsed
+        return conn
+
+    def acquire(self):
+        """Return (connection, reused) with a pooled connection if one is still fresh"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.hits += 1
+                    return conn, True
+                self.expired += 1
+                conn.close()
+            self.misses += 1
+        return self._new_connection(), False
+
+    def release(self, conn):
+        """Return a connection whose response has been fully read to the pool"""
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """Close a connection that must not be reused"""
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and return (connection, response)
+
+        If a reused connection turns out to have been closed by the server,
+        the request is sent once more on a fresh connection. The caller must
+        read the response and then release() or discard() the connection.
+        """
+        headers = headers or {}
+        conn, reused = self.acquire()
+        try:
+            conn.request(method, path, body, headers)
+            return conn, conn.getresponse()
+        except self.STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        with self._lock:
+            self.reconnects += 1
+        conn = self._new_connection()
+        try:
+            conn.request(method, path, body, headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """Return pool counters and an estimate of the handshake time saved by reuse"""
+        with self._lock:
+            opened = self.misses + self.reconnects
+            avg_connect_time = self.connect_time / opened if opened else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reconnects": self.reconnects,
+                "expired": self.expired,
+                "idle": len(self._idle),
+                "connect_time": self.connect_time,
+                "avg_connect_time": avg_connect_time,
+                "estimated_time_saved": self.hits * avg_connect_time,
+            }
@@ -1,115 +1,278 @@
-import tiktoken
+import bisect
+from registry import get_tokenizer
+from text_splitter import Chunk
 
-class ContextManager:
+# Tokens the API adds around every message for its role and delimiters
+MESSAGE_TOKEN_OVERHEAD = 4
+
+class _FenwickTree:
+    """Growable binary indexed tree over per-position token counts"""
     def __init__(self):
+        self.values = []
+        self.tree = [0]
+
+    def _grow(self, size):
+        capacity = len(self.tree) - 1
+        while capacity < size:
+            capacity = max(1, capacity * 2)
+        self.values.extend([0] * (capacity - len(self.values)))
+        # Rebuild in O(n); amortized over the doublings this stays linear
+        self.tree = [0] + list(self.values)
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, position, value):
+        if position >= len(self.tree) - 1:
+            self._grow(position + 1)
+        delta = value - self.values[position]
+        self.values[position] = value
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        return self.prefix(len(self.tree) - 1)
+
+    def prefix(self, end):
+        """Sum of positions [0, end)"""
+        result = 0
+        while end > 0:
+            result += self.tree[end]
+            end -= end & -end
+        return result
+
+    def lower_bound(self, target):
+        """Smallest end such that prefix(end) >= target"""
+        if target <= 0:
+            return 0
+        position = 0
+        remaining = target
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(self.tree) and self.tree[nxt] < remaining:
+                position = nxt
+                remaining -= self.tree[nxt]
+            step >>= 1
+        return position + 1
+
+class ContextManager:
+    # Dropped messages are only removed from memory once this many have piled up
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, max_messages=None):
+        """
+        Args:
+            max_messages: Keep only the most recent max_messages conversation
+                pairs, user message i and assistant message i being one pair
+                (None keeps the whole history). Older messages are dropped, so
+                memory stays flat however long the document is.
+        """
         self.assistant_messages = []
         self.user_previous_messages = []
-        self.tokenizer = tiktoken.encoding_for_model("gpt-4o")
-        
+        self.max_messages = max_messages
+
+        # Messages added per role so far, and the pair index of the first stored
+        # message. start is the list index of the oldest retained pair; messages
+        # before it are dropped and freed in batches by _compact().
+        self.user_count = 0
+        self.assistant_count = 0
+        self.offset = 0
+        self.start = 0
+
+        # Token counts are computed once per message when it is added. Prefix sums
+        # (prefix[i] = tokens of the first i messages) let a budgeted window be
+        # found by binary search instead of re-tokenizing the history every call.
+        self.assistant_token_prefix = [0]
+        self.user_token_prefix = [0]
+
+        # The combined timeline interleaves user message i (position 2i) with
+        # assistant message i (position 2i + 1); missing messages count as zero.
+        self.combined_tokens = _FenwickTree()
+
     def add_response(self, response):
-        self.assistant_messages.append({
-            "role": "assistant", 
+        message = {
+            "role": "assistant",
             "content": response
-        })
-        
+        }
+        self.assistant_count += 1
+        if self.assistant_count <= self.offset:
+            # The user message of this pair has already been dropped
+            return
+        tokens = self._remember_tokens(message)
+        self.combined_tokens.set(2 * len(self.assistant_messages) + 1, tokens)
+        self.assistant_messages.append(message)
+        self.assistant_token_prefix.append(self.assistant_token_prefix[-1] + tokens)
+        self._enforce_retention()
+
     def add_user_message(self, message):
-        self.user_previous_messages.append({
-            "role": "user", 
+        message = {
+            "role": "user",
             "content": message
-        })
-        
+        }
+        self.user_count += 1
+        if self.user_count <= self.offset:
+            # The assistant message of this pair has already been dropped
+            return
+        tokens = self._remember_tokens(message)
+        self.combined_tokens.set(2 * len(self.user_previous_messages), tokens)
+        self.user_previous_messages.append(message)
+        self.user_token_prefix.append(self.user_token_prefix[-1] + tokens)
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        """Drop the messages that fall outside max_messages"""
+        if self.max_messages is None:
+            return
+        newest = max(self.user_count, self.assistant_count)
+        self.start = max(self.start, newest - self.max_messages - self.offset)
+        if self.start >= max(self.COMPACT_THRESHOLD, self.max_messages):
+            self._compact()
+
+    def _compact(self):
+        """Free the dropped messages and rebase the token sums on the retained ones"""
+        start = self.start
+        user_base = self.user_token_prefix[min(start, len(self.user_previous_messages))]
+        assistant_base = self.assistant_token_prefix[min(start, len(self.assistant_messages))]
+        del self.user_previous_messages[:start]
+        del self.assistant_messages[:start]
+        self.user_token_prefix = [0] + [p - user_base for p in self.user_token_prefix[start + 1:]]
+        self.assistant_token_prefix = [0] + [p - assistant_base for p in self.assistant_token_prefix[start + 1:]]
+
+        # Both roles shift by the same amount, so user/assistant pairs stay aligned
+        self.combined_tokens = _FenwickTree()
+        for i in range(len(self.user_previous_messages)):
+            self.combined_tokens.set(2 * i, self.user_token_prefix[i + 1] - self.user_token_prefix[i])
+        for i in range(len(self.assistant_messages)):
+            self.combined_tokens.set(2 * i + 1, self.assistant_token_prefix[i + 1] - self.assistant_token_prefix[i])
+        self.offset += start
+        self.start = 0
+
+    @property
+    def tokenizer(self):
+        # Shared by every ContextManager; chunks with a token_count never need it
+        return get_tokenizer()
+
     def get_assistant_messages(self):
-        return self.assistant_messages
-    
+        return self.assistant_messages[self.start:] if self.start else self.assistant_messages
+
     def get_user_previous_messages(self):
-        return self.user_previous_messages
-    
+        return self.user_previous_messages[self.start:] if self.start else self.user_previous_messages
+
     def _count_tokens(self, message):
-        """Count the number of tokens in a message"""
-        return len(self.tokenizer.encode(str(message)))
-    
+        """Count the tokens a message is billed for
+
+        Only the content is encoded (plus a fixed per-message overhead), and
+        chunks that already carry a token_count from the splitter are not
+        encoded again.
+        """
+        content = message["content"]
+        token_count = getattr(content, "token_count", None)
+        if token_count is None:
+            token_count = len(self.tokenizer.encode(content, disallowed_special=()))
+        return token_count + MESSAGE_TOKEN_OVERHEAD
+
+    def _remember_tokens(self, message):
+        """Count a new message once and keep the count with its content for later reuse"""
+        tokens = self._count_tokens(message)
+        if getattr(message["content"], "token_count", None) is None:
+            message["content"] = Chunk(message["content"], tokens - MESSAGE_TOKEN_OVERHEAD)
+        return tokens
+
+    def _limited_suffix(self, messages, prefix, max_tokens):
+        """Return the longest run of newest messages that fits in max_tokens"""
+        total = prefix[-1]
+        start = bisect.bisect_left(prefix, total - max_tokens, lo=min(self.start, len(messages)))
+        return messages[start:], total - prefix[start]
+
     def get_limited_user_messages(self, max_tokens):
         """Return the most recent user messages up to max_tokens"""
-        messages = []
-        token_count = 0
-        
-        # Process from newest to oldest
-        for i in range(len(self.user_previous_messages) - 1, -1, -1):
-            msg = self.user_previous_messages[i]
-            msg_tokens = self._count_tokens(msg)
-            
-            if token_count + msg_tokens <= max_tokens:
-                messages.insert(0, msg)  # Insert at beginning to maintain chronological order
-                token_count += msg_tokens
-            else:
-                break
-                
-        return messages, token_count
-    
+        return self._limited_suffix(self.user_previous_messages, self.user_token_prefix, max_tokens)
+
     def get_limited_assistant_messages(self, max_tokens):
         """Return the most recent assistant messages up to max_tokens"""
-        messages = []
-        token_count = 0
-        
-        # Process from newest to oldest
-        for i in range(len(self.assistant_messages) - 1, -1, -1):
-            msg = self.assistant_messages[i]
-            msg_tokens = self._count_tokens(msg)
-            
-            if token_count + msg_tokens <= max_tokens:
-                messages.insert(0, msg)  # Insert at beginning to maintain chronological order
-                token_count += msg_tokens
-            else:
-                break
-                
-        return messages, token_count
-    
+        return self._limited_suffix(self.assistant_messages, self.assistant_token_prefix, max_tokens)
+
     def get_limited_combined_messages(self, max_tokens):
         """Return the most recent combined user and assistant messages up to max_tokens"""
+        total = self.combined_tokens.total()
+        start = max(self.combined_tokens.lower_bound(total - max_tokens), 2 * self.start)
+        token_count = total - self.combined_tokens.prefix(start)
+
+        # Walk the selected positions in chronological order
+        messages = []
+        end = 2 * max(len(self.user_previous_messages), len(self.assistant_messages))
+        for position in range(start, end):
+            index, is_assistant = divmod(position, 2)
+            source = self.assistant_messages if is_assistant else self.user_previous_messages
+            if index < len(source):
+                messages.append(source[index])
+
+        return messages, token_count
+
+    def pair_count(self):
+        """Number of conversation pairs added so far, dropped ones included"""
+        return max(self.user_count, self.assistant_count)
+
+    def _role_history(self, role):
+        if role == "user":
+            return self.user_previous_messages, self.user_token_prefix
+        return self.assistant_messages, self.assistant_token_prefix
+
+    def window_start(self, max_tokens, role="combined"):
+        """Return the pair index of the oldest whole pair that fits in max_tokens with everything after it
+
+        Args:
+            max_tokens: Token budget of the window
+            role: "combined", "user" or "assistant"
+        """
+        if role == "combined":
+            total = self.combined_tokens.total()
+            position = max(self.combined_tokens.lower_bound(total - max_tokens), 2 * self.start)
+            # A window starting at an assistant message begins at the next whole pair instead
+            return self.offset + (position + 1) // 2
+        messages, prefix = self._role_history(role)
+        start = bisect.bisect_left(prefix, prefix[-1] - max_tokens, lo=min(self.start, len(messages)))
+        return self.offset + start
+
+    def get_messages_since(self, pair_index, role="combined"):
+        """Return the retained messages of pair pair_index and later, with their token count
+
+        Unlike get_limited_*_messages the start of the window is fixed, so
+        successive calls return a growing list with the same beginning.
+        """
+        first = max(pair_index - self.offset, self.start)
+        if role != "combined":
+            messages, prefix = self._role_history(role)
+            first = min(first, len(messages))
+            return messages[first:], prefix[-1] - prefix[first]
+
+        end = 2 * max(len(self.user_previous_messages), len(self.assistant_messages))
+        position = min(2 * first, end)
+        capacity = len(self.combined_tokens.tree) - 1
+        token_count = self.combined_tokens.total() - self.combined_tokens.prefix(min(position, capacity))
         messages = []
-        token_count = 0
-        
-        # Create a timeline of messages in chronological order
-        timeline = []
-        user_index = 0
-        assistant_index = 0
-        
-        # Assuming user_previous_messages and assistant_messages are in chronological order
-        # and generally alternate (user then assistant)
-        while user_index < len(self.user_previous_messages) or assistant_index < len(self.assistant_messages):
-            if user_index < len(self.user_previous_messages):
-                timeline.append(("user", user_index))
-                user_index += 1
-                
-            if assistant_index < len(self.assistant_messages):
-                timeline.append(("assistant", assistant_index))
-                assistant_index += 1
-        
-        # Process from newest to oldest
-        for i in range(len(timeline) - 1, -1, -1):
-            msg_type, idx = timeline[i]
-            
-            if msg_type == "user":
-                msg = self.user_previous_messages[idx]
-            else:
-                msg = self.assistant_messages[idx]
-                
-            msg_tokens = self._count_tokens(msg)
-            
-            if token_count + msg_tokens <= max_tokens:
-                messages.insert(0, msg)  # Insert at beginning to maintain chronological order
-                token_count += msg_tokens
-            else:
-                break
-                
+        for position in range(position, end):
+            index, is_assistant = divmod(position, 2)
+            source = self.assistant_messages if is_assistant else self.user_previous_messages
+            if index < len(source):
+                messages.append(source[index])
         return messages, token_count
-    
+
     def get_latest_conversation_pair(self):
         latest_message = []
-        if self.user_previous_messages:
+        if len(self.user_previous_messages) > self.start:
             latest_message.append(self.user_previous_messages[-1])
-        if self.assistant_messages:
+        if len(self.assistant_messages) > self.start:
             latest_message.append(self.assistant_messages[-1])
         return latest_message
 
-
+    def get_latest_conversation_pair_tokens(self):
+        """Return the token count of get_latest_conversation_pair() from the stored counts"""
+        return ((self.user_token_prefix[-1] - self.user_token_prefix[-2]
+                 if len(self.user_previous_messages) > self.start else 0) +
+                (self.assistant_token_prefix[-1] - self.assistant_token_prefix[-2]
+                 if len(self.assistant_messages) > self.start else 0))
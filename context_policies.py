@@ -0,0 +1,273 @@
+import re
+from context_manager import MESSAGE_TOKEN_OVERHEAD
+from glossary import Glossary
+from registry import get_tokenizer
+from text_splitter import Chunk
+
+# A trimmed message shorter than this is not worth sending
+MIN_TRIMMED_TOKENS = 32
+
+def message_tokens(message):
+    """Tokens of a message dict, reusing the count carried by its content when there is one"""
+    content = message["content"]
+    token_count = getattr(content, "token_count", None)
+    if token_count is None:
+        token_count = len(get_tokenizer().encode(content, disallowed_special=()))
+    return token_count + MESSAGE_TOKEN_OVERHEAD
+
+def trim_message(message, max_tokens):
+    """Keep the end of a message so that it fits in max_tokens, or return None
+
+    The end is kept because it is the text right before the current chunk.
+    """
+    content_budget = max_tokens - MESSAGE_TOKEN_OVERHEAD
+    if content_budget < MIN_TRIMMED_TOKENS:
+        return None
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(message["content"], disallowed_special=())[-content_budget:]
+    data = b''.join(tokenizer.decode_tokens_bytes(tokens))
+    # Drop the continuation bytes of a character cut at the start
+    data = data.lstrip(bytes(range(0x80, 0xc0)))
+    return {"role": message["role"], "content": Chunk(data.decode('utf-8', errors='replace'), len(tokens))}
+
+def fit_newest(messages, max_tokens):
+    """Return the newest messages that fit in max_tokens, and their token count
+
+    Whole messages are taken from the newest backwards; the first one that
+    does not fit is trimmed to the remaining budget instead of being sent
+    whole, and everything older is left out.
+    """
+    selected = []
+    total = 0
+    for message in reversed(messages):
+        tokens = message_tokens(message)
+        if total + tokens > max_tokens:
+            trimmed = trim_message(message, max_tokens - total)
+            if trimmed is not None:
+                selected.append(trimmed)
+                total += message_tokens(trimmed)
+            break
+        selected.append(message)
+        total += tokens
+    selected.reverse()
+    return selected, total
+
+class ContextPolicy:
+    """Chooses the history messages sent between the system prompt and the current message.
+
+    select() must return (messages, tokens) with tokens <= budget;
+    LLMClient.process() trims the result if a policy returns more.
+    current_message is the text of the message the context is sent with.
+    history_messages is how many conversation pairs the ContextManager
+    needs to keep for this policy (None for the whole history).
+    """
+    description = "context"
+    history_messages = None
+
+    def select(self, context_manager, budget, current_message=None):
+        raise NotImplementedError
+
+class LatestPairPolicy(ContextPolicy):
+    """The previous source chunk and its result, trimmed when they exceed the budget"""
+    description = "latest conversation context"
+    history_messages = 1
+
+    def select(self, context_manager, budget, current_message=None):
+        messages = context_manager.get_latest_conversation_pair()
+        tokens = context_manager.get_latest_conversation_pair_tokens()
+        if tokens <= budget:
+            return messages, tokens
+        return fit_newest(messages, budget)
+
+class BudgetedWindowPolicy(ContextPolicy):
+    """As many of the most recent whole messages as fit in the budget
+
+    With anchored=True the window keeps its first message and only grows
+    until it no longer fits; it then restarts at ANCHOR_FILL of the budget.
+    Consecutive requests thus share the same prefix (system prompt plus the
+    start of the window), which providers with prompt caching bill and serve
+    faster. An anchored policy keeps state, so use one instance per document.
+    
+    Args:
+        role: "combined" for user and assistant messages, or "user" / "assistant" only
+        history_messages: Conversation pairs to keep available for the window
+        anchored: Keep the start of the window stable between requests
+    """
+    ANCHOR_FILL = 0.5
+
+    def __init__(self, role="combined", history_messages=64, anchored=False):
+        if role not in ("combined", "user", "assistant"):
+            raise ValueError(f"Unknown context role '{role}'")
+        self.role = role
+        self.history_messages = history_messages
+        self.anchored = anchored
+        self._anchor = None
+        self.description = {
+            "combined": "combined user and assistant context",
+            "user": "user context",
+            "assistant": "assistant context",
+        }[role]
+
+    def select(self, context_manager, budget, current_message=None):
+        if self.anchored:
+            return self._select_anchored(context_manager, budget)
+        if self.role == "user":
+            return context_manager.get_limited_user_messages(budget)
+        if self.role == "assistant":
+            return context_manager.get_limited_assistant_messages(budget)
+        return context_manager.get_limited_combined_messages(budget)
+
+    def _select_anchored(self, context_manager, budget):
+        if self._anchor is not None:
+            messages, tokens = context_manager.get_messages_since(self._anchor, self.role)
+            if tokens <= budget:
+                return messages, tokens
+        # Restart with room to grow for the next few requests
+        self._anchor = context_manager.window_start(int(budget * self.ANCHOR_FILL), self.role)
+        return context_manager.get_messages_since(self._anchor, self.role)
+
+class SourceOnlyPolicy(ContextPolicy):
+    """Only the latest source chunk(s), never a result that may still be in flight"""
+    description = "source context"
+
+    def __init__(self, max_messages=1):
+        self.max_messages = max_messages
+        self.history_messages = max_messages
+
+    def select(self, context_manager, budget, current_message=None):
+        return fit_newest(context_manager.get_user_previous_messages()[-self.max_messages:], budget)
+
+def outline(text, max_sentence_chars=200):
+    """Extractive summary: headings and the first sentence of every prose paragraph"""
+    lines = []
+    for paragraph in text.split('\n\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if paragraph.startswith('#'):
+            lines.append(paragraph.splitlines()[0])
+            continue
+        if paragraph.startswith(('```', '~~~', '$$', '|')):
+            # Code, display math and tables say little about the document's thread
+            continue
+        first = re.split(r'(?<=[.!?。！？])\s', paragraph, maxsplit=1)[0]
+        lines.append('- ' + ' '.join(first.split())[:max_sentence_chars])
+    return '\n'.join(lines)
+
+class SummaryCompressedPolicy(ContextPolicy):
+    """Recent messages in full, plus a compressed summary of the source before them
+
+    Args:
+        summary_share: Share of the budget reserved for the summary when the
+            history does not fit whole
+        summarizer: Callable turning a source text into a short summary
+            (default: outline(), which needs no extra request)
+        history_messages: Conversation pairs to keep available for summarizing
+    """
+    description = "summary-compressed context"
+    SUMMARY_HEADER = "Summary of the earlier parts of the document:\n\n"
+
+    def __init__(self, summary_share=0.25, summarizer=None, history_messages=64):
+        self.summary_share = summary_share
+        self.summarizer = summarizer or outline
+        self.history_messages = history_messages
+        # Summaries by source text; history is bounded, so this stays small
+        self._summaries = {}
+
+    def _summary_of(self, text):
+        summary = self._summaries.get(text)
+        if summary is None:
+            if len(self._summaries) >= 4 * (self.history_messages or 64):
+                self._summaries.clear()
+            summary = self.summarizer(text)
+            self._summaries[text] = summary
+        return summary
+
+    def select(self, context_manager, budget, current_message=None):
+        everything, total = context_manager.get_limited_combined_messages(budget)
+        history = context_manager.get_limited_combined_messages(float('inf'))[0]
+        if len(everything) == len(history):
+            return everything, total
+
+        summary_budget = int(budget * self.summary_share)
+        recent, recent_tokens = context_manager.get_limited_combined_messages(budget - summary_budget)
+        older = history[:len(history) - len(recent)]
+        parts = [self._summary_of(m["content"]) for m in older if m["role"] == "user"]
+        text = '\n'.join(part for part in parts if part)
+        if not text:
+            return recent, recent_tokens
+
+        # The newest part of the outline is kept if it has to be cut; the header is always kept
+        available = budget - recent_tokens
+        header_tokens = len(get_tokenizer().encode(self.SUMMARY_HEADER, disallowed_special=()))
+        fitted, _ = fit_newest([{"role": "user", "content": text}], available - header_tokens)
+        if not fitted:
+            return recent, recent_tokens
+        summary = {"role": "user", "content": self.SUMMARY_HEADER + fitted[0]["content"]}
+        summary_tokens = message_tokens(summary)
+        if summary_tokens > available:
+            return recent, recent_tokens
+        return [summary] + recent, summary_tokens + recent_tokens
+
+class GlossaryPolicy(ContextPolicy):
+    """The glossary entries whose terms appear in the current message, and nothing else
+
+    Only what keeps the terminology consistent is sent, instead of the
+    previous chunk and its translation, so prompts stay small and no
+    request waits for the result of another. The glossary only learns
+    from written results, though: with chunks in flight concurrently, a
+    chunk misses the terms of those still in flight when it is sent.
+
+    PROMPT_SECTION is appended to the system prompt of documents using
+    the policy, so that results name their terms and follow the glossary.
+
+    Args:
+        glossary: Glossary shared by the documents using it (default: a new one kept in memory)
+    """
+    description = "glossary context"
+    history_messages = 0
+    GLOSSARY_HEADER = "Glossary (translate these terms this way):\n\n"
+    PROMPT_SECTION = ("\n\n<glossary>\n"
+                      "- The first time a technical term appears, keep the original term in brackets after its "
+                      "translation. (e.g. 注意力机制（attention mechanism）)\n"
+                      "- If a glossary is given before the text, translate its terms as listed there. "
+                      "Never translate or return the glossary itself.\n"
+                      "</glossary>\n")
+
+    def __init__(self, glossary=None):
+        self.glossary = glossary if glossary is not None else Glossary()
+
+    def select(self, context_manager, budget, current_message=None):
+        if not current_message:
+            return [], 0
+        entries = self.glossary.lookup(current_message)
+        # The least frequent half of the entries is dropped until the list fits
+        while entries:
+            message = {"role": "user", "content": self.GLOSSARY_HEADER + '\n'.join(
+                f"- {term}: {translation}" for term, translation in entries)}
+            tokens = message_tokens(message)
+            if tokens <= budget:
+                return [message], tokens
+            entries = entries[:len(entries) // 2]
+        return [], 0
+
+CONTEXT_POLICIES = {
+    "latest": LatestPairPolicy,
+    "window": BudgetedWindowPolicy,
+    "source": SourceOnlyPolicy,
+    "summary": SummaryCompressedPolicy,
+    "glossary": GlossaryPolicy,
+}
+
+def get_policy(policy, prefix_cache=False):
+    """Return a ContextPolicy from an instance or one of the CONTEXT_POLICIES names
+
+    With prefix_cache the "window" policy keeps a stable, anchored start.
+    """
+    if isinstance(policy, ContextPolicy):
+        return policy
+    if policy not in CONTEXT_POLICIES:
+        raise ValueError(f"Unknown context policy '{policy}' (choose from {', '.join(CONTEXT_POLICIES)})")
+    if policy == "window" and prefix_cache:
+        return BudgetedWindowPolicy(anchored=True)
+    return CONTEXT_POLICIES[policy]()
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Characters OCR output scatters through otherwise identical text
+_INVISIBLE = dict.fromkeys(map(ord, '­​‌‍⁠﻿'))
+_PUNCTUATION = str.maketrans({
+    '‘': "'", '’': "'", '“': '"', '”': '"',
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '−': '-',
+})
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_chunk(text):
+    """Return text with the differences OCR introduces between copies of the same block removed
+
+    Unicode compatibility forms (ligatures, full-width characters) are
+    folded, soft hyphens and zero-width characters dropped, curly quotes
+    and dashes made plain, and every run of whitespace collapsed to one
+    space. Case and wording are kept, since they change the result.
+    """
+    text = unicodedata.normalize('NFKC', str(text)).translate(_INVISIBLE).translate(_PUNCTUATION)
+    return _WHITESPACE.sub(' ', text).strip()
+
+class DedupCache:
+    """Cross-document cache of results for chunks that repeat between papers.
+
+    Papers from the same venue share license blocks, publisher boilerplate
+    and standard appendices. Their results are stored in a SQLite file
+    keyed by the normalized chunk (see normalize_chunk()), the system
+    prompt and the model, without the surrounding context, so the same
+    block in another paper is answered without a request. The file can be
+    shared by concurrent runs and processes (SQLite's write-ahead log
+    handles the locking). Chunks shorter than `min_chars` after
+    normalization depend too much on their context and are not cached.
+
+    Args:
+        path: SQLite database file, created if missing
+        min_chars: Shortest normalized chunk worth caching
+    """
+    def __init__(self, path, min_chars=200):
+        self.path = path
+        self.min_chars = min_chars
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by every thread of this process, serialized by the lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " chars INTEGER NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped = 0
+
+    def make_key(self, model, system_prompt, chunk):
+        """Return the key for chunk, or None when it is too short to be cached"""
+        normalized = normalize_chunk(chunk)
+        if len(normalized) < self.min_chars:
+            return None
+        material = f"{model}\0{system_prompt}\0{normalized}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the stored result for key, or None"""
+        if key is None:
+            with self._lock:
+                self.skipped += 1
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT response FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET hits = hits + 1, last_used = ? WHERE key = ?",
+                             (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key):
+        """Return True if a result is stored for key, without counting a hit or a miss"""
+        if key is None:
+            return False
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key, response):
+        """Store the result of a chunk"""
+        if key is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO results (key, response, chars, created, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET response = excluded.response, chars = excluded.chars, "
+                "last_used = excluded.last_used",
+                (key, response, len(response), now, now))
+            self.stores += 1
+
+    def stats(self):
+        """Counters of this process plus the size of the shared store"""
+        with self._lock:
+            entries, total_hits = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM results").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "total_hits": total_hits,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def format_dedup_stats(stats):
+    """One line describing DedupCache.stats()"""
+    return (f"Dedup cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), "
+            f"{stats['skipped']} short chunks skipped, {stats['entries']} entries "
+            f"answered {stats['total_hits']} times in all runs")
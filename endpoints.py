@@ -0,0 +1,274 @@
+import collections
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+from connection_pool import ConnectionPool
+from metrics import percentile
+
+DEFAULT_PATH = "/v1/chat/completions"
+
+def completions_path(base_url):
+    """Return the request path for base_url
+
+    A full endpoint URL is used as given; a bare host or an API root such as
+    https://host/v1 gets /chat/completions appended (a bare host gets
+    /v1/chat/completions). The query string is kept, e.g. an api-version.
+    """
+    parsed = urlparse(base_url)
+    path = parsed.path.rstrip('/')
+    if not path:
+        path = DEFAULT_PATH
+    elif not path.endswith('/chat/completions'):
+        path += '/chat/completions'
+    if parsed.query:
+        path += '?' + parsed.query
+    return path
+
+class Endpoint:
+    """One OpenAI-compatible endpoint with its own key, model name and connection pool.
+
+    The endpoint tracks its recent latencies and a circuit breaker: after
+    `failure_threshold` failures in a row it is "open" and receives no
+    requests for `cooldown` seconds; it is then "half-open" and gets a
+    single trial request, which closes the circuit again on success or
+    reopens it for twice as long (up to `max_cooldown`) on failure.
+    A 429 with Retry-After opens the circuit for at least that long.
+
+    Args:
+        base_url: Endpoint URL; its path is honored (see completions_path())
+        api_key: API key sent to this endpoint
+        model: Model name sent to this endpoint
+        weight: Relative share of the traffic when endpoints are equally fast
+        name: Label used in status messages and stats (default: host[:port])
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    # Latencies kept for the hedging percentile and minimum before hedging
+    LATENCY_WINDOW = 200
+    MIN_HEDGE_SAMPLES = 20
+    # Weight of the newest latency in the moving average used for routing
+    EWMA_ALPHA = 0.2
+    # Statuses that say nothing about the endpoint's health (the request itself was bad)
+    CLIENT_ERRORS = (400, 413, 422)
+
+    def __init__(self, base_url, api_key, model, weight=1.0, name=None, pool_size=4, pool_idle_timeout=60,
+                 failure_threshold=5, cooldown=30, max_cooldown=300):
+        parsed_url = urlparse(base_url)
+        self.scheme = parsed_url.scheme or 'https'
+        self.hostname = parsed_url.netloc.split(':')[0]
+        self.port = parsed_url.port or (443 if self.scheme == 'https' else 80)
+        self.path = completions_path(base_url)
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        if weight <= 0:
+            raise ValueError(f"Endpoint weight must be positive, got {weight}")
+        self.weight = float(weight)
+        self.name = name or parsed_url.netloc
+
+        self.pool = ConnectionPool(self.hostname, self.port, self.scheme,
+                                   max_size=pool_size, idle_timeout=pool_idle_timeout)
+
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self.ewma_latency = None
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = cooldown
+        self._trial_in_flight = False
+
+        # Counters exposed through stats()
+        self.requests = 0
+        self.failures = 0
+        self.circuit_opens = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _update_state(self, now):
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+
+    def available(self):
+        """Whether the circuit lets a request through now"""
+        with self._lock:
+            self._update_state(time.monotonic())
+            if self.state == self.HALF_OPEN:
+                return not self._trial_in_flight
+            return self.state == self.CLOSED
+
+    def score(self):
+        """Expected wait for a new request, relative to the endpoint's weight (lower is better)"""
+        with self._lock:
+            latency = self.ewma_latency or 0.0
+            return latency * (self.in_flight + 1) / self.weight
+
+    def begin(self):
+        """Count a request as in flight; in the half-open state it is the trial request"""
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = True
+
+    def finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += self.EWMA_ALPHA * (latency - self.ewma_latency)
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self.cooldown = self.base_cooldown
+            self._trial_in_flight = False
+
+    def record_failure(self, status=None, retry_after=None):
+        """Count a failed attempt and open the circuit when the endpoint looks unhealthy"""
+        if status in self.CLIENT_ERRORS:
+            return
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            now = time.monotonic()
+            self._update_state(now)
+            if self.state == self.HALF_OPEN:
+                # The trial failed: back off for longer
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self._open(now, self.cooldown)
+            elif self.consecutive_failures >= self.failure_threshold:
+                self._open(now, self.cooldown)
+            if retry_after is not None:
+                self._open(now, retry_after)
+
+    def _open(self, now, seconds):
+        if self.state != self.OPEN:
+            self.circuit_opens += 1
+        self.state = self.OPEN
+        self.open_until = max(self.open_until, now + seconds)
+        self._trial_in_flight = False
+
+    def hedge_delay(self, fraction):
+        """Latency percentile after which a request is hedged, or None without enough samples"""
+        with self._lock:
+            if len(self.latencies) < self.MIN_HEDGE_SAMPLES:
+                return None
+            return percentile(list(self.latencies), fraction)
+
+    def record_hedge(self, won):
+        with self._lock:
+            self.hedges += 1
+            if won:
+                self.hedge_wins += 1
+
+    def stats(self):
+        with self._lock:
+            self._update_state(time.monotonic())
+            return {
+                "name": self.name,
+                "model": self.model,
+                "weight": self.weight,
+                "state": self.state,
+                "requests": self.requests,
+                "failures": self.failures,
+                "circuit_opens": self.circuit_opens,
+                "latency_ewma": self.ewma_latency,
+                "latency_p50": percentile(list(self.latencies), 0.5),
+                "latency_p95": percentile(list(self.latencies), 0.95),
+                "hedged_to": self.hedges,
+                "hedges_won": self.hedge_wins,
+            }
+
+class EndpointRouter:
+    """Pick an endpoint per attempt by measured latency, load, weight and health.
+
+    Two different endpoints with a closed (or half-open) circuit are drawn
+    at random in proportion to their weight, and the one with the lower score()
+    wins ("power of two choices"): fast endpoints get most of the traffic
+    without every request piling onto the same one, and endpoints without
+    measurements yet are tried early. When every circuit is open, the
+    endpoint that recovers first is used rather than failing the request.
+    """
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+        self.endpoints = list(endpoints)
+
+    def _healthy(self, exclude):
+        return [e for e in self.endpoints if e not in exclude and e.available()]
+
+    def choose(self, exclude=()):
+        """Return the endpoint for the next attempt, avoiding those in exclude when possible"""
+        candidates = self._healthy(exclude) or self._healthy(())
+        if not candidates:
+            return min(self.endpoints, key=lambda e: e.open_until)
+        if len(candidates) == 1:
+            return candidates[0]
+        first = random.choices(candidates, weights=[e.weight for e in candidates])[0]
+        others = [e for e in candidates if e is not first]
+        second = random.choices(others, weights=[e.weight for e in others])[0]
+        return first if first.score() <= second.score() else second
+
+    def alternative(self, endpoint):
+        """Another healthy endpoint to fail over or hedge to, or None"""
+        candidates = self._healthy((endpoint,))
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: e.score())
+
+    def pool_stats(self):
+        """Connection pool counters summed over every endpoint"""
+        per_endpoint = [e.pool.stats() for e in self.endpoints]
+        totals = {key: sum(stats[key] for stats in per_endpoint) for key in per_endpoint[0]}
+        opened = totals["misses"] + totals["reconnects"]
+        totals["avg_connect_time"] = totals["connect_time"] / opened if opened else 0.0
+        totals["estimated_time_saved"] = sum(stats["estimated_time_saved"] for stats in per_endpoint)
+        return totals
+
+    def stats(self):
+        return [e.stats() for e in self.endpoints]
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.pool.close()
+
+def load_endpoints(path):
+    """Read endpoint definitions from a JSON file
+
+    The file holds a list of objects with base_url and optionally api_key,
+    model, weight and name; LLMClient fills a missing api_key or model with
+    its own (the --api-key and --model options):
+
+        [{"base_url": "https://eu.example.com/v1", "api_key": "...", "weight": 2},
+         {"base_url": "https://us.example.com/v1/chat/completions", "model": "gpt-4o-mini"}]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a non-empty list of endpoints")
+    for entry in entries:
+        if not isinstance(entry, dict) or "base_url" not in entry:
+            raise ValueError(f"Endpoint without base_url in {path}: {entry}")
+    return entries
+
+def format_endpoint_stats(stats):
+    """One line describing an endpoint from Endpoint.stats()"""
+    latency = "n/a" if stats["latency_p50"] is None else f"{stats['latency_p50']:.2f}s p50 / {stats['latency_p95']:.2f}s p95"
+    return (f"Endpoint {stats['name']} ({stats['model']}, weight {stats['weight']:g}): "
+            f"{stats['requests']} requests, {stats['failures']} failures, {latency}, "
+            f"circuit {stats['state']} (opened {stats['circuit_opens']}x), "
+            f"{stats['hedges_won']}/{stats['hedged_to']} hedges won")
@@ -0,0 +1,58 @@
+# main.py
+import argparse
+import os
+from pipeline import FormatTranslatePipeline
+from cli_options import add_client_arguments, client_options
+
+def main():
+    parser = argparse.ArgumentParser(description="Format and translate OCR'd Markdown with an LLM in one pass")
+    parser.add_argument("--input", required=True, help="Input Markdown file path or directory containing complete.md")
+    parser.add_argument("--output", required=False, help="Output Markdown file path (optional, defaults to 'translated.md' in input directory)")
+    parser.add_argument("--formatted-output", required=False, help="Formatted checkpoint path (optional, defaults to 'formatted.md' in input directory)")
+    parser.add_argument("--no-checkpoint", action="store_true", help="Do not keep the formatted checkpoint")
+    parser.add_argument("--base-url", default="https://api.openai.com/v1/chat/completions", help="LLM API base URL")
+    parser.add_argument("--process-prompt-path", default="prompts.md", help="Path to the formatting system prompt file")
+    parser.add_argument("--translate-prompt-path", default="prompts_translate.md", help="Path to the translation system prompt file")
+    parser.add_argument("--api-key", required=True, help="LLM API key")
+    parser.add_argument("--model", default="gpt-4o-mini", help="LLM model name")
+    parser.add_argument("--translate-model", default=None, help="LLM model name for translation (defaults to --model)")
+    parser.add_argument("--queue-size", type=int, default=2, help="Formatted chunks allowed to wait for translation")
+    add_client_arguments(parser)
+
+    args = parser.parse_args()
+
+    # Check if input is a directory and look for complete.md
+    input_path = args.input
+    if os.path.isdir(input_path):
+        complete_md_path = os.path.join(input_path, "complete.md")
+        if os.path.isfile(complete_md_path):
+            input_path = complete_md_path
+        else:
+            raise FileNotFoundError(f"Directory {input_path} does not contain a 'complete.md' file")
+    elif not os.path.isfile(input_path):
+        raise FileNotFoundError(f"Input file {input_path} does not exist")
+
+    # Determine output path if not provided
+    if args.output is None:
+        input_dir = os.path.dirname(input_path)
+        args.output = os.path.join(input_dir, "translated.md")
+
+    pipeline = FormatTranslatePipeline(
+        input_path,
+        args.output,
+        args.base_url,
+        args.process_prompt_path,
+        args.translate_prompt_path,
+        args.api_key,
+        args.model,
+        translate_model=args.translate_model,
+        formatted_path=args.formatted_output,
+        checkpoint=not args.no_checkpoint,
+        queue_size=args.queue_size,
+        **client_options(args)
+    )
+
+    pipeline.run()
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 import argparse
 import os
 from document_translator import DocumentTranslator
+from batch_runner import BatchRunner
+from batch_jobs import OfflineBatchRunner
+from cli_options import add_client_arguments, add_offline_arguments, client_options, offline_options
 
 def main():
     parser = argparse.ArgumentParser(description="Process OCR'd Markdown with an LLM")
@@ -11,9 +14,34 @@ def main():
     parser.add_argument("--prompt-path", default="prompts_translate.md", help="Path to the system prompt file")
     parser.add_argument("--api-key", required=True, help="LLM API key")
     parser.add_argument("--model", default="gpt-4o-mini", help="LLM model name")
+    add_client_arguments(parser)
+    add_offline_arguments(parser)
+    parser.add_argument("--batch", action="store_true", help="Treat --input as a root folder and process every paper directory containing formatted.md below it")
+    parser.add_argument("--max-documents", type=int, default=None, help="Batch mode: number of papers processed at the same time (default: --concurrency)")
+    parser.add_argument("--report", default=None, help="Batch mode: path of the JSON summary report (default: batch_report.json in the input folder)")
     
     args = parser.parse_args()
     
+    if args.batch:
+        if not os.path.isdir(args.input):
+            raise NotADirectoryError(f"Batch input {args.input} is not a directory")
+        # Offline mode goes through the provider's batch API instead of one request per chunk
+        runner_class, extra_options = (OfflineBatchRunner, offline_options(args)) if args.offline else (BatchRunner, {})
+        runner = runner_class(
+            DocumentTranslator,
+            "formatted.md",
+            "translated.md",
+            args.base_url,
+            args.prompt_path,
+            args.api_key,
+            args.model,
+            max_documents=args.max_documents,
+            **extra_options,
+            **client_options(args)
+        )
+        runner.run(args.input, args.report)
+        return
+    
     # Check if input is a directory and look for formatted.md
     input_path = args.input
     if os.path.isdir(input_path):
@@ -29,6 +57,24 @@ def main():
     if args.output is None:
         input_dir = os.path.dirname(input_path)
         args.output = os.path.join(input_dir, "translated.md")
+
+    if args.offline:
+        # A single document is submitted as a batch of one
+        input_path = os.path.abspath(input_path)
+        runner = OfflineBatchRunner(
+            DocumentTranslator,
+            os.path.basename(input_path),
+            "translated.md",
+            args.base_url,
+            args.prompt_path,
+            args.api_key,
+            args.model,
+            **offline_options(args),
+            **client_options(args)
+        )
+        runner.run(os.path.dirname(input_path), args.report, documents=[input_path],
+                   outputs={input_path: os.path.abspath(args.output)})
+        return
         
     processor = DocumentTranslator(
         input_path,  # Use the potentially updated input path
@@ -36,7 +82,8 @@ def main():
         args.base_url,
         args.prompt_path,
         args.api_key,
-        args.model
+        args.model,
+        **client_options(args)
     )
     
     processor.translate()
@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import threading
+from output_writer import atomic_write
+
+# Glossary files are read and rewritten under this lock, so that the
+# documents of one process sharing a file never lose each other's terms
+_file_lock = threading.Lock()
+
+WORD_RE = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+CJK = '\u3400-\u4dbf\u4e00-\u9fff'
+# A translated term followed by the source term in brackets: 注意力机制（attention mechanism）
+BRACKETED_RE = re.compile(rf'([{CJK}]{{2,}})\s*[（(]\s*([A-Za-z][A-Za-z0-9 ./+\'-]{{0,60}}?)\s*[)）]')
+# Words that end the text before a term: 我们提出了 | 注意力机制
+LEAD_RE = re.compile('称为|作为|成为|认为|视为|叫做|使用|采用|利用|通过|提出|基于|'
+                     '[即的了是在和与及或将被把从这该其种个们]')
+ACRONYM_RE = re.compile(r'^[A-Z][A-Za-z]*[A-Z][A-Za-z]*s?$')
+
+def term_words(term):
+    """The lower-case words a term is matched by"""
+    return tuple(WORD_RE.findall(term.lower()))
+
+def extract_terms(source, translation, max_term_chars=12):
+    """Return the (source term, translated term) pairs a finished chunk shows
+
+    Needs no request: the pairs are the terms the translation gives with the
+    original in brackets, "长短期记忆（LSTM）" or "注意力机制（attention
+    mechanism）". The translated term is what follows the last function
+    word before the bracket. The source term must appear in the source, and
+    for an acronym its spelled-out form ("Long Short-Term Memory (LSTM)")
+    is taken from the source as well.
+    """
+    source_words = ' '.join(term_words(source))
+    pairs = []
+    for match in BRACKETED_RE.finditer(translation):
+        lead = match.group(1)
+        cut = max((m.end() for m in LEAD_RE.finditer(lead)), default=0)
+        translated = lead[cut:]
+        term = ' '.join(match.group(2).split())
+        words = term_words(term)
+        if not 2 <= len(translated) <= max_term_chars or not words:
+            continue
+        if f" {' '.join(words)} " not in f" {source_words} ":
+            continue
+        pairs.append((term, translated))
+        if ACRONYM_RE.match(term):
+            expanded = _spelled_out(source, term)
+            if expanded is not None:
+                pairs.append((expanded, translated))
+    return pairs
+
+def _spelled_out(source, acronym):
+    """The words before "(ACRONYM)" in source whose initials spell it, or None"""
+    match = re.search(r'((?:[A-Za-z][\w-]*\s+){1,8})\(\s*' + re.escape(acronym) + r'\s*\)', source)
+    if match is None:
+        return None
+    words = match.group(1).split()
+    letters = acronym.rstrip('s').lower()
+    for start in range(len(words) - 1, -1, -1):
+        initials = ''.join(part[0] for word in words[start:] for part in word.split('-') if part).lower()
+        if initials == letters:
+            return ' '.join(words[start:])
+        if len(initials) > len(letters):
+            break
+    return None
+
+class Glossary:
+    """Term translations learnt from finished chunks, looked up by the terms a chunk contains.
+
+    The translator adds every accepted result with learn(); the context of a
+    request is then only the entries whose source terms appear in its chunk
+    (see GlossaryPolicy), instead of the previous chunk and its translation.
+    Terms are indexed by their first word, so a lookup costs one dict access
+    per word of the chunk whatever the size of the glossary.
+
+    With a path the glossary is kept in a JSON file shared by the papers of
+    one field: {"terms": {"attention mechanism": {"注意力机制": 3}}}, counts
+    per translation, the most frequent one being used. An entry written as
+    a plain string ("LSTM": "长短期记忆") is fixed and never overridden.
+
+    Args:
+        path: JSON file loaded at start and updated by save() (None keeps the glossary in memory)
+        extractor: Callable(source, translation) returning (term, translated term) pairs
+            (default: extract_terms(), which needs no extra request)
+        max_entries: Most entries sent with one chunk, the most frequent first
+    """
+    def __init__(self, path=None, extractor=None, max_entries=40):
+        self.path = path
+        self.extractor = extractor or extract_terms
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # term words -> {"term": display form, "translations": {translated: count}, "fixed": str or None}
+        self.entries = {}
+        # first word -> set of term words starting with it
+        self.index = {}
+        # Counts learnt since the last save, merged into the file then
+        self._new = {}
+        self.learned = 0
+        self.lookups = 0
+        self.sent = 0
+
+        if path is not None:
+            for term, value in self._load().get("terms", {}).items():
+                self._add(term, value, fixed=isinstance(value, str))
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _add(self, term, value, fixed=False):
+        """Add a file entry (dict of counts, or a fixed translation) or one learnt translation"""
+        words = term_words(term)
+        if not words:
+            return
+        entry = self.entries.get(words)
+        if entry is None:
+            entry = {"term": term, "translations": {}, "fixed": None}
+            self.entries[words] = entry
+            self.index.setdefault(words[0], set()).add(words)
+        if isinstance(value, dict):
+            for translated, n in value.items():
+                entry["translations"][translated] = entry["translations"].get(translated, 0) + n
+        elif fixed:
+            entry["fixed"] = value
+        else:
+            entry["translations"][value] = entry["translations"].get(value, 0) + 1
+
+    def translation(self, entry):
+        if entry["fixed"] is not None:
+            return entry["fixed"]
+        return max(entry["translations"].items(), key=lambda item: (item[1], -len(item[0])))[0]
+
+    def learn(self, source, translation):
+        """Add the term pairs shown by a finished chunk"""
+        pairs = self.extractor(source, translation)
+        if not pairs:
+            return
+        with self._lock:
+            for term, translated in pairs:
+                self._add(term, translated)
+                key = (term_words(term), translated)
+                _, count = self._new.get(key, (term, 0))
+                self._new[key] = (term, count + 1)
+                self.learned += 1
+
+    def lookup(self, text):
+        """Return [(term, translation)] for the known terms that appear in text, most frequent first"""
+        words = WORD_RE.findall(text.lower())
+        with self._lock:
+            self.lookups += 1
+            found = {}
+            for i, word in enumerate(words):
+                for candidate in self.index.get(word, ()):
+                    if candidate not in found and tuple(words[i:i + len(candidate)]) == candidate:
+                        found[candidate] = self.entries[candidate]
+            ranked = sorted(found.values(), key=lambda entry: (entry["fixed"] is None,
+                                                               -sum(entry["translations"].values())))
+            result = [(entry["term"], self.translation(entry)) for entry in ranked[:self.max_entries]]
+            self.sent += len(result)
+        return result
+
+    def save(self):
+        """Add the translations learnt since the last save to the file, keeping what others saved meanwhile"""
+        if self.path is None:
+            return
+        with self._lock:
+            new, self._new = self._new, {}
+        if not new:
+            return
+        with _file_lock:
+            data = self._load()
+            terms = data.setdefault("terms", {})
+            # A term already in the file keeps the spelling it was saved with
+            spelling = {term_words(term): term for term in terms}
+            for (words, translated), (term, count) in new.items():
+                term = spelling.setdefault(words, term)
+                value = terms.setdefault(term, {})
+                if isinstance(value, dict):
+                    value[translated] = value.get(translated, 0) + count
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            atomic_write(self.path, json.dumps(data, ensure_ascii=False, indent=1, sort_keys=True))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "terms": len(self.entries),
+                "learned": self.learned,
+                "lookups": self.lookups,
+                "entries_sent": self.sent,
+            }
+
+    def close(self):
+        self.save()
+
+def format_glossary_stats(stats):
+    """One line describing Glossary.stats()"""
+    return (f"Glossary: {stats['terms']} terms ({stats['learned']} learnt in this run), "
+            f"{stats['entries_sent']} entries sent with {stats['lookups']} chunks")
@@ -1,284 +1,646 @@
-import http.client
+import hashlib
 import json
-from urllib.parse import urlparse
-import tiktoken
+import threading
 import time  # Added for retry delays
+from concurrent.futures import Future, as_completed, wait
+from context_manager import MESSAGE_TOKEN_OVERHEAD
+from endpoints import Endpoint, EndpointRouter, load_endpoints
+from rate_limiter import RequestScheduler
+from registry import get_tokenizer
+from context_policies import BudgetedWindowPolicy, LatestPairPolicy, fit_newest, get_policy
+
+class LLMRequestError(Exception):
+    """A request that still failed after every retry; never returned as if it were a response"""
+    def __init__(self, message, status=None, attempts=0):
+        super().__init__(message)
+        self.status = status
+        self.attempts = attempts
 
 class LLMClient:
-    def __init__(self, api_key, base_url, model="gpt-4o-mini"):
-        parsed_url = urlparse(base_url)
-        self.hostname = parsed_url.netloc.split(':')[0]
-        self.port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
+    # max_tokens of responses unless the caller sets its own
+    DEFAULT_MAX_COMPLETION_TOKENS = 8192
+
+    def __init__(self, api_key, base_url, model="gpt-4o-mini", pool_size=4, pool_idle_timeout=60,
+                 stream=False, response_cache=None, resume=False, requests_per_minute=None,
+                 tokens_per_minute=None, max_concurrency=1, max_backoff=60, cache_hint=None,
+                 endpoints=None, hedge_percentile=None, dedup_cache=None, max_completion_tokens=None):
+        # Every request goes to one of the endpoints; without a list, base_url is the only one.
+        # endpoints is a JSON file, or Endpoint objects or dicts of Endpoint arguments (see load_endpoints)
+        if isinstance(endpoints, str):
+            endpoints = load_endpoints(endpoints)
+        if not endpoints:
+            endpoints = [{"base_url": base_url}]
+        self.endpoints = [
+            entry if isinstance(entry, Endpoint) else
+            Endpoint(**dict({"api_key": api_key, "model": model, "pool_size": pool_size,
+                             "pool_idle_timeout": pool_idle_timeout}, **entry))
+            for entry in endpoints
+        ]
+        self.router = EndpointRouter(self.endpoints)
+        
+        # The first endpoint stands for the client in messages and for older callers
+        primary = self.endpoints[0]
+        self.scheme = primary.scheme
+        self.hostname = primary.hostname
+        self.port = primary.port
+        self.pool = primary.pool
 
         self.base_url = base_url
         self.api_key = api_key
-        self.tokenzier = tiktoken.encoding_for_model("gpt-4o")
         self.model = model
+        self.stream = stream
+        
+        # max_tokens of requests that do not ask for a smaller one
+        self.max_completion_tokens = max_completion_tokens or self.DEFAULT_MAX_COMPLETION_TOKENS
+        
+        # Successful responses are always stored; they are only looked up when resuming
+        self.response_cache = response_cache
+        self.resume = resume
+        
+        # Results of chunks that repeat across documents, looked up before any context is built
+        self.dedup_cache = dedup_cache
+        
+        # Rate limits, adaptive concurrency and retry backoff shared by every request
+        self.scheduler = RequestScheduler(requests_per_minute, tokens_per_minute,
+                                          max_concurrency=max_concurrency, max_delay=max_backoff)
         
-    def _send_request(self, messages, status_callback, max_retries=500, initial_delay=1):
+        # Timing, retries and usage of the last request made from each thread
+        self._local = threading.local()
+        
+        # Provider-specific prompt caching hint: None, "openai" or "anthropic"
+        if cache_hint not in (None, "openai", "anthropic"):
+            raise ValueError(f"Unknown cache hint '{cache_hint}'")
+        self.cache_hint = cache_hint
+        
+        # A request still unanswered after this latency percentile of its endpoint
+        # is sent to a second endpoint as well, and the first answer wins
+        if hedge_percentile is not None and not 0 < hedge_percentile < 1:
+            raise ValueError(f"hedge_percentile must be between 0 and 1, got {hedge_percentile}")
+        self.hedge_percentile = hedge_percentile
+        
+    @property
+    def tokenzier(self):
+        """The process-wide gpt-4o encoding, loaded on first use rather than per client"""
+        return get_tokenizer()
+    
+    def last_request_info(self):
+        """Return details of the last request sent from the calling thread
+        
+        The dict holds attempts, retries, latency (of the successful attempt),
+        total_time (including retries), ttfb, throttle_wait, usage,
+        finish_reason, status, cache_hit, dedup_hit and the endpoint and model
+        of the last attempt. Returns None if this thread has
+        not sent a request yet.
+        """
+        return getattr(self._local, 'last_request', None)
+    
+    def _apply_cache_hint(self, payload):
+        """Mark the shared system prompt for the provider's prompt cache
+        
+        "openai" sends a prompt_cache_key derived from the model and system
+        prompt, so requests sharing that prefix are routed to the same cache.
+        "anthropic" adds a cache_control breakpoint after the system prompt,
+        as accepted by Anthropic-compatible endpoints. The response cache key
+        is computed from the plain messages and does not change.
+        """
+        messages = payload["messages"]
+        if self.cache_hint is None or not messages or messages[0]["role"] != "system":
+            return
+        system_prompt = messages[0]["content"]
+        if self.cache_hint == "openai":
+            payload["prompt_cache_key"] = hashlib.sha256(
+                f"{self.model}\0{system_prompt}".encode('utf-8')).hexdigest()[:32]
+        else:
+            system = {
+                "role": "system",
+                "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+            }
+            payload["messages"] = [system] + messages[1:]
+    
+    def build_payload(self, messages, model=None, max_completion_tokens=None):
+        """Return the request body for messages, as sent to the chat-completions endpoint
+        
+        Also used for the lines of an offline batch file, so that a chunk is
+        asked for in the same way whichever route it takes.
+        """
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "max_tokens": max_completion_tokens or self.max_completion_tokens,
+            "top_p": 0.8,
+            "temperature": 0.2        
+        }
+        self._apply_cache_hint(payload)
+        return payload
+    
+    def _read_stream(self, response, status_callback, stream_writer, started, info):
+        """Read a server-sent-event response and return the concatenated content
+        
+        Every content delta is handed to stream_writer as soon as it arrives;
+        the time to the first token, usage and finish_reason are stored in info.
+        Raises ConnectionError if the stream ends before the server signalled
+        completion, so that the caller can discard the partial output and retry.
+        """
+        parts = []
+        finished = False
+        first_token_time = None
+        
+        for raw_line in response:
+            line = raw_line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                finished = True
+                break
+            
+            event = json.loads(data)
+            if event.get('usage'):
+                info["usage"] = event['usage']
+            choices = event.get('choices') or []
+            if not choices:
+                continue
+            if choices[0].get('finish_reason'):
+                finished = True
+                info["finish_reason"] = choices[0]['finish_reason']
+            delta = (choices[0].get('delta') or {}).get('content')
+            if not delta:
+                continue
+            
+            if first_token_time is None:
+                first_token_time = time.monotonic()
+                info["ttfb"] = first_token_time - started
+                status_callback(f"First token received after {first_token_time - started:.2f}s")
+            parts.append(delta)
+            if stream_writer is not None:
+                stream_writer.write(delta)
+        
+        if not finished:
+            raise ConnectionError("Stream ended before the response was complete")
+        return ''.join(parts)
+        
+    def _start_request_info(self):
+        """Create the details of a new request and make them this thread's last_request_info()"""
+        info = {
+            "attempts": 0,
+            "retries": 0,
+            "latency": None,
+            "total_time": None,
+            "ttfb": None,
+            "throttle_wait": 0.0,
+            "usage": None,
+            "finish_reason": None,
+            "status": None,
+            "cache_hit": False,
+            "dedup_hit": False,
+            "endpoint": None,
+            "model": None,
+        }
+        self._local.last_request = info
+        return info
+    
+    def _send_request(self, messages, status_callback, max_retries=500, initial_delay=1, stream_writer=None,
+                      prompt_tokens=None, dedup_source=None, model=None, bypass_cache=False,
+                      max_completion_tokens=None):
         """Send a request to the LLM API
         
         Args:
             messages: List of message objects to send to the API
             status_callback: Callback function for status updates
             max_retries: Maximum number of retry attempts on failure
-            initial_delay: Initial delay in seconds between retries (will increase exponentially)
+            initial_delay: Initial delay in seconds between retries (will increase exponentially,
+                with jitter, up to max_backoff)
+            stream_writer: Optional object with write(text) and discard() methods that receives
+                content deltas in streaming mode; discard() is called before a retry
+            prompt_tokens: Token count of messages if already known, for the tokens/min limit
+            dedup_source: (system_prompt, chunk) under which a successful response is also
+                stored in the DedupCache
+            model: Model to use instead of the client's (and the endpoints') own, e.g. a fallback
+            bypass_cache: Do not return a cached response, e.g. when asking again for a bad one
+            max_completion_tokens: max_tokens of this request (default: the client's)
         
         Returns:
             The response content from the API
+        
+        Raises:
+            LLMRequestError: If the request still fails after max_retries retries
         """
         status_callback(f"Preparing request with {len(messages)} messages...")
         
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "max_tokens": 8192,
-            "top_p": 0.8,
-            "temperature": 0.2        
-        }
+        payload = self.build_payload(messages, model, max_completion_tokens)
+        if self.stream:
+            payload["stream"] = True
+            # Ask for a final usage event, which streamed responses otherwise omit
+            payload["stream_options"] = {"include_usage": True}
         
-        header = {
-            'Accept': 'application/json',
-            'Authorization': 'Bearer ' + self.api_key,
-            'Content-Type': 'application/json'
-        }
+        info = self._start_request_info()
+        
+        # Both caches are keyed by the model that answered, which may be an endpoint's own
+        if self.response_cache is not None and self.resume and not bypass_cache:
+            for cached_model in self._cache_models(model):
+                cached = self.response_cache.get(self.response_cache.make_key(cached_model, messages))
+                if cached is not None:
+                    info["cache_hit"] = True
+                    status_callback("Found cached response, skipping request.")
+                    self._store_dedup(dedup_source, cached_model, cached)
+                    return cached
+        
+        # The provider counts the prompt plus the requested completion against tokens/min
+        if prompt_tokens is None:
+            prompt_tokens = sum(self._count_tokens(message) for message in messages)
+        estimated_tokens = prompt_tokens + payload["max_tokens"]
+        
+        # Rate-limit headers and Retry-After describe the whole client only when it has one endpoint
+        single_endpoint = len(self.endpoints) == 1
         
         retry_count = 0
         delay = initial_delay
+        request_started = time.monotonic()
+        failed_endpoint = None
 
         while True:
             if retry_count > 0:
                 status_callback(f"Retry attempt {retry_count}/{max_retries} after {delay:.1f}s delay...")
                 time.sleep(delay)
-                # Exponential backoff: double the delay for the next retry
-                delay *= 2
-            
-            status_callback(f"Sending request to {self.hostname}...")
-            
-            conn = http.client.HTTPSConnection(self.hostname, self.port)
             
+            waited = self.scheduler.acquire(estimated_tokens)
+            # The slot is released whatever happens from here on, callbacks included
             try:
-                conn.request("POST", "/v1/chat/completions", json.dumps(payload), header)
-                status_callback("Waiting for response...")
-                response = conn.getresponse()
+                info["throttle_wait"] += waited
+                info["attempts"] += 1
+                info["retries"] = retry_count
+                if waited >= 1:
+                    status_callback(f"Waited {waited:.1f}s for the rate limiter.")
+                
+                # Prefer another endpoint than the one that just failed
+                endpoint = self.router.choose(exclude=(failed_endpoint,) if failed_endpoint else ())
+                status_callback(f"Sending request to {endpoint.name}...")
                 
-                if response.status == 200:
-                    status_callback("Response received, processing data...")
-                    data = json.loads(response.read().decode())
-                    result = data['choices'][0]['message']['content']
-                    status_callback("Processing completed successfully.")
-                    return result
-                else:
-                    error_msg = f"API request failed with status {response.status}: {response.read().decode()}"
+                try:
+                    status, headers, body, attempt_info = self._attempt_with_hedge(
+                        endpoint, payload, status_callback, stream_writer, model)
+                    info.update(attempt_info)
+                    self.scheduler.record_response(status, headers if single_endpoint else None)
+                    
+                    if status == 200:
+                        info["total_time"] = time.monotonic() - request_started
+                        # A response cut off by max_tokens is never reused: a cache hit
+                        # carries no finish_reason, so it would pass for a complete one
+                        truncated = info.get("finish_reason") == "length"
+                        if self.response_cache is not None and not truncated:
+                            self.response_cache.put(self.response_cache.make_key(info["model"], messages), body)
+                        if not truncated:
+                            self._store_dedup(dedup_source, info["model"], body)
+                        status_callback("Processing completed successfully.")
+                        return body
+                    else:
+                        error_msg = f"API request failed with status {status}: {body}"
+                        status_callback(error_msg, True)
+                        
+                        # A request the API rejects as such (malformed, too large) fails the same way
+                        # everywhere, and so does any request once the retries are used up
+                        if status in Endpoint.CLIENT_ERRORS or retry_count >= max_retries:
+                            raise LLMRequestError(error_msg, status, info["attempts"])
+                        
+                        # Otherwise, increment retry count and try again
+                        retry_count += 1
+                        failed_endpoint = endpoint
+                        delay = self._retry_delay(endpoint, retry_count, headers, initial_delay, status_callback,
+                                                  status)
+                        
+                except LLMRequestError:
+                    raise
+                except Exception as e:
+                    error_msg = f"Error: {str(e)}"
                     status_callback(error_msg, True)
+                    info["endpoint"] = endpoint.name
+                    
+                    # Drop whatever part of a streamed response was already written
+                    if stream_writer is not None:
+                        stream_writer.discard()
                     
-                    # If we've reached max retries, return the error
+                    # If we've reached max retries, give up
                     if retry_count >= max_retries:
-                        return error_msg
+                        raise LLMRequestError(f"Error occurred after {max_retries} retries: {str(e)}",
+                                              attempts=info["attempts"]) from e
                     
                     # Otherwise, increment retry count and try again
+                    self.scheduler.record_failure()
                     retry_count += 1
-                    
-            except Exception as e:
-                error_msg = f"Error: {str(e)}"
-                status_callback(error_msg, True)
-                
-                # If we've reached max retries, return the error
-                if retry_count >= max_retries:
-                    return f"Error occurred after {max_retries} retries: {str(e)}"
-                
-                # Otherwise, increment retry count and try again
-                retry_count += 1
+                    failed_endpoint = endpoint
+                    delay = self._retry_delay(endpoint, retry_count, None, initial_delay, status_callback)
                 
             finally:
-                conn.close()
+                self.scheduler.release()
     
-    def _count_tokens(self, message):
-        """Count the number of tokens in a message"""
-        return len(self.tokenzier.encode(str(message)))
+    def _cache_models(self, model=None):
+        """Models whose cached results answer a request for model (default: any endpoint's own)"""
+        if model is not None:
+            return [model]
+        return list(dict.fromkeys(endpoint.model for endpoint in self.endpoints))
     
-    def process_with_all_context(self, system_prompt, context_manager, current_user_message, 
-                                 max_tokens=20000, status_callback=None):
-        """Process a user message with the LLM using both user and assistant messages as context
-        up to a certain token count threshold.
+    def _store_dedup(self, dedup_source, model, response):
+        """Store response in the DedupCache under (model, system prompt, chunk), if there is one"""
+        if self.dedup_cache is not None and dedup_source is not None:
+            system_prompt, chunk = dedup_source
+            self.dedup_cache.put(self.dedup_cache.make_key(model, system_prompt, chunk), response)
+    
+    def _retry_delay(self, endpoint, retry_count, headers, initial_delay, status_callback, status=None):
+        """Delay before the next attempt: none when another healthy endpoint can take it
         
-        Args:
-            system_prompt: The system prompt to guide the LLM
-            context_manager: ContextManager instance with message history
-            current_user_message: The current user message to process
-            max_tokens: Maximum number of tokens to include in context (default: 20000)
-            status_callback: Optional callback function for status updates
+        Only throttling (429), server errors and failed connections (status
+        None) are failed over at once; any other status backs off as usual.
         """
-        if status_callback is None:
-            # Default status callback just prints to console
-            status_callback = lambda msg, is_error=False: print(f"{'ERROR: ' if is_error else 'STATUS: '}{msg}")
-            
-        status_callback("Starting processing request with combined user and assistant context...")
-        
-        # Initialize messages with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Current user message
-        current_message = {"role": "user", "content": current_user_message}
-        
-        # Calculate tokens used by system prompt and current message
-        system_tokens = self._count_tokens({"content": system_prompt})
-        current_message_tokens = self._count_tokens(current_message)
-        
-        # Calculate remaining tokens for context
-        remaining_tokens = max_tokens - system_tokens - current_message_tokens
-        
-        if remaining_tokens > 0:
-            # Get limited context from context manager
-            context_messages, context_tokens = context_manager.get_limited_combined_messages(remaining_tokens)
-            
-            # Add context messages
-            messages.extend(context_messages)
-            
-            status_callback(f"Added {len(context_messages)} context messages using {context_tokens} tokens.")
-        
-        # Add current user message
-        messages.append(current_message)
-        
-        status_callback(f"Built context with {len(messages)} messages.")
-        
-        return self._send_request(messages, status_callback)
+        alternative = self.router.alternative(endpoint)
+        if alternative is not None and (status is None or status == 429 or status >= 500):
+            status_callback(f"Failing over from {endpoint.name} to another endpoint.")
+            return 0.0
+        # Retry-After pauses every request only when it comes from the client's only endpoint
+        return self.scheduler.backoff(retry_count, headers if len(self.endpoints) == 1 else None, initial_delay)
     
-    def process_with_context_of_assistant(self, system_prompt, context_manager, current_user_message, 
-                                          max_tokens=20000, status_callback=None):
-        """Process a user message with the LLM and assistant messages as context
+    def _attempt(self, endpoint, payload, status_callback, stream_writer, model=None):
+        """Send one attempt to endpoint and return (status, headers, content or error body, info)
         
-        Args:
-            system_prompt: The system prompt to guide the LLM
-            context_manager: ContextManager instance with message history
-            current_user_message: The current user message to process
-            max_tokens: Maximum number of tokens for context
-            status_callback: Optional callback function for status updates
+        info holds status, latency, ttfb, usage, finish_reason, the endpoint
+        name and the model of this attempt only. The endpoint's health is updated here.
         """
-        if status_callback is None:
-            # Default status callback just prints to console
-            status_callback = lambda msg, is_error=False: print(f"{'ERROR: ' if is_error else 'STATUS: '}{msg}")
+        info = {"endpoint": endpoint.name, "model": model or endpoint.model}
+        header = {
+            'Accept': 'application/json',
+            'Authorization': 'Bearer ' + endpoint.api_key,
+            'Content-Type': 'application/json'
+        }
+        # Each endpoint may serve the model under its own name, unless a specific model was asked for
+        body = json.dumps(dict(payload, model=model or endpoint.model))
+        
+        conn = None
+        endpoint.begin()
+        try:
+            started = time.monotonic()
+            conn, response = endpoint.pool.request("POST", endpoint.path, body, header)
+            status_callback("Waiting for response...")
+            info["status"] = response.status
+            if not self.stream:
+                info["ttfb"] = time.monotonic() - started
+            if response.status == 200 and self.stream:
+                result = self._read_stream(response, status_callback, stream_writer, started, info)
+            data = response.read()
             
-        status_callback("Starting processing request with assistant context...")
-        
-        # Initialize messages with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Current user message
-        current_message = {"role": "user", "content": current_user_message}
-        
-        # Calculate tokens used by system prompt and current message
-        system_tokens = self._count_tokens({"content": system_prompt})
-        current_message_tokens = self._count_tokens(current_message)
-        
-        # Calculate remaining tokens for context
-        remaining_tokens = max_tokens - system_tokens - current_message_tokens
-        
-        if remaining_tokens > 0:
-            # Get limited assistant messages from context manager
-            assistant_messages, assistant_tokens = context_manager.get_limited_assistant_messages(remaining_tokens)
+            # The body has been fully read, so the connection can go back to the pool
+            if response.will_close:
+                endpoint.pool.discard(conn)
+            else:
+                endpoint.pool.release(conn)
+            conn = None
             
-            # Add assistant messages
-            messages.extend(assistant_messages)
+            if response.status != 200:
+                retry_after = None
+                if response.status == 429:
+                    retry_after = self.scheduler.parse_retry_after(response.headers.get('Retry-After'))
+                endpoint.record_failure(response.status, retry_after)
+                return response.status, response.headers, data.decode(), info
             
-            status_callback(f"Added {len(assistant_messages)} assistant messages using {assistant_tokens} tokens.")
-        
-        # Add current user message
-        messages.append(current_message)
-        
-        status_callback(f"Built context with {len(messages)} messages.")
-        
-        return self._send_request(messages, status_callback)
+            status_callback("Response received, processing data...")
+            if not self.stream:
+                parsed = json.loads(data.decode())
+                result = parsed['choices'][0]['message']['content']
+                info["usage"] = parsed.get('usage')
+                info["finish_reason"] = parsed['choices'][0].get('finish_reason')
+            info["latency"] = time.monotonic() - started
+            endpoint.record_success(info["latency"])
+            return response.status, response.headers, result, info
+        except Exception:
+            endpoint.record_failure()
+            raise
+        finally:
+            endpoint.finish()
+            
+            # Only connections left in an unknown state are dropped here
+            if conn is not None:
+                endpoint.pool.discard(conn)
     
-    def process_with_context_of_user(self, system_prompt, context_manager, current_user_message, 
-                                     max_tokens=20000, status_callback=None):
-        """Process a user message with the LLM and previous user messages as context
-        
-        Args:
-            system_prompt: The system prompt to guide the LLM
-            context_manager: ContextManager instance with message history
-            current_user_message: The current user message to process
-            max_tokens: Maximum number of tokens for context
-            status_callback: Optional callback function for status updates
+    def _attempt_with_hedge(self, endpoint, payload, status_callback, stream_writer, model=None):
+        """Send one attempt, hedged to a second endpoint if it is slower than usual
+        
+        When hedge_percentile is set and the endpoint has enough latency
+        samples, the attempt is also sent to the best other healthy endpoint
+        once it has run longer than that percentile of the endpoint's
+        latencies; the first successful answer is returned and the other
+        one is left to finish and be dropped. Streamed attempts that write
+        to a stream_writer are never hedged, since two streams cannot write
+        to the same output.
         """
-        if status_callback is None:
-            # Default status callback just prints to console
-            status_callback = lambda msg, is_error=False: print(f"{'ERROR: ' if is_error else 'STATUS: '}{msg}")
-            
-        status_callback("Starting processing request with user context...")
-        
-        # Initialize messages with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Current user message
-        current_message = {"role": "user", "content": current_user_message}
-        
-        # Calculate tokens used by system prompt and current message
-        system_tokens = self._count_tokens({"content": system_prompt})
-        current_message_tokens = self._count_tokens(current_message)
-        
-        # Calculate remaining tokens for context
-        remaining_tokens = max_tokens - system_tokens - current_message_tokens
+        hedge_after = None
+        if self.hedge_percentile is not None and stream_writer is None and len(self.endpoints) > 1:
+            hedge_after = endpoint.hedge_delay(self.hedge_percentile)
+        if hedge_after is None:
+            return self._attempt(endpoint, payload, status_callback, stream_writer, model)
+        
+        primary = self._run_in_thread(self._attempt, endpoint, payload, status_callback, None, model)
+        done, _ = wait([primary], timeout=hedge_after)
+        backup = None if done else self.router.alternative(endpoint)
+        if backup is None:
+            return primary.result()
+        
+        status_callback(f"No answer from {endpoint.name} after {hedge_after:.1f}s, "
+                        f"hedging to {backup.name}...")
+        hedge = self._run_in_thread(self._attempt, backup, payload, status_callback, None, model)
+        last_result = None
+        last_error = None
+        for future in as_completed([primary, hedge]):
+            try:
+                result = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+            if result[0] == 200:
+                backup.record_hedge(won=future is hedge)
+                return result
+            last_result = result
+        backup.record_hedge(won=False)
+        if last_result is not None:
+            return last_result
+        raise last_error
+    
+    def _run_in_thread(self, fn, *args):
+        """Run fn(*args) in its own daemon thread and return a Future of its result
         
-        if remaining_tokens > 0:
-            # Get limited user messages from context manager
-            user_messages, user_tokens = context_manager.get_limited_user_messages(remaining_tokens)
-            
-            # Add user messages
-            messages.extend(user_messages)
-            
-            status_callback(f"Added {len(user_messages)} user messages using {user_tokens} tokens.")
+        Hedged attempts get their own threads rather than a bounded pool, so
+        a losing attempt stuck on a slow endpoint never delays another request.
+        """
+        future = Future()
         
-        # Add current user message
-        messages.append(current_message)
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
         
-        status_callback(f"Built context with {len(messages)} messages.")
+        threading.Thread(target=run, daemon=True).start()
+        return future
+    
+    def pool_stats(self):
+        """Return hit/miss counters of the keep-alive connection pools of every endpoint"""
+        return self.router.pool_stats()
+    
+    def endpoint_stats(self):
+        """Return requests, failures, latency, circuit state and hedges of every endpoint"""
+        return self.router.stats()
+    
+    def close(self):
+        """Close all pooled connections"""
+        self.router.close()
+    
+    def _count_tokens(self, message):
+        """Count the number of tokens in a message
         
-        return self._send_request(messages, status_callback)
+        Like ContextManager, only the content of a message dict is encoded,
+        plus the fixed per-message overhead. Chunks from a token-budgeted
+        TextSplitter already carry their count, which is reused instead of
+        encoding the same text again.
+        """
+        if isinstance(message, dict):
+            return self._count_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD
+        token_count = getattr(message, "token_count", None)
+        if token_count is not None:
+            return token_count
+        return len(self.tokenzier.encode(str(message), disallowed_special=()))
     
-    def process_with_latest_context(self, system_prompt, context_manager, current_user_message,
-                                   max_tokens=20000, status_callback=None):
-        """Process a user message with the LLM using only the most recent user-assistant conversation pair
+    def process(self, system_prompt, context_manager, current_user_message, policy,
+                max_tokens=20000, status_callback=None, stream_writer=None, model=None, bypass_cache=False,
+                max_completion_tokens=None):
+        """Process a user message with the LLM, with context chosen by a ContextPolicy
+        
+        max_tokens is a strict budget for the whole prompt: the context gets
+        what is left after the system prompt and the current message, and
+        context that does not fit is trimmed rather than sent anyway.
         
         Args:
             system_prompt: The system prompt to guide the LLM
             context_manager: ContextManager instance with message history
             current_user_message: The current user message to process
-            max_tokens: Maximum number of tokens for context
+            policy: ContextPolicy instance or policy name ("latest", "window", "source", "summary")
+            max_tokens: Maximum number of prompt tokens (default: 20000)
             status_callback: Optional callback function for status updates
+            stream_writer: Optional writer receiving content deltas in streaming mode
+            model: Model to use for this request instead of the client's own
+            bypass_cache: Ask the model again even if a cached or deduplicated result exists
+            max_completion_tokens: max_tokens of the response (default: the client's)
+        
+        Raises:
+            LLMRequestError: If the request still fails after every retry
         """
         if status_callback is None:
             # Default status callback just prints to console
             status_callback = lambda msg, is_error=False: print(f"{'ERROR: ' if is_error else 'STATUS: '}{msg}")
-            
-        status_callback("Starting processing request with latest conversation context...")
+        policy = get_policy(policy)
+        
+        status_callback(f"Starting processing request with {policy.description}...")
+        
+        # Boilerplate seen in an earlier document is answered without a request
+        if self.dedup_cache is not None and not bypass_cache:
+            for cached_model in self._cache_models(model):
+                cached = self.dedup_cache.get(self.dedup_cache.make_key(cached_model, system_prompt,
+                                                                        current_user_message))
+                if cached is not None:
+                    self._start_request_info()["dedup_hit"] = True
+                    status_callback("Chunk seen in an earlier document, reusing its result.")
+                    return cached
+        
+        messages, prompt_tokens = self.build_messages(system_prompt, context_manager, current_user_message,
+                                                      policy, max_tokens, status_callback)
+        
+        return self._send_request(messages, status_callback, stream_writer=stream_writer,
+                                  prompt_tokens=prompt_tokens,
+                                  dedup_source=(system_prompt, current_user_message),
+                                  model=model, bypass_cache=bypass_cache,
+                                  max_completion_tokens=max_completion_tokens)
+    
+    def build_messages(self, system_prompt, context_manager, current_user_message, policy,
+                       max_tokens=20000, status_callback=None):
+        """Return (messages, prompt_tokens) for a user message, with context chosen by policy
         
-        # Initialize messages with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
+        The context gets what is left of max_tokens after the system prompt
+        and the current message; see process().
+        """
+        if status_callback is None:
+            status_callback = lambda msg, is_error=False: None
+        policy = get_policy(policy)
         
         # Current user message
         current_message = {"role": "user", "content": current_user_message}
         
-        # Calculate tokens used by system prompt and current message
+        # System prompts from the registry and chunks from the splitter carry their counts
         system_tokens = self._count_tokens({"content": system_prompt})
         current_message_tokens = self._count_tokens(current_message)
+        prompt_tokens = system_tokens + current_message_tokens
         
-        # Calculate remaining tokens for context
-        remaining_tokens = max_tokens - system_tokens - current_message_tokens
-        
+        # Whatever is left of the budget goes to context
+        remaining_tokens = max_tokens - prompt_tokens
+        context_messages = []
         if remaining_tokens > 0:
-            # Get latest conversation pair from context manager
-            latest_messages = context_manager.get_latest_conversation_pair()
-            latest_tokens = sum(self._count_tokens(msg) for msg in latest_messages)
+            context_messages, context_tokens = policy.select(context_manager, remaining_tokens,
+                                                             current_user_message)
+            if context_tokens > remaining_tokens:
+                # Never trust a policy to keep to the budget
+                context_messages, context_tokens = fit_newest(context_messages, remaining_tokens)
             
-            # Add latest conversation messages
-            messages.extend(latest_messages)
+            status_callback(f"Added {len(context_messages)} context messages using {context_tokens} "
+                            f"of {remaining_tokens} available tokens.")
             
-            status_callback(f"Added {len(latest_messages)} latest conversation messages using {latest_tokens} tokens.")
+            prompt_tokens += context_tokens
         
-        # Add current user message
-        messages.append(current_message)
+        messages = [{"role": "system", "content": system_prompt}] + context_messages + [current_message]
         
         status_callback(f"Built context with {len(messages)} messages.")
+        return messages, prompt_tokens
+    
+    def has_result(self, system_prompt, current_user_message, messages, model=None):
+        """Return True if process() would answer this chunk without a request
+        
+        That is a deduplicated chunk, or a cached response when resuming.
+        Nothing is counted as a cache hit; process() does that when it is called.
+        """
+        for cached_model in self._cache_models(model):
+            if self.dedup_cache is not None:
+                if self.dedup_cache.contains(self.dedup_cache.make_key(cached_model, system_prompt,
+                                                                       current_user_message)):
+                    return True
+            if self.response_cache is not None and self.resume:
+                if self.response_cache.contains(self.response_cache.make_key(cached_model, messages)):
+                    return True
+        return False
+    
+    def store_result(self, system_prompt, current_user_message, messages, response, model=None):
+        """Store a response obtained outside of process(), e.g. from an offline batch, in the caches
         
-        return self._send_request(messages, status_callback)
+        model is the one that answered (default: the first endpoint's, to which batches are sent).
+        """
+        model = model or self.endpoints[0].model
+        if self.response_cache is not None:
+            self.response_cache.put(self.response_cache.make_key(model, messages), response)
+        self._store_dedup((system_prompt, current_user_message), model, response)
+    
+    def process_with_all_context(self, system_prompt, context_manager, current_user_message, 
+                                 max_tokens=20000, status_callback=None, stream_writer=None):
+        """Process a user message using the most recent user and assistant messages that fit in max_tokens"""
+        return self.process(system_prompt, context_manager, current_user_message,
+                            BudgetedWindowPolicy("combined"), max_tokens, status_callback, stream_writer)
+    
+    def process_with_context_of_assistant(self, system_prompt, context_manager, current_user_message, 
+                                          max_tokens=20000, status_callback=None, stream_writer=None):
+        """Process a user message using the most recent assistant messages that fit in max_tokens"""
+        return self.process(system_prompt, context_manager, current_user_message,
+                            BudgetedWindowPolicy("assistant"), max_tokens, status_callback, stream_writer)
+    
+    def process_with_context_of_user(self, system_prompt, context_manager, current_user_message, 
+                                     max_tokens=20000, status_callback=None, stream_writer=None):
+        """Process a user message using the most recent user messages that fit in max_tokens"""
+        return self.process(system_prompt, context_manager, current_user_message,
+                            BudgetedWindowPolicy("user"), max_tokens, status_callback, stream_writer)
+    
+    def process_with_latest_context(self, system_prompt, context_manager, current_user_message,
+                                   max_tokens=20000, status_callback=None, stream_writer=None):
+        """Process a user message using the most recent user-assistant pair, trimmed to max_tokens"""
+        return self.process(system_prompt, context_manager, current_user_message,
+                            LatestPairPolicy(), max_tokens, status_callback, stream_writer)
@@ -0,0 +1,124 @@
+import importlib
+import json
+import math
+import threading
+import time
+
+class JsonLinesSink:
+    """Append every event as one JSON object per line"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, event):
+        self._file.write(json.dumps(event, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def load_sink(spec):
+    """Create a sink from 'package.module:factory'
+
+    The factory is called without arguments and must return an object with
+    write(event) and, optionally, close() methods. This is how events are
+    shipped to an external metrics system without changing this code.
+    """
+    module_name, _, attribute = spec.partition(':')
+    if not attribute:
+        raise ValueError(f"Metrics sink '{spec}' must look like 'package.module:factory'")
+    factory = getattr(importlib.import_module(module_name), attribute)
+    return factory()
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (None for an empty list)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+class MetricsRecorder:
+    """Collects per-chunk events, forwards them to sinks and aggregates a run summary.
+
+    Every event is a flat dict with at least `event` and `time` keys. Sinks
+    receive events as they happen; summary() aggregates the chunk events
+    recorded so far.
+    """
+    SUMMED_FIELDS = ('retries', 'revalidations', 'prompt_tokens', 'completion_tokens', 'cached_tokens',
+                     'bytes_written', 'queue_time', 'throttle_wait')
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.chunk_events = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, event_type, **fields):
+        event = {"event": event_type, "time": time.time()}
+        event.update(fields)
+        with self._lock:
+            if event_type == "chunk":
+                self.chunk_events.append(event)
+            for sink in self.sinks:
+                sink.write(event)
+        return event
+
+    def summary(self, document=None):
+        """Aggregate chunk events, optionally only those of one document"""
+        with self._lock:
+            events = [e for e in self.chunk_events if document is None or e.get("document") == document]
+        latencies = [e["latency"] for e in events if e.get("latency") is not None]
+        ttfbs = [e["ttfb"] for e in events if e.get("ttfb") is not None]
+
+        summary = {
+            "chunks": len(events),
+            "cache_hits": sum(1 for e in events if e.get("cache_hit")),
+            "dedup_hits": sum(1 for e in events if e.get("dedup_hit")),
+            "protected_blocks": sum(1 for e in events if e.get("protected")),
+            "failed_chunks": sum(1 for e in events if e.get("failed")),
+            "invalid_chunks": sum(1 for e in events if e.get("validation")),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_max": max(latencies) if latencies else None,
+            "ttfb_p50": percentile(ttfbs, 0.5),
+        }
+        for field in self.SUMMED_FIELDS:
+            summary[field] = sum(e.get(field) or 0 for e in events)
+        return summary
+
+    def close(self):
+        """Emit the run summary and close every sink"""
+        self.emit("run_summary", wall_time=time.time() - self.started, **self.summary())
+        for sink in self.sinks:
+            close = getattr(sink, 'close', None)
+            if close is not None:
+                close()
+
+def format_summary(summary):
+    """One-line human readable version of MetricsRecorder.summary()"""
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "n/a"
+    cached_share = ""
+    if summary['prompt_tokens']:
+        cached_share = f", {summary['cached_tokens'] / summary['prompt_tokens']:.0%}"
+    return (f"{summary['chunks']} chunks ({summary['cache_hits']} cached, {summary['dedup_hits']} deduplicated, "
+            f"{summary['protected_blocks']} kept local, {summary['failed_chunks']} failed, "
+            f"{summary['invalid_chunks']} invalid), {summary['retries']} retries, "
+            f"{summary['revalidations']} re-requested after validation, latency p50 {seconds(summary['latency_p50'])} / "
+            f"p95 {seconds(summary['latency_p95'])}, first byte p50 {seconds(summary['ttfb_p50'])}, "
+            f"{summary['prompt_tokens']} prompt + {summary['completion_tokens']} completion tokens "
+            f"({summary['cached_tokens']} prompt tokens cached{cached_share}), {summary['bytes_written']} bytes written, "
+            f"{summary['queue_time']:.1f}s queued, {summary['throttle_wait']:.1f}s rate limited")
+
+def create_recorder(log_path=None, sink_spec=None):
+    """Build a MetricsRecorder from the --metrics-log and --metrics-sink options"""
+    sinks = []
+    if log_path:
+        sinks.append(JsonLinesSink(log_path))
+    if sink_spec:
+        sinks.append(load_sink(sink_spec))
+    return MetricsRecorder(sinks)
@@ -0,0 +1,410 @@
+# mock_server.py
+"""A local stand-in for an OpenAI-compatible chat-completions endpoint.
+
+Used to exercise LLMClient (connection reuse, retries, ...) without a paid
+API key or network access. The reply to every request is the last user
+message echoed back unchanged. Latency, generation speed and the share of
+5xx and 429 responses can be configured to mimic a real provider, and
+prompt caching is simulated by reporting the longest previously seen
+message prefix as cached tokens.
+
+The files and batches endpoints of the batch API are served as well:
+an uploaded request file is answered line by line, with the same echo
+and injected failures, batch_delay seconds after the batch is created.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.record_connection()
+
+    def log_message(self, format, *args):
+        # Keep the console quiet; the client already reports every request
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        """Write one piece of a chunked transfer-encoded body"""
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_stream(self, model, content, usage=None, finish_reason="stop"):
+        """Send content as server-sent events, one word per delta"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        delay = self.server.token_delay()
+        pieces = content.split(" ")
+        for i, piece in enumerate(pieces):
+            if delay:
+                time.sleep(delay)
+            # The deltas add up to exactly the content, as with a non-streamed reply
+            self._send_event(model, {"content": piece if i == len(pieces) - 1 else piece + " "}, None)
+        self._send_event(model, {}, finish_reason)
+        if usage is not None:
+            # Like the real API, usage arrives in a final event without choices
+            event = {"object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _send_event(self, model, delta, finish_reason):
+        event = {
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+        if len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.server.get_batch(parts[-1])
+            if batch is not None:
+                self._send_json(200, batch)
+                return
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+            data = self.server.files.get(parts[-2])
+            if data is not None:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/jsonl")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/files"):
+            self._upload_file(raw)
+            return
+        payload = json.loads(raw or b"{}")
+        if path.endswith("/batches"):
+            batch = self.server.create_batch(payload)
+            if batch is None:
+                self._send_json(404, {"error": {"message": f"No such file: {payload.get('input_file_id')}"}})
+            else:
+                self._send_json(200, batch)
+            return
+        self.server.record_request(payload)
+
+        if not path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        # Time before the first byte, then the injected failures
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        failure = self.server.pick_failure()
+        if failure == 429:
+            headers = {}
+            if self.server.retry_after is not None:
+                headers["Retry-After"] = str(self.server.retry_after)
+            self._send_json(429, {"error": {"message": "Rate limit reached"}}, headers)
+            return
+        if failure == 500:
+            self._send_json(500, {"error": {"message": "Injected server error"}})
+            return
+
+        if payload.get("stream"):
+            content, usage, finish_reason = self.server.reply(payload)
+            include_usage = (payload.get("stream_options") or {}).get("include_usage")
+            self._send_stream(payload.get("model"), content, usage if include_usage else None, finish_reason)
+            return
+        completion = self.server.completion(payload)
+        delay = self.server.token_delay()
+        if delay:
+            # Without streaming the whole completion is generated before replying
+            time.sleep(delay * completion["usage"]["completion_tokens"])
+        self._send_json(200, completion)
+
+    def _upload_file(self, raw):
+        """Store the file part of a multipart upload"""
+        boundary = self.headers.get("Content-Type", "").partition("boundary=")[2].strip('"')
+        for part in raw.split(b"--" + boundary.encode()):
+            head, _, data = part.partition(b"\r\n\r\n")
+            if b'name="file"' in head:
+                file = self.server.add_file(data[:-2] if data.endswith(b"\r\n") else data)
+                self._send_json(200, file)
+                return
+        self._send_json(400, {"error": {"message": "No file in the upload"}})
+
+class MockChatServer(ThreadingHTTPServer):
+    """Threaded mock server that counts connections and requests
+
+    Args:
+        latency: Seconds to wait before answering each request
+        tokens_per_second: Generation speed (one word is one token); None replies at once
+        error_rate: Share of requests answered with 500
+        rate_limit_rate: Share of requests answered with 429
+        retry_after: Retry-After value sent with 429 responses (None sends no header)
+        seed: Seed for the injected failures, so runs are repeatable
+        keep_requests: Keep every request payload in `requests` (disable for long benchmarks)
+        batch_delay: Seconds between the creation of a batch and its completion
+    """
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, tokens_per_second=None,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=None, seed=None, keep_requests=True,
+                 batch_delay=0.0):
+        super().__init__((host, port), MockChatHandler)
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.request_count = 0
+        self.status_counts = {200: 0, 429: 0, 500: 0}
+        self._thread = None
+
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.keep_requests = keep_requests
+        self._random = random.Random(seed)
+        
+        # Digests of every message prefix seen so far, for simulated prompt caching
+        self._prefixes = set()
+
+        # Uploaded and generated files by id, and batches by id
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+    
+    def reply(self, payload):
+        """Return (content, usage, finish_reason) for a chat-completions request: the last user message echoed
+
+        Like a real model, the reply is cut off after max_tokens words with finish_reason "length".
+        """
+        user_messages = [m for m in payload.get("messages", []) if m.get("role") == "user"]
+        content = user_messages[-1]["content"] if user_messages else ""
+        finish_reason = "stop"
+        max_tokens = payload.get("max_tokens")
+        if max_tokens is not None and len(content.split()) > max_tokens:
+            content = " ".join(content.split()[:max_tokens])
+            finish_reason = "length"
+        return content, self.usage(payload, content), finish_reason
+    
+    def completion(self, payload):
+        """Return the non-streamed chat.completion answer to payload"""
+        content, usage, finish_reason = self.reply(payload)
+        return {
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        }
+    
+    def usage(self, payload, content):
+        """Rough usage block counting whitespace separated words as tokens"""
+        messages = payload.get("messages", [])
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+        completion_tokens = len(content.split())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_prefix_tokens(messages)},
+        }
+    
+    def add_file(self, data):
+        """Store a file and return its file object"""
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with self._lock:
+            self.files[file_id] = data
+        return {"id": file_id, "object": "file", "bytes": len(data), "purpose": "batch",
+                "created_at": int(time.time())}
+    
+    def create_batch(self, payload):
+        """Start a batch over an uploaded file and return it, or None if the file is unknown"""
+        data = self.files.get(payload.get("input_file_id"))
+        if data is None:
+            return None
+        lines = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": payload.get("endpoint"),
+            "input_file_id": payload.get("input_file_id"),
+            "completion_window": payload.get("completion_window"),
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            "metadata": payload.get("metadata"),
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._run_batch, args=(batch["id"], lines), daemon=True).start()
+        return dict(batch)
+    
+    def get_batch(self, batch_id):
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            return None if batch is None else dict(batch)
+    
+    def _run_batch(self, batch_id, lines):
+        """Answer every line of a batch after batch_delay, failed ones going to the error file"""
+        time.sleep(self.batch_delay)
+        output = []
+        errors = []
+        for line in lines:
+            self.record_request(line["body"])
+            failure = self.pick_failure()
+            record = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": line["custom_id"], "error": None}
+            if failure is None:
+                record["response"] = {"status_code": 200, "body": self.completion(line["body"])}
+                output.append(record)
+            else:
+                message = "Rate limit reached" if failure == 429 else "Injected server error"
+                record["response"] = {"status_code": failure, "body": {"error": {"message": message}}}
+                errors.append(record)
+        
+        def to_file(records):
+            if not records:
+                return None
+            data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            return self.add_file(data.encode("utf-8"))["id"]
+        
+        output_file_id = to_file(output)
+        error_file_id = to_file(errors)
+        with self._lock:
+            self.batches[batch_id].update(
+                status="completed",
+                output_file_id=output_file_id,
+                error_file_id=error_file_id,
+                completed_at=int(time.time()),
+                request_counts={"total": len(lines), "completed": len(output), "failed": len(errors)},
+            )
+    
+    def cached_prefix_tokens(self, messages):
+        """Return the tokens of the longest prefix of messages (before the last one) seen before"""
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages[:-1]:
+            digest.update(json.dumps(message, sort_keys=True).encode())
+            keys.append((digest.hexdigest(), len(str(message.get("content", "")).split())))
+        
+        cached = tokens = 0
+        with self._lock:
+            if len(self._prefixes) > 100000:
+                self._prefixes.clear()
+            for key, message_tokens in keys:
+                tokens += message_tokens
+                if key in self._prefixes:
+                    cached = tokens
+                self._prefixes.add(key)
+        return cached
+
+    def token_delay(self):
+        """Seconds per generated token, or 0 when generation is instant"""
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+
+    def pick_failure(self):
+        """Return 429, 500 or None (success) according to the configured rates"""
+        with self._lock:
+            roll = self._random.random()
+            if roll < self.rate_limit_rate:
+                status = 429
+            elif roll < self.rate_limit_rate + self.error_rate:
+                status = 500
+            else:
+                status = 200
+            self.status_counts[status] += 1
+        return None if status == 200 else status
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record_request(self, payload):
+        with self._lock:
+            self.request_count += 1
+            if self.keep_requests:
+                self.requests.append(payload)
+
+    def start(self):
+        """Serve from a background thread and return self"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock chat-completions server")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte of every response")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Simulated generation speed (default: instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the injected failures")
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="Seconds before a submitted batch is completed")
+
+    args = parser.parse_args()
+
+    server = MockChatServer(args.host, args.port,
+                            latency=args.latency,
+                            tokens_per_second=args.tokens_per_second,
+                            error_rate=args.error_rate,
+                            rate_limit_rate=args.rate_limit_rate,
+                            retry_after=args.retry_after,
+                            seed=args.seed,
+                            keep_requests=False,
+                            batch_delay=args.batch_delay)
+    print(f"Mock server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import threading
+
+def atomic_write(path, text, fsync=False):
+    """Write text to path through a temporary file and a rename
+
+    Readers see either the old file or the complete new one, never a
+    partial write. With fsync the data is on disk before the rename.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _fsync_directory(path):
+    """Make a rename in path durable; not every platform can open a directory"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class ChunkStreamWriter:
+    """Collects the streamed tokens of one chunk in a temporary file beside its chunk file.
+
+    Tokens are written through Python's buffer rather than flushed one by
+    one. close() renames the finished file into place; if the stream
+    breaks, discard() removes the partial file, so the retried response
+    starts from a clean slate and no chunk file ever holds half a response.
+    """
+    def __init__(self, chunk_path):
+        self.chunk_path = chunk_path
+        self.partial_path = chunk_path + '.part'
+        self.written = False
+        self._chunk_file = None
+
+    def write(self, text):
+        if self._chunk_file is None:
+            self._chunk_file = open(self.partial_path, 'w', encoding='utf-8')
+        self._chunk_file.write(text)
+        self.written = True
+
+    def discard(self):
+        if self._chunk_file is not None:
+            self._chunk_file.close()
+            self._chunk_file = None
+            os.remove(self.partial_path)
+        self.written = False
+
+    def close(self):
+        if self._chunk_file is not None:
+            self._chunk_file.close()
+            self._chunk_file = None
+            os.replace(self.partial_path, self.chunk_path)
+
+class ChunkFileWriter:
+    """Writes every chunk to its own file and builds the document from them at the end.
+
+    Each chunk file is written atomically (temporary file plus rename), so
+    a chunk is either complete or absent. finish() concatenates the chunk
+    files of this run in order, separated by blank lines, into a temporary
+    output file that is fsynced once and renamed over output_path.
+    """
+    def __init__(self, output_path, tmp_folder):
+        self.output_path = output_path
+        self.tmp_folder = tmp_folder
+        self.indices = []
+
+    def chunk_path(self, index):
+        return os.path.join(self.tmp_folder, f"chunk_{index:04d}.txt")
+
+    def stream_writer(self, index):
+        """Return a writer for the streamed tokens of chunk index"""
+        return ChunkStreamWriter(self.chunk_path(index))
+
+    def write_chunk(self, index, text, stream_writer=None):
+        """Save a finished chunk; content already streamed to disk is not written again"""
+        if stream_writer is not None and stream_writer.written:
+            stream_writer.close()
+        else:
+            atomic_write(self.chunk_path(index), text)
+        self.indices.append(index)
+
+    def finish(self):
+        """Assemble the output document from the chunk files and make it durable"""
+        tmp_path = f"{self.output_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as output_file:
+                for index in self.indices:
+                    with open(self.chunk_path(index), 'rb') as chunk_file:
+                        shutil.copyfileobj(chunk_file, output_file)
+                    output_file.write(b"\n\n")
+                output_file.flush()
+                os.fsync(output_file.fileno())
+            os.replace(tmp_path, self.output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _fsync_directory(os.path.dirname(os.path.abspath(self.output_path)))
+
+    def describe(self):
+        return f"Individual chunks saved in {self.tmp_folder}"
+
+class BufferedOutputWriter:
+    """Keeps every chunk in memory and writes the document once, for small documents.
+
+    No chunk files are written and streamed tokens are not put on disk;
+    finish() writes the output atomically with a single fsync.
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.parts = []
+
+    def stream_writer(self, index):
+        return None
+
+    def write_chunk(self, index, text, stream_writer=None):
+        self.parts.append(text)
+
+    def finish(self):
+        atomic_write(self.output_path, ''.join(part + "\n\n" for part in self.parts), fsync=True)
+        _fsync_directory(os.path.dirname(os.path.abspath(self.output_path)))
+
+    def describe(self):
+        return "Chunks were buffered in memory"
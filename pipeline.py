@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+from document_processor import DocumentProcessor
+from document_translator import DocumentTranslator
+from response_cache import ResponseCache
+from metrics import create_recorder
+
+class FormatTranslatePipeline:
+    """Format and translate a document in one pass.
+
+    Every chunk that DocumentProcessor finishes is handed to DocumentTranslator
+    through a bounded queue, so translating chunk 1 overlaps with formatting
+    chunk 2 instead of waiting for the whole formatted document. The
+    formatted chunks are passed on unchanged rather than re-split.
+
+    The formatted text is still written to `formatted_path` as a checkpoint
+    for manual review; with checkpoint=False it goes to a temporary file
+    that is removed once the run is complete.
+    """
+    _END = object()
+
+    def __init__(self, input_path, output_path, base_url, process_prompt_path, translate_prompt_path,
+                 api_key, model="gpt-4o-mini", translate_model=None, formatted_path=None,
+                 checkpoint=True, queue_size=2, **options):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.base_url = base_url
+        self.process_prompt_path = process_prompt_path
+        self.translate_prompt_path = translate_prompt_path
+        self.api_key = api_key
+        self.model = model
+        self.translate_model = translate_model or model
+        self.checkpoint = checkpoint
+        self.queue_size = max(1, int(queue_size))
+        self.options = options
+
+        output_dir = os.path.dirname(output_path)
+        if formatted_path is None:
+            formatted_path = os.path.join(output_dir, "formatted.md")
+        if not checkpoint:
+            formatted_path = os.path.join(output_dir, ".formatted.partial.md")
+        self.formatted_path = formatted_path
+
+    def _put(self, chunk_queue, item, translator_thread):
+        """Put item on the queue without blocking forever if the translator has died"""
+        while True:
+            try:
+                chunk_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not translator_thread.is_alive():
+                    raise RuntimeError("Translation stage stopped before formatting finished")
+
+    def run(self):
+        """Run both stages and return their summaries"""
+        started = time.monotonic()
+        options = dict(self.options)
+
+        # Both stages share one cache so that their index updates do not race
+        if options.pop("use_cache", True) and options.get("response_cache") is None:
+            cache_dir = options.pop("cache_dir", None) or os.path.join(os.path.dirname(self.output_path), '.cache')
+            cache_max_mb = options.pop("cache_max_mb", 512)
+            options["response_cache"] = ResponseCache(cache_dir, max_bytes=int(cache_max_mb * 1024 * 1024))
+        else:
+            options["use_cache"] = False
+
+        # Both stages write to one event log, tagged "format" and "translate"
+        metrics = options.get("metrics")
+        if metrics is None:
+            metrics = create_recorder(options.pop("metrics_log", None), options.pop("metrics_sink", None))
+            options["metrics"] = metrics
+
+        chunk_queue = queue.Queue(maxsize=self.queue_size)
+        translator = DocumentTranslator(
+            self.formatted_path,
+            self.output_path,
+            self.base_url,
+            self.translate_prompt_path,
+            self.api_key,
+            self.translate_model,
+            log_prefix="translate",
+            **options
+        )
+
+        summaries = {}
+        errors = []
+
+        def translate():
+            try:
+                summaries["translate"] = translator.run(chunks=iter(chunk_queue.get, self._END))
+            except Exception as e:
+                errors.append(e)
+
+        translator_thread = threading.Thread(target=translate, daemon=True)
+        translator_thread.start()
+
+        processor = DocumentProcessor(
+            self.input_path,
+            self.formatted_path,
+            self.base_url,
+            self.process_prompt_path,
+            self.api_key,
+            self.model,
+            log_prefix="format",
+            on_chunk=lambda i, response: self._put(chunk_queue, response, translator_thread),
+            **options
+        )
+
+        try:
+            try:
+                summaries["format"] = processor.run()
+            finally:
+                # Always let the translator finish what it already received
+                if translator_thread.is_alive():
+                    self._put(chunk_queue, self._END, translator_thread)
+                translator_thread.join()
+        except Exception as e:
+            # A translator that died shows up in the formatter as a queue nobody reads;
+            # its own error is the one worth reporting
+            if errors:
+                raise errors[0] from e
+            raise
+        finally:
+            if self.options.get("metrics") is None:
+                metrics.close()
+
+        if errors:
+            raise errors[0]
+
+        if not self.checkpoint and os.path.exists(self.formatted_path):
+            os.remove(self.formatted_path)
+
+        summaries["wall_time"] = time.monotonic() - started
+        serial_time = summaries["format"]["wall_time"] + summaries["translate"]["wall_time"]
+        print(f"Pipeline complete in {summaries['wall_time']:.1f}s "
+              f"(formatting {summaries['format']['wall_time']:.1f}s and translation "
+              f"{summaries['translate']['wall_time']:.1f}s overlapped, {serial_time:.1f}s if run back to back)")
+        if self.checkpoint:
+            print(f"Formatted checkpoint saved to {self.formatted_path}")
+        print(f"Translation saved to {self.output_path}")
+        return summaries
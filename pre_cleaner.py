@@ -0,0 +1,360 @@
+import re
+from protected_blocks import BlockClassifier
+
+class PreCleaner:
+    """Makes the formatter's mechanical fixes locally, before a document is split.
+
+    Fixes (counted in `stats`):
+        headers: page numbers repeating through the document, and the page
+            headers and footers repeating next to them, are removed
+        hyphens: words hyphenated at a line break are joined again
+        headings: numbered headings get the level of their section number
+            (1 -> ##, 1.1 -> ###, 1.1.1 -> ####)
+        line_numbers: line numbers are stripped from code listings; a
+            numbered listing OCR'd into one line is unfolded into a code block
+
+    needs_llm() then tells what in a chunk is still left for the LLM to
+    repair; a chunk without anything is kept as it is, without a request.
+
+    Repeated lines are only known once the whole document was seen, so
+    every paragraph goes through scan() before clean_paragraphs(). Both
+    passes only keep counters, so a large input can still be read lazily.
+
+    Args:
+        min_repeats: Page breaks a line must repeat at to be taken for a header or footer
+        page_chars: Characters between two occurrences of a line for them to be on different pages
+    """
+    # Headers and footers are short lines that are not Markdown blocks
+    MAX_HEADER_CHARS = 80
+    MARKUP_RE = re.compile(r'^(?:#|>|\||\$|!?\[|`|~|[-*+]\s|\d+[.)]\s)')
+    PAGE_NUMBER_RE = re.compile(r'^(?:page\s*)?[-–—]?\s*#\s*[-–—]?(?:\s*(?:/|of)\s*#)?$')
+    NUMBER_RE = re.compile(r'\d+')
+
+    HEADING_RE = re.compile(r'^(#{1,6})(\s+)((?:\d{1,2}|[A-Z](?=\.\d))(?:\.\d{1,2})*)(\.?\s+\S.*)$')
+    HYPHEN_RE = re.compile(r'([A-Za-z]+)-$')
+    WORD_START_RE = re.compile(r'^([a-z]+)([,.;:]?)[ \t]*')
+    # Hyphenated words seen whole, such as "well-known", keep their hyphen when broken at a line end
+    COMPOUND_RE = re.compile(r'\b[A-Za-z]+-[a-z]+\b')
+    # A line number stands between whitespace; numbers in the code do not continue the count
+    LINE_NUMBER_RE = re.compile(r'(?:^|(?<=\s))(\d{1,4})(?=\s|$)')
+    LEADING_NUMBER_RE = re.compile(r'^\s*(\d{1,4})(?:\s|$)')
+    CODE_CHARS_RE = re.compile(r'[;{}=()<>]')
+    MIN_NUMBERED_LINES = 4
+
+    # Signs of work left for the LLM, see needs_llm()
+    GARBLED_RE = re.compile(r'[\ufffd\ufb00-\ufb06\ue000-\uf8ff\x00-\x08\x0b\x0c\x0e-\x1f]|\u00c3[\x80-\xbf]|\u00e2\u20ac')
+    MATH_CHAR_RE = re.compile(r'[\u0370-\u03ff\u02c6\u02dc\u2070-\u209f\u2190-\u21ff\u2200-\u22ff'
+                              r'\u27c0-\u27ef\u2980-\u2aff\U0001d400-\U0001d7ff]')
+    MATH_RE = re.compile(r'\$\$.*?\$\$|\$[^$\n]+\$|\\\(.*?\\\)|\\\[.*?\\\]', re.DOTALL)
+    CODE_LINE_RE = re.compile(r'[;{]\s*$|^\s*\}|^\s*#\s*(?:include|define|pragma|ifn?def|endif)\b')
+    BARE_HEADING_RE = re.compile(r'^\s*(?:(?:\d{1,2}(?:\.\d{1,2})*\.?|[IVX]{1,4}\.)\s+[A-Z][^.!?:;]{0,80}'
+                                 r'|[A-Z][A-Z \-]{3,60})$')
+    COLUMNS_RE = re.compile(r'\S {3,}\S.* {3,}\S')
+    SPACED_LETTERS_RE = re.compile(r'(?:^|\s)(?:[A-Za-z] ){4,}[A-Za-z](?:\s|$)')
+    LIST_OR_TABLE_RE = re.compile(r'^\s*(?:[-*+]\s|\d+[.)]\s|\|)')
+    # Chunks made of short lines are tables, formulas or lists broken by the OCR
+    SHORT_LINE_CHARS = 25
+
+    def __init__(self, min_repeats=3, page_chars=500):
+        self.min_repeats = min_repeats
+        self.page_chars = page_chars
+        # Normalized header/footer lines and the number of pages each was seen on
+        self.counts = {}
+        self.repeated = set()
+        self.compounds = set()
+        self.stats = {"headers": 0, "hyphens": 0, "headings": 0, "line_numbers": 0}
+
+    @staticmethod
+    def _fence(closing, line):
+        """Return (in_fence, closing, opened) for line, given the closing marker of the open fence (or None)"""
+        if closing is not None:
+            stripped = line.strip()
+            if stripped.startswith(closing) and not stripped.strip(closing[0]):
+                closing = None
+            return True, closing, False
+        match = BlockClassifier.FENCE_RE.match(line)
+        if match is None:
+            return False, None, False
+        return True, match.group(1), True
+
+    def _iter_lines(self, paragraphs):
+        """Yield (paragraph, lines, flags, offset); flags tell which lines belong to code fences"""
+        closing = None
+        offset = 0
+        for paragraph in paragraphs:
+            lines = paragraph.split('\n')
+            flags = []
+            for line in lines:
+                in_fence, closing, _ = self._fence(closing, line)
+                flags.append(in_fence)
+            yield paragraph, lines, flags, offset
+            offset += len(paragraph) + 2
+
+    def _is_page_number(self, line):
+        """Whether line is a bare page number ("12", "- 12 -", "Page 12 of 30"), which marks a page break"""
+        header = self._header_key(line)
+        return header is not None and bool(self.PAGE_NUMBER_RE.match(header[0]))
+
+    def _iter_breaks(self, paragraphs):
+        """Yield (paragraph, lines, flags, offset, candidates) with the header candidates of each paragraph
+
+        Whether a paragraph's edges touch a page break depends on the
+        paragraphs around it, so each one is yielded once the next
+        non-empty paragraph was read.
+        """
+        waiting = []
+        after_number = False
+        for item in self._iter_lines(paragraphs):
+            if not item[0].strip():
+                waiting.append(item)
+                continue
+            _, lines, flags, _ = item
+            before_number = not flags[0] and self._is_page_number(lines[0])
+            if waiting and waiting[0][0].strip():
+                paragraph, previous_lines, previous_flags, offset = waiting[0]
+                yield paragraph, previous_lines, previous_flags, offset, self._header_lines(
+                    previous_lines, previous_flags, after_number, before_number)
+                after_number = not previous_flags[-1] and self._is_page_number(previous_lines[-1])
+                waiting = waiting[1:]
+            for empty in waiting:
+                yield empty + ([],)
+            waiting = [item]
+        if waiting and waiting[0][0].strip():
+            paragraph, lines, flags, offset = waiting[0]
+            yield paragraph, lines, flags, offset, self._header_lines(lines, flags, after_number, False)
+            waiting = waiting[1:]
+        for empty in waiting:
+            yield empty + ([],)
+
+    def _header_lines(self, lines, flags, after_number, before_number):
+        """Indices of the lines of a paragraph that may be a page number, header or footer
+
+        Page numbers qualify at either edge of a paragraph. Other lines
+        only qualify next to one: first in a paragraph that follows a page
+        number (after_number) or starts with one, last in a paragraph that
+        precedes a page number (before_number) or ends with one. A line
+        carrying on a sentence (a word hyphenated across the line break, or
+        a footer starting in lower case) never qualifies.
+        """
+        numbers = [not in_fence and self._is_page_number(line) for line, in_fence in zip(lines, flags)]
+        last = len(lines) - 1
+        candidates = set(i for i in (0, last) if numbers[i])
+        # The first line of a page, after the page number of the previous one
+        first = 1 if numbers[0] and last >= 1 else 0
+        if (not flags[first] and not numbers[first] and (first == 1 or after_number)
+                and not lines[first].rstrip().endswith('-')):
+            candidates.add(first)
+        # The last line of a page, before its page number
+        end = last - 1 if numbers[last] and last >= 1 else last
+        text = lines[end].lstrip()
+        if (not flags[end] and not numbers[end] and (end < last or before_number) and text[:1]
+                and not text[0].islower() and not (end > 0 and lines[end - 1].rstrip().endswith('-'))):
+            candidates.add(end)
+        return sorted(candidates)
+
+    def _header_key(self, line):
+        """Return (key, last number) if line could be a page header or footer, else None
+
+        Digits are replaced so that "Page 3" and "Page 4" share a key. A
+        line must hold a letter unless it looks like a bare page number,
+        which keeps equation numbers and table cells out.
+        """
+        line = line.strip()
+        if not line or len(line) > self.MAX_HEADER_CHARS:
+            return None
+        key = self.NUMBER_RE.sub('#', ' '.join(line.lower().split()))
+        # "- 3 -" is a page number, not a list item
+        if not self.PAGE_NUMBER_RE.match(key):
+            if self.MARKUP_RE.match(line) or not any(c.isalpha() for c in key):
+                return None
+        numbers = self.NUMBER_RE.findall(line)
+        return key, int(numbers[-1]) if numbers else None
+
+    def _on_new_page(self, pages, key, number, offset):
+        """Whether this occurrence of key is on a later page than the last one counted
+
+        Occurrences must be page_chars apart and page numbers never go
+        down. Both passes apply this same rule, so clean_paragraphs()
+        removes exactly the occurrences scan() counted.
+        """
+        last = pages.get(key)
+        if last is not None:
+            last_offset, last_number = last
+            if offset - last_offset < self.page_chars:
+                return False
+            if number is not None and last_number is not None and number < last_number:
+                return False
+        pages[key] = (offset, number)
+        return True
+
+    def scan(self, paragraphs):
+        """First pass: find the lines repeating at min_repeats page breaks or more"""
+        self.counts = {}
+        self.compounds = set()
+        pages = {}
+        for _, lines, flags, offset, candidates in self._iter_breaks(paragraphs):
+            for line, in_fence in zip(lines, flags):
+                if not in_fence and '-' in line:
+                    self.compounds.update(word.lower() for word in self.COMPOUND_RE.findall(line))
+            for i in candidates:
+                header = self._header_key(lines[i])
+                if header is not None and self._on_new_page(pages, header[0], header[1], offset):
+                    self.counts[header[0]] = self.counts.get(header[0], 0) + 1
+        self.repeated = {key for key, count in self.counts.items() if count >= self.min_repeats}
+
+    def clean_paragraphs(self, paragraphs):
+        """Second pass: yield the paragraphs with the mechanical fixes made
+
+        Paragraphs left empty once their headers are removed (e.g. a page
+        number on its own) are dropped. The first line of the document with
+        a header's key is always kept: it is often the paper's title, and
+        otherwise it keeps the first of a series of numbered lines safe.
+        """
+        pages = {}
+        seen = set()
+        for paragraph, lines, flags, offset, candidates in self._iter_breaks(paragraphs):
+            if not paragraph.strip():
+                yield paragraph
+                continue
+            kept = []
+            for i, (line, in_fence) in enumerate(zip(lines, flags)):
+                header = self._header_key(line) if not in_fence else None
+                if (i in candidates and header is not None and header[0] in self.repeated
+                        and self._on_new_page(pages, header[0], header[1], offset) and header[0] in seen):
+                    self.stats["headers"] += 1
+                    continue
+                if header is not None:
+                    seen.add(header[0])
+                kept.append((line, in_fence))
+            if any(line.strip() for line, _ in kept):
+                yield self._clean_lines(kept)
+
+    def _clean_lines(self, lines):
+        """Fix one paragraph given as (line, in_fence) pairs"""
+        if len(lines) == 1 and not lines[0][1]:
+            unfolded = self._unfold_listing(lines[0][0])
+            if unfolded is not None:
+                return unfolded
+
+        flags = [in_fence for _, in_fence in lines]
+        result = []
+        fence = []
+        for line, in_fence in lines:
+            if in_fence:
+                fence.append(line)
+                continue
+            if fence:
+                result.extend(self._strip_line_numbers(fence))
+                fence = []
+            result.append(self._fix_heading(line))
+        if fence:
+            result.extend(self._strip_line_numbers(fence))
+        return '\n'.join(self._join_hyphens(result, flags))
+
+    def _fix_heading(self, line):
+        """Give a numbered heading the level of its section number"""
+        match = self.HEADING_RE.match(line)
+        if match is None:
+            return line
+        level = min(6, len(match.group(3).split('.')) + 1)
+        if len(match.group(1)) == level:
+            return line
+        self.stats["headings"] += 1
+        return '#' * level + match.group(2) + match.group(3) + match.group(4)
+
+    def _join_hyphens(self, lines, flags):
+        """Move the end of a word hyphenated at a line break up to its start"""
+        lines = list(lines)
+        emptied = set()
+        for i in range(len(lines) - 1):
+            start = self.HYPHEN_RE.search(lines[i])
+            if flags[i] or flags[i + 1] or start is None:
+                continue
+            match = self.WORD_START_RE.match(lines[i + 1])
+            if match is None:
+                continue
+            hyphen = '-' if f"{start.group(1)}-{match.group(1)}".lower() in self.compounds else ''
+            lines[i] = lines[i][:-1] + hyphen + match.group(1) + match.group(2)
+            lines[i + 1] = lines[i + 1][match.end():]
+            if not lines[i + 1]:
+                emptied.add(i + 1)
+            self.stats["hyphens"] += 1
+        # A line whose only word moved up is dropped rather than left blank
+        return [line for i, line in enumerate(lines) if i not in emptied]
+
+    def _strip_line_numbers(self, fence):
+        """Remove the line numbers of a fenced listing if every line of it has the next number"""
+        body = [i for i, line in enumerate(fence) if not BlockClassifier.FENCE_RE.match(line)]
+        numbers = [self.LEADING_NUMBER_RE.match(fence[i]) for i in body]
+        if len(body) < self.MIN_NUMBERED_LINES or not all(numbers):
+            return fence
+        values = [int(match.group(1)) for match in numbers]
+        if any(b != a + 1 for a, b in zip(values, values[1:])):
+            return fence
+        fence = list(fence)
+        for i, match in zip(body, numbers):
+            # The number and the space after it; the rest is the code's own indentation
+            fence[i] = fence[i][match.end(1) + 1:]
+        self.stats["line_numbers"] += len(body)
+        return fence
+
+    def _unfold_listing(self, line):
+        """Unfold a numbered listing OCR'd into one line ("1 a;  2 b;  3 }") into a code block
+
+        The numbers must start the line and count up by one, and most lines
+        must look like code, so that a table of contents is left alone.
+        Returns None if line is not such a listing.
+        """
+        cuts = []
+        for match in self.LINE_NUMBER_RE.finditer(line):
+            if not cuts:
+                if line[:match.start()].strip():
+                    return None
+                cuts.append(match)
+            elif int(match.group(1)) == int(cuts[-1].group(1)) + 1:
+                cuts.append(match)
+        if len(cuts) < self.MIN_NUMBERED_LINES:
+            return None
+        ends = [match.start() for match in cuts[1:]] + [len(line)]
+        code = [line[match.end():end].strip() for match, end in zip(cuts, ends)]
+        filled = [text for text in code if text]
+        if sum(1 for text in filled if self.CODE_CHARS_RE.search(text)) * 2 < len(filled):
+            return None
+        self.stats["line_numbers"] += len(code)
+        # The language and indentation are left to the LLM
+        return '\n'.join(['```'] + code + ['```'])
+
+    def needs_llm(self, text):
+        """Return what is left for the LLM to repair in text, an empty list if nothing"""
+        reasons = set()
+        code_lines = 0
+        closing = None
+        for line in text.split('\n'):
+            in_fence, closing, opened = self._fence(closing, line)
+            if opened and not line.strip().strip(line.strip()[0]):
+                reasons.add("code block without a language")
+            if not in_fence and self.CODE_LINE_RE.search(line):
+                code_lines += 1
+        if closing is not None or text.count('$$') % 2:
+            reasons.add("unbalanced code fence or $$")
+        if code_lines >= 2:
+            reasons.add("code outside a code block")
+
+        for _, lines, flags, _ in self._iter_lines(text.split('\n\n')):
+            prose = [line for line, in_fence in zip(lines, flags) if not in_fence]
+            if len(lines) == 1 and prose and self.BARE_HEADING_RE.match(prose[0]):
+                reasons.add("heading without Markdown markup")
+            body = [line.strip() for line in prose if line.strip() and not self.LIST_OR_TABLE_RE.match(line)]
+            if len(body) >= 4 and sorted(map(len, body))[len(body) // 2] < self.SHORT_LINE_CHARS:
+                reasons.add("broken lines")
+            if any(self.COLUMNS_RE.search(line) for line in prose):
+                reasons.add("text in columns")
+
+        outside_math = self.MATH_RE.sub(' ', text)
+        if self.GARBLED_RE.search(text):
+            reasons.add("garbled characters")
+        if self.MATH_CHAR_RE.search(outside_math):
+            reasons.add("math outside $...$")
+        if self.SPACED_LETTERS_RE.search(outside_math):
+            reasons.add("letter-spaced words")
+        return sorted(reasons)
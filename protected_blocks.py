@@ -0,0 +1,171 @@
+import re
+
+class ProtectedBlock(str):
+    """Paragraphs that are not sent to the LLM; kind says why.
+
+    Behaves like a str holding the paragraphs joined by blank lines. It
+    keeps its place in the chunk sequence, so the local result is written
+    between the LLM results exactly where the block was in the input.
+    """
+    def __new__(cls, text, kind):
+        block = super().__new__(cls, text)
+        block.kind = kind
+        return block
+
+class BlockClassifier:
+    """Tells, paragraph by paragraph, which ones belong to a block that needs no LLM.
+
+    Kinds:
+        references: everything after a References / Bibliography heading,
+            up to the next other heading
+        code: fenced code blocks
+        math: display math between $$ (or \\[ and \\]) lines
+        links: paragraphs made only of URLs, links and images
+
+    The classifier keeps state between calls, so a code block or the
+    reference list may span many paragraphs, or several chunks of a
+    previous stage. A block opened inside a paragraph that also holds
+    ordinary text is left to the LLM as a whole.
+
+    Args:
+        kinds: Kinds to detect; other blocks are reported as None
+    """
+    KINDS = ("references", "code", "math", "links")
+
+    HEADING_RE = re.compile(r'^\s{0,3}#{1,6}\s')
+    REFERENCES_RE = re.compile(
+        r'^\s{0,3}(?:#{1,6}\s+)?(?:\*\*|__)?\s*(?:[\dIVX]+\.?\s+)?'
+        r'(?:references|bibliography|works cited|literature cited|参考文献)'
+        r'\s*:?\s*(?:\*\*|__)?\s*$', re.IGNORECASE)
+    FENCE_RE = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+    MATH_OPEN_RE = re.compile(r'^\s*(\$\$|\\\[)')
+    LINK_LINE_RE = re.compile(
+        r'^\s*(?:[-*]\s+)?(?:<?https?://\S+>?|!?\[[^\]]*\]\([^)\s]+\)|doi:\S+)\s*$', re.IGNORECASE)
+
+    def __init__(self, kinds=KINDS):
+        unknown = set(kinds) - set(self.KINDS)
+        if unknown:
+            raise ValueError(f"Unknown block kinds: {', '.join(sorted(unknown))}")
+        self.kinds = set(kinds)
+        self.in_references = False
+        # Closing marker of the code fence or display math still open, and the
+        # kind reported for it (None when it was opened inside ordinary text)
+        self.closing = None
+        self.open_kind = None
+        self.previous_kind = None
+
+    def _open(self, line):
+        """If line opens a code fence or display math, remember how it closes and return its kind"""
+        match = self.FENCE_RE.match(line)
+        if match:
+            self.closing = match.group(1)
+            return "code"
+        match = self.MATH_OPEN_RE.match(line)
+        if match:
+            closing = '$$' if match.group(1) == '$$' else '\\]'
+            # One-line display math such as $$x = y$$ closes right away
+            if not line.strip()[len(match.group(1)):].endswith(closing):
+                self.closing = closing
+            return "math"
+        return None
+
+    def _closes(self, line):
+        stripped = line.strip()
+        if self.closing[0] in '`~':
+            marker = re.fullmatch(r'\s{0,3}(`{3,}|~{3,})\s*', line)
+            return (marker is not None and marker.group(1)[0] == self.closing[0]
+                    and len(marker.group(1)) >= len(self.closing))
+        return stripped.endswith(self.closing)
+
+    def _track(self, lines):
+        """Follow blocks opened and closed by lines; return the index of the line closing the block open before them"""
+        closed_at = None
+        for i, line in enumerate(lines):
+            if self.closing is not None:
+                if self._closes(line):
+                    self.closing = None
+                    if closed_at is None:
+                        closed_at = i
+            else:
+                self._open(line)
+        return closed_at
+
+    def classify(self, paragraph):
+        """Return the kind of block paragraph belongs to, or None if it goes to the LLM"""
+        # Blank paragraphs stay with whatever surrounds them
+        if not paragraph.strip():
+            return self.previous_kind
+
+        lines = paragraph.strip('\n').split('\n')
+        if self.closing is not None:
+            # Inside a block opened by an earlier paragraph
+            kind = self.open_kind
+            self._track(lines)
+        else:
+            kind = self._classify_start(lines)
+        if self.closing is None:
+            self.open_kind = None
+        self.previous_kind = kind
+        return kind
+
+    def _classify_start(self, lines):
+        first_line = lines[0]
+        self.open_kind = None
+        if self.REFERENCES_RE.match(first_line):
+            # The heading itself is translated; the entries after it are not
+            self.in_references = True
+            self._track(lines[1:])
+            return None
+        if self.HEADING_RE.match(first_line):
+            self.in_references = False
+            self._track(lines)
+            return None
+        if self.in_references and "references" in self.kinds:
+            self._track(lines)
+            return "references"
+
+        kind = self._open(first_line)
+        if kind is not None:
+            if self.closing is None:
+                closed_at = 0
+            else:
+                closed_at = self._track(lines[1:])
+                if closed_at is not None:
+                    closed_at += 1
+            # Only a paragraph holding nothing but the block is kept away from the LLM
+            if kind in self.kinds and (closed_at is None or closed_at == len(lines) - 1):
+                self.open_kind = kind
+                return kind
+            return None
+
+        self._track(lines)
+        non_empty = [line for line in lines if line.strip()]
+        if "links" in self.kinds and all(self.LINK_LINE_RE.match(line) for line in non_empty):
+            return "links"
+        return None
+
+# A line that starts a new entry: [12], 12. or a list bullet
+_ENTRY_START_RE = re.compile(r'^\s*(?:\[\d+\]|\d+\.\s|[-*]\s)')
+_HYPHENATED_RE = re.compile(r'(\w)-\n\s*([a-z])')
+
+def format_references(text):
+    """Light local cleanup of a reference list, instead of an LLM request
+
+    Lines broken by the OCR inside an entry are joined (undoing end-of-line
+    hyphenation), runs of spaces are collapsed, and entries that start on
+    their own line ([1], 1. or a bullet) become separate paragraphs.
+    """
+    paragraphs = []
+    for paragraph in text.split('\n\n'):
+        paragraph = _HYPHENATED_RE.sub(r'\1\2', paragraph.strip())
+        entries = []
+        for line in paragraph.split('\n'):
+            line = ' '.join(line.split())
+            if not line:
+                continue
+            if entries and not _ENTRY_START_RE.match(line):
+                entries[-1] += ' ' + line
+            else:
+                entries.append(line)
+        paragraphs.extend(entries)
+    return '\n\n'.join(paragraphs)
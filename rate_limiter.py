@@ -0,0 +1,212 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate_per_minute`.
+
+    The bucket holds at most one minute worth of budget. A single request
+    larger than that is let through once the bucket is full, so it can
+    never wait forever.
+    """
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Block until amount can be taken from the bucket; return the time waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.level >= amount or self.level >= self.capacity:
+                    self.level -= amount
+                    return waited
+                wait = (min(amount, self.capacity) - self.level) / self.rate
+            wait = min(wait, 1.0)
+            time.sleep(wait)
+            waited += wait
+
+    def observe_remaining(self, remaining):
+        """Never assume more budget than the server reports as remaining"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.level, float(remaining))
+
+class AdaptiveConcurrency:
+    """Concurrency limit that adapts to congestion (additive increase, multiplicative decrease).
+
+    Every success raises the limit by 1/limit, so roughly one slot per
+    round of successful requests; every 429 or 5xx halves it. The limit
+    stays between `minimum` and `maximum`.
+    """
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            previous = int(self.limit)
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            if int(self.limit) > previous:
+                self._condition.notify_all()
+
+    def on_congestion(self):
+        with self._condition:
+            self.limit = max(float(self.minimum), self.limit / 2)
+
+class RequestScheduler:
+    """Client-side rate limiting, adaptive concurrency and retry backoff for LLMClient.
+
+    Before each attempt acquire() waits for a concurrency slot, for a
+    global pause (set from Retry-After or exhausted x-ratelimit-* headers)
+    to end, and for the optional requests/min and tokens/min buckets.
+    Retry delays use capped exponential backoff with full jitter, and are
+    never shorter than what the server asked for.
+    """
+    DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+    DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=1,
+                 initial_delay=1, max_delay=60):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self.paused_until = 0.0
+
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    @classmethod
+    def parse_duration(cls, value):
+        """Parse '1s', '6m0s', '20ms' or a plain number of seconds"""
+        if value is None:
+            return None
+        value = value.strip()
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        parts = cls.DURATION_RE.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * cls.DURATION_UNITS[unit] for amount, unit in parts)
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Parse a Retry-After header given in seconds or as an HTTP date"""
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, estimated_tokens=0):
+        """Wait until a request may be sent; return the time spent waiting"""
+        started = time.monotonic()
+        self.concurrency.acquire()
+        while True:
+            with self._lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(min(wait, 1.0))
+        if self.request_bucket is not None:
+            self.request_bucket.acquire(1)
+        if self.token_bucket is not None and estimated_tokens:
+            self.token_bucket.acquire(estimated_tokens)
+        waited = time.monotonic() - started
+        with self._lock:
+            self.wait_time += waited
+        return waited
+
+    def release(self):
+        self.concurrency.release()
+
+    def record_response(self, status, headers):
+        """Update limits from a response's status and rate-limit headers"""
+        if headers is not None:
+            for kind, bucket in (('requests', self.request_bucket), ('tokens', self.token_bucket)):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+                if bucket is not None:
+                    bucket.observe_remaining(remaining)
+                if remaining <= 0:
+                    reset = self.parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                    if reset:
+                        self._pause(reset)
+
+        if status == 429 or status >= 500:
+            self.record_failure(status == 429)
+        elif status == 200:
+            self.concurrency.on_success()
+
+    def record_failure(self, throttled=False):
+        """Shrink concurrency after a 429, a 5xx or a connection error"""
+        with self._lock:
+            if throttled:
+                self.throttled += 1
+        self.concurrency.on_congestion()
+
+    def backoff(self, retry_count, headers=None, initial_delay=None):
+        """Return the delay before retry number retry_count, pausing every request if the server asked to"""
+        if initial_delay is None:
+            initial_delay = self.initial_delay
+        delay = random.uniform(0, min(self.max_delay, initial_delay * 2 ** min(retry_count - 1, 32)))
+        if headers is not None:
+            retry_after = self.parse_retry_after(headers.get('Retry-After'))
+            if retry_after is not None:
+                # The server knows best; make every thread wait, not only this one
+                self._pause(retry_after)
+                delay = max(delay, retry_after)
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return {
+                "throttled": self.throttled,
+                "wait_time": self.wait_time,
+                "concurrency_limit": int(self.concurrency.limit),
+            }
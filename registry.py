@@ -0,0 +1,90 @@
+# registry.py
+"""Process-wide tokenizers and prompts, created once and shared.
+
+tiktoken is only imported when a tokenizer is first needed, every prompt
+file is read and measured once, and the token count travels with the
+prompt text (as a Chunk) so requests never encode it again.
+
+Run this module once while online to download tiktoken's encoding files,
+e.g. into a folder that is later used offline through TIKTOKEN_CACHE_DIR:
+
+    python registry.py --cache-dir ./tiktoken_cache
+"""
+import argparse
+import os
+import threading
+from text_splitter import Chunk
+
+DEFAULT_MODEL = "gpt-4o"
+
+_lock = threading.Lock()
+_tokenizers = {}
+_prompt_files = {}
+_prompt_texts = {}
+
+def get_tokenizer(model=DEFAULT_MODEL):
+    """Return the shared tiktoken encoding for model, loading it on first use"""
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(model)
+            if tokenizer is None:
+                import tiktoken
+                tokenizer = tiktoken.encoding_for_model(model)
+                _tokenizers[model] = tokenizer
+    return tokenizer
+
+def measure_prompt(text, model=DEFAULT_MODEL):
+    """Return text as a Chunk carrying its token count, counting each distinct prompt once"""
+    if getattr(text, "token_count", None) is not None:
+        return text
+    key = (model, text)
+    prompt = _prompt_texts.get(key)
+    if prompt is None:
+        token_count = len(get_tokenizer(model).encode(text, disallowed_special=()))
+        prompt = Chunk(text, token_count)
+        with _lock:
+            prompt = _prompt_texts.setdefault(key, prompt)
+    return prompt
+
+def load_prompt(path, model=DEFAULT_MODEL):
+    """Read a prompt file once and return it measured
+
+    The file is read again only if its size or modification time changed.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, model)
+    prompt = _prompt_files.get(key)
+    if prompt is None:
+        with open(path, 'r', encoding='utf-8') as f:
+            prompt = measure_prompt(f.read(), model)
+        with _lock:
+            _prompt_files[key] = prompt
+    return prompt
+
+def prewarm(models=(DEFAULT_MODEL,)):
+    """Load the encodings of models now, downloading their files into tiktoken's cache if needed"""
+    for model in models:
+        get_tokenizer(model)
+
+def main():
+    parser = argparse.ArgumentParser(description="Download and cache tiktoken encodings for offline use")
+    parser.add_argument("--cache-dir", default=None, help="Cache folder to fill (default: TIKTOKEN_CACHE_DIR or tiktoken's own default)")
+    parser.add_argument("--model", action="append", default=None, help=f"Model whose encoding to cache; repeatable (default: {DEFAULT_MODEL})")
+
+    args = parser.parse_args()
+
+    if args.cache_dir:
+        # tiktoken reads the variable when it loads an encoding, so set it first
+        os.makedirs(args.cache_dir, exist_ok=True)
+        os.environ["TIKTOKEN_CACHE_DIR"] = os.path.abspath(args.cache_dir)
+
+    models = args.model or [DEFAULT_MODEL]
+    prewarm(models)
+    location = os.environ.get("TIKTOKEN_CACHE_DIR", "tiktoken's default cache folder")
+    print(f"Cached encodings for {', '.join(models)} in {location}")
+    if args.cache_dir:
+        print(f"Set TIKTOKEN_CACHE_DIR={os.environ['TIKTOKEN_CACHE_DIR']} to use them offline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from output_writer import atomic_write
+
+class ResponseCache:
+    """Persistent, content-addressed cache of LLM responses.
+
+    Each entry is keyed by a SHA-256 hash of the model name and the complete
+    message list (system prompt, context messages and the chunk itself), so a
+    change to any of them results in a cache miss. Responses are stored as
+    individual files under `objects/`, and `index.json` records their size
+    and last use so that the least recently used entries can be evicted once
+    the cache grows past `max_bytes`. The index is written when entries are
+    evicted and on flush(), not on every put; objects written after the last
+    save are picked up from `objects/` when the cache is opened again.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, self.INDEX_NAME)
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.index = self._load_index()
+        self.total_bytes = sum(entry["size"] for entry in self.index.values())
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model, messages):
+        """Return the cache key for a request"""
+        material = json.dumps({"model": model, "messages": messages},
+                              sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        """Load the index, dropping entries whose object file has gone missing and adding unindexed objects"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index = {key: entry for key, entry in index.items() if os.path.isfile(self._object_path(key))}
+
+        # Objects stored since the index was last saved, e.g. by a run that was interrupted
+        for prefix in os.listdir(self.objects_dir):
+            folder = os.path.join(self.objects_dir, prefix)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                key, ext = os.path.splitext(name)
+                if ext != '.txt' or key in index:
+                    continue
+                stat = os.stat(os.path.join(folder, name))
+                index[key] = {"size": stat.st_size, "last_used": stat.st_mtime}
+        return index
+
+    def _object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key + '.txt')
+
+    def get(self, key):
+        """Return the cached response for key, or None"""
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._object_path(key), 'r', encoding='utf-8') as f:
+                    response = f.read()
+            except OSError:
+                # The object file vanished behind our back; forget it
+                self.total_bytes -= entry["size"]
+                del self.index[key]
+                self.misses += 1
+                return None
+            entry["last_used"] = time.time()
+            self.hits += 1
+            return response
+
+    def contains(self, key):
+        """Return True if a response is stored for key, without counting a hit or a miss"""
+        with self._lock:
+            return key in self.index
+
+    def put(self, key, response):
+        """Store a response and evict least recently used entries if needed"""
+        path = self._object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, response)
+        size = len(response.encode('utf-8'))
+
+        with self._lock:
+            previous = self.index.get(key)
+            if previous is not None:
+                self.total_bytes -= previous["size"]
+            self.index[key] = {"size": size, "last_used": time.time()}
+            self.total_bytes += size
+            # Removed objects must leave the index at once; new ones wait for flush()
+            if self._evict(keep=key):
+                self._save_index()
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes; return True if any were"""
+        if self.total_bytes <= self.max_bytes:
+            return False
+        evicted = False
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._object_path(key))
+            except OSError:
+                pass
+            self.total_bytes -= entry["size"]
+            del self.index[key]
+            self.evictions += 1
+            evicted = True
+        return evicted
+
+    def _save_index(self):
+        atomic_write(self.index_path, json.dumps(self.index))
+
+    def flush(self):
+        """Persist the entries stored and the last-use times recorded since the index was last saved"""
+        with self._lock:
+            self._save_index()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.index),
+                "bytes": self.total_bytes,
+            }
@@ -0,0 +1,81 @@
+import re
+
+class ResponseValidator:
+    """Cheap local checks that a response is a usable result for its chunk.
+
+    validate() returns a list of problems, empty when the response passes:
+
+    - empty responses and error messages returned in place of a result
+    - a UTF-8 size far from the source's (min_ratio / max_ratio); sizes in
+      bytes rather than characters keep the ratio near 1 across scripts
+    - code fences or $$ delimiters left unbalanced where the source's were balanced
+    - tags of the system prompt (<instruction>, <example>, ...) leaking into the result
+    - for translations, prose that is not in target_language
+
+    Args:
+        system_prompt: Prompt whose tags must not appear in responses
+        target_language: "zh" to require Chinese prose, or None to skip the check
+        min_ratio: Smallest accepted response/source size ratio
+        max_ratio: Largest accepted response/source size ratio
+        min_source_bytes: Sources smaller than this are not ratio-checked
+    """
+    ERROR_PREFIXES = ("API request failed with status", "Error occurred after", "Error: ")
+    FENCE_RE = re.compile(r'^\s{0,3}(```|~~~)', re.MULTILINE)
+    TAG_RE = re.compile(r'</?([A-Za-z][\w-]*)>')
+
+    # Text the language check ignores: code, math, links and inline code
+    NON_PROSE_RE = re.compile(r'```.*?```|~~~.*?~~~|\$\$.*?\$\$|\$[^$\n]*\$|`[^`\n]*`|https?://\S+|!?\[[^\]]*\]\([^)]*\)',
+                              re.DOTALL)
+    CJK_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+    LATIN_RE = re.compile(r'[A-Za-z]')
+    # Share of CJK among CJK and Latin letters below which a translation is not Chinese
+    MIN_CJK_SHARE = 0.1
+    # Latin letters a source needs before its translation is language-checked
+    MIN_LATIN_LETTERS = 100
+
+    def __init__(self, system_prompt="", target_language=None, min_ratio=0.3, max_ratio=3.0,
+                 min_source_bytes=200):
+        if target_language not in (None, "zh"):
+            raise ValueError(f"Unsupported target language '{target_language}'")
+        self.prompt_tags = set(self.TAG_RE.findall(str(system_prompt)))
+        self.target_language = target_language
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.min_source_bytes = min_source_bytes
+
+    def validate(self, source, response):
+        """Return the problems found in response, an empty list if there are none"""
+        if not response.strip():
+            return ["empty response"]
+        if response.startswith(self.ERROR_PREFIXES):
+            return ["error message instead of a result"]
+
+        problems = []
+        source_bytes = len(source.encode('utf-8'))
+        if source_bytes >= self.min_source_bytes:
+            ratio = len(response.encode('utf-8')) / source_bytes
+            if not self.min_ratio <= ratio <= self.max_ratio:
+                problems.append(f"response is {ratio:.2f}x the size of the source")
+
+        if len(self.FENCE_RE.findall(response)) % 2 and not len(self.FENCE_RE.findall(source)) % 2:
+            problems.append("unbalanced code fence")
+        if response.count('$$') % 2 and not source.count('$$') % 2:
+            problems.append("unbalanced $$")
+
+        leaked = (self.prompt_tags & set(self.TAG_RE.findall(response))) - set(self.TAG_RE.findall(source))
+        if leaked:
+            problems.append("prompt tags in response: " + ", ".join(sorted(leaked)))
+
+        if self.target_language == "zh" and not self._looks_chinese(source, response):
+            problems.append("response is not in Chinese")
+        return problems
+
+    def _looks_chinese(self, source, response):
+        source_prose = self.NON_PROSE_RE.sub(' ', source)
+        if len(self.LATIN_RE.findall(source_prose)) < self.MIN_LATIN_LETTERS:
+            # Too little prose to translate (formulas, tables, names...)
+            return True
+        prose = self.NON_PROSE_RE.sub(' ', response)
+        cjk = len(self.CJK_RE.findall(prose))
+        latin = len(self.LATIN_RE.findall(prose))
+        return cjk + latin == 0 or cjk / (cjk + latin) >= self.MIN_CJK_SHARE
@@ -0,0 +1,171 @@
+import contextlib
+import io
+import os
+import random
+
+import pytest
+
+from batch_jobs import OfflineBatchRunner
+from batch_runner import BatchRunner
+from context_manager import MESSAGE_TOKEN_OVERHEAD, ContextManager
+from document_processor import DocumentProcessor
+from mock_server import MockChatServer
+from text_splitter import Chunk, TextSplitter, iter_paragraphs
+
+PROMPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts.md")
+TEXT = "\n\n".join(["# A Paper"] + [f"Paragraph {i} " + "word " * 80 for i in range(12)])
+
+@pytest.fixture
+def server():
+    with MockChatServer() as srv:
+        yield srv
+
+def run_document(server, tmp_path, output_name="out.md", **options):
+    """Format TEXT through the mock server; return the output and the number of requests sent"""
+    input_path = tmp_path / "in.md"
+    input_path.write_text(TEXT, encoding="utf-8")
+    before = server.request_count
+    options.setdefault("use_cache", False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        DocumentProcessor(str(input_path), str(tmp_path / output_name), server.base_url, PROMPT, "k",
+                          chunk_words=200, **options).run()
+    return (tmp_path / output_name).read_text(encoding="utf-8"), server.request_count - before
+
+def test_sequential_run_echoes_every_chunk(server, tmp_path):
+    output, requests = run_document(server, tmp_path)
+    assert output.split() == TEXT.split()
+    assert requests == 6
+
+def test_concurrent_and_streamed_runs_match_sequential(server, tmp_path):
+    sequential, _ = run_document(server, tmp_path, "sequential.md")
+    concurrent, requests = run_document(server, tmp_path, "concurrent.md", concurrency=3)
+    assert concurrent == sequential and requests == 6
+    streamed, requests = run_document(server, tmp_path, "streamed.md", stream=True)
+    assert streamed == sequential and requests == 6
+
+def test_resume_sends_no_new_requests(server, tmp_path):
+    first, requests = run_document(server, tmp_path, use_cache=True)
+    assert requests == 6
+    resumed, requests = run_document(server, tmp_path, use_cache=True, resume=True)
+    assert resumed == first
+    assert requests == 0
+
+def test_offline_batch_rerun_after_restart(server, tmp_path):
+    for paper in range(2):
+        os.makedirs(tmp_path / f"p{paper}")
+        (tmp_path / f"p{paper}" / "in.md").write_text(TEXT.replace("Paragraph", f"Paper {paper} paragraph"),
+                                                      encoding="utf-8")
+    options = dict(use_cache=False, chunk_words=200)
+    with contextlib.redirect_stdout(io.StringIO()):
+        BatchRunner(DocumentProcessor, "in.md", "sync.md", server.base_url, PROMPT, "k", **options).run(str(tmp_path))
+
+    class Restart(Exception):
+        pass
+
+    def interrupted(*args):
+        raise Restart()
+
+    # Stopped while waiting for the submitted batch
+    runner = OfflineBatchRunner(DocumentProcessor, "in.md", "out.md", server.base_url, PROMPT, "k",
+                                poll_interval=0.1, **options)
+    runner._wait = interrupted
+    with pytest.raises(Restart), contextlib.redirect_stdout(io.StringIO()):
+        runner.run(str(tmp_path))
+    batches = len(server.batches)
+    assert batches == 1
+
+    # Started again, it picks up that batch instead of submitting a new one
+    before = server.request_count
+    runner = OfflineBatchRunner(DocumentProcessor, "in.md", "out.md", server.base_url, PROMPT, "k",
+                                poll_interval=0.1, **options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        runner.run(str(tmp_path))
+    assert len(server.batches) == batches
+    assert server.request_count == before
+    for paper in range(2):
+        folder = tmp_path / f"p{paper}"
+        assert (folder / "out.md").read_text(encoding="utf-8") == (folder / "sync.md").read_text(encoding="utf-8")
+
+def fits(messages, budget):
+    """Longest run of newest (content, tokens) messages within budget, as in the reference"""
+    total = 0
+    start = len(messages)
+    while start > 0 and total + messages[start - 1][1] <= budget:
+        start -= 1
+        total += messages[start][1]
+    return messages[start:], total
+
+@pytest.mark.parametrize("max_messages", [None, 3, 80])
+def test_context_manager_matches_list_reference(max_messages):
+    rng = random.Random(max_messages)
+    manager = ContextManager(max_messages=max_messages)
+    pairs = []
+    for i in range(200):
+        user = (f"user {i}", rng.randint(1, 50) + MESSAGE_TOKEN_OVERHEAD)
+        assistant = (f"assistant {i}", rng.randint(1, 50) + MESSAGE_TOKEN_OVERHEAD)
+        manager.add_user_message(Chunk(user[0], user[1] - MESSAGE_TOKEN_OVERHEAD))
+        manager.add_response(Chunk(assistant[0], assistant[1] - MESSAGE_TOKEN_OVERHEAD))
+        pairs.append((user, assistant))
+
+        first = 0 if max_messages is None else max(0, len(pairs) - max_messages)
+        retained = pairs[first:]
+        users = [user for user, _ in retained]
+        assistants = [assistant for _, assistant in retained]
+        combined = [message for pair in retained for message in pair]
+        assert [m["content"] for m in manager.get_user_previous_messages()] == [c for c, _ in users]
+        assert [m["content"] for m in manager.get_assistant_messages()] == [c for c, _ in assistants]
+        assert [m["content"] for m in manager.get_latest_conversation_pair()] == [user[0], assistant[0]]
+        assert manager.get_latest_conversation_pair_tokens() == user[1] + assistant[1]
+
+        for budget in (0, 40, 150, 1000):
+            for method, reference in ((manager.get_limited_user_messages, users),
+                                      (manager.get_limited_assistant_messages, assistants),
+                                      (manager.get_limited_combined_messages, combined)):
+                messages, tokens = method(budget)
+                expected, expected_tokens = fits(reference, budget)
+                assert [m["content"] for m in messages] == [c for c, _ in expected]
+                assert tokens == expected_tokens
+
+            # The window starts at the oldest whole pair that fits with everything after it
+            start = first + len(retained)
+            while start > first and sum(t for pair in pairs[start - 1:] for _, t in pair) <= budget:
+                start -= 1
+            assert manager.window_start(budget) == start
+            messages, tokens = manager.get_messages_since(start)
+            expected = [message for pair in pairs[start:] for message in pair]
+            assert [m["content"] for m in messages] == [c for c, _ in expected]
+            assert tokens == sum(t for _, t in expected)
+
+class ByteTokenizer:
+    """One token per byte, so cuts can fall inside a UTF-8 character"""
+    def encode(self, text, disallowed_special=()):
+        return list(text.encode("utf-8"))
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes([token]) for token in tokens]
+
+SPLIT_TEXT = "\n\n".join([
+    "# Title", "Some words " * 20, "```\ncode\n\nmore code\n```", "| a | b |\n|---|---|\n| 1 | 2 |",
+    "注意力机制 naïve café " * 5, "## Section", "end",
+])
+
+@pytest.mark.parametrize("options", [
+    dict(max_words=60), dict(max_words=60, markdown=True),
+    dict(max_tokens=250, tokenizer=ByteTokenizer()), dict(max_tokens=250, tokenizer=ByteTokenizer(), markdown=True),
+])
+def test_text_splitter_keeps_the_text(options):
+    splitter = TextSplitter(**options)
+    segments = splitter.split_document(SPLIT_TEXT)
+    assert len(segments) > 1
+    assert "".join(segments) == SPLIT_TEXT + "\n\n"
+    # Reading the paragraphs lazily, in small blocks, gives the same segments
+    assert list(splitter.iter_segments(iter_paragraphs(io.StringIO(SPLIT_TEXT), block_size=7))) == segments
+
+def test_text_splitter_cuts_long_paragraphs_without_losing_text():
+    paragraph = "注意力机制 naïve café " * 40
+    segments = TextSplitter(max_tokens=64, tokenizer=ByteTokenizer()).split_document(paragraph)
+    assert all(segment.token_count <= 64 for segment in segments)
+    # Only the blank lines after each piece are added
+    assert "".join(segment[:-2] for segment in segments) == paragraph
+    segments = TextSplitter(max_words=25).split_document(paragraph)
+    assert " ".join(segments).split() == paragraph.split()
@@ -0,0 +1,31 @@
+from pre_cleaner import PreCleaner
+
+FILLER = "This is ordinary prose that goes on for a while to fill the page. " * 12
+
+def clean(paragraphs):
+    cleaner = PreCleaner()
+    cleaner.scan(paragraphs)
+    return cleaner, list(cleaner.clean_paragraphs(paragraphs))
+
+def test_repeated_lines_away_from_page_breaks_are_kept():
+    paragraphs = ["# A Paper"]
+    for n in range(1, 5):
+        paragraphs += [FILLER, "$$\nx_%d = y^2\n$$" % n, "where", FILLER, "Algorithm %d: Training loop" % n, FILLER]
+    cleaner, cleaned = clean(paragraphs)
+    assert cleaned.count("where") == 4
+    assert all(f"Algorithm {n}: Training loop" in cleaned for n in range(1, 5))
+    assert cleaner.repeated == set()
+    assert cleaner.stats["headers"] == 0
+
+def test_headers_and_page_numbers_at_page_breaks_are_removed():
+    paragraphs = ["# A Paper"]
+    for page in range(1, 6):
+        paragraphs += [f"Journal of Stuff, Vol. 3\n{FILLER}", "Algorithm %d: Training loop" % page, FILLER,
+                       f"- {page} -"]
+    cleaner, cleaned = clean(paragraphs)
+    text = '\n\n'.join(cleaned)
+    # The first occurrence of each key stays, every later one at a page break goes
+    assert text.count("Journal of Stuff") == 1
+    assert "- 1 -" in text and "- 3 -" not in text
+    assert all(f"Algorithm {n}: Training loop" in text for n in range(1, 6))
+    assert cleaner.stats["headers"] == 8
@@ -1,12 +1,86 @@
+import re
+
+def iter_paragraphs(file, block_size=1 << 16):
+    """Lazily yield the paragraphs of an open text file
+    
+    Gives exactly what file.read().split('\\n\\n') would, while holding
+    only one block plus the unfinished paragraph in memory.
+    """
+    pending = ''
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        parts = (pending + block).split('\n\n')
+        pending = parts.pop()
+        yield from parts
+    yield pending
+
+def _iter_lines(paragraphs):
+    """Yield the lines of '\\n\\n'.join(paragraphs) without joining them"""
+    for i, paragraph in enumerate(paragraphs):
+        if i:
+            yield ''
+        yield from paragraph.split('\n')
+
+class Chunk(str):
+    """A document segment that remembers how many tokens it encodes to.
+
+    Behaves exactly like a str; token_count lets downstream code (LLMClient,
+    ContextManager) reuse the count from the splitting pass instead of
+    encoding the same text again. It is None when the segment was budgeted
+    by words and never encoded.
+    """
+    def __new__(cls, text, token_count=None):
+        chunk = super().__new__(cls, text)
+        chunk.token_count = token_count
+        return chunk
+
 class TextSplitter:
-    def __init__(self, max_words=4000):
+    # Tokens taken by the blank line between two paragraphs
+    SEPARATOR_TOKENS = 1
+
+    FENCE_RE = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+    HEADING_RE = re.compile(r'^\s{0,3}#{1,6}(\s|$)')
+
+    # In Markdown mode a segment that is at least this full is closed at the next heading
+    HEADING_BREAK_FILL = 0.5
+
+    def __init__(self, max_words=4000, max_tokens=None, tokenizer=None, markdown=False):
+        """
+        Args:
+            max_words: Word budget per segment (used when max_tokens is not set)
+            max_tokens: Token budget per segment; switches to token-based splitting
+            tokenizer: tiktoken encoding used in token mode (default: the gpt-4o encoding)
+            markdown: Split on Markdown blocks, keeping code fences, tables and
+                display math intact and preferring heading boundaries
+        """
         self.max_words = max_words
+        self.max_tokens = max_tokens
+        self.markdown = markdown
+        if max_tokens is not None and tokenizer is None:
+            # Imported here: registry itself depends on this module for Chunk
+            from registry import get_tokenizer
+            tokenizer = get_tokenizer()
+        self.tokenizer = tokenizer
         
     def split_document(self, text):
-        # Split the text by paragraphs (double newlines)
-        paragraphs = text.split('\n\n')
+        return list(self.iter_segments(text.split('\n\n')))
+    
+    def iter_segments(self, paragraphs):
+        """Yield segments from an iterable of paragraphs (text split on blank lines)
         
-        segments = []
+        Segments are produced as soon as they are complete, so a document read
+        lazily with iter_paragraphs() is never held in memory as a whole.
+        split_document() returns the same segments as a list.
+        """
+        if self.markdown:
+            return self._iter_markdown(_iter_lines(paragraphs))
+        if self.max_tokens is not None:
+            return self._iter_by_tokens(paragraphs)
+        return self._iter_by_words(paragraphs)
+    
+    def _iter_by_words(self, paragraphs):
         current_segment = []
         current_word_count = 0
         
@@ -17,7 +91,7 @@ class TextSplitter:
             # If adding this paragraph exceeds max_words and we already have content,
             # finish the current segment and start a new one
             if current_word_count + paragraph_words > self.max_words and current_segment:
-                segments.append('\n\n'.join(current_segment) + '\n\n')
+                yield '\n\n'.join(current_segment) + '\n\n'
                 current_segment = []
                 current_word_count = 0
             
@@ -25,7 +99,7 @@ class TextSplitter:
             if paragraph_words > self.max_words:
                 # If we have content in the current segment, add it as a segment
                 if current_segment:
-                    segments.append('\n\n'.join(current_segment) + '\n\n')
+                    yield '\n\n'.join(current_segment) + '\n\n'
                     current_segment = []
                     current_word_count = 0
                 
@@ -39,7 +113,7 @@ class TextSplitter:
                         temp_paragraph.append(word)
                         temp_word_count += 1
                     else:
-                        segments.append(' '.join(temp_paragraph) + '\n\n')
+                        yield ' '.join(temp_paragraph) + '\n\n'
                         temp_paragraph = [word]
                         temp_word_count = 1
                 
@@ -53,6 +127,267 @@ class TextSplitter:
         
         # Add the last segment if it has content
         if current_segment:
-            segments.append('\n\n'.join(current_segment) + '\n\n')
+            yield '\n\n'.join(current_segment) + '\n\n'
+    
+    def _split_tokens(self, tokens, max_tokens=None):
+        """Cut an oversized paragraph into pieces of at most max_tokens tokens
+        
+        Pieces are cut on token boundaries; bytes of a character that is
+        split across two tokens are carried over to the next piece so that
+        no text is lost or garbled.
+        """
+        # Leave room for the separator that follows every piece
+        step = max(1, (max_tokens or self.max_tokens) - self.SEPARATOR_TOKENS)
+        pieces = []
+        carry = b''
+        for start in range(0, len(tokens), step):
+            piece_tokens = tokens[start:start + step]
+            data = carry + b''.join(self.tokenizer.decode_tokens_bytes(piece_tokens))
+            carry = b''
+            # A UTF-8 character is at most 4 bytes, so at most 3 can be dangling
+            for _ in range(3):
+                try:
+                    data.decode('utf-8')
+                    break
+                except UnicodeDecodeError:
+                    carry = data[-1:] + carry
+                    data = data[:-1]
+            pieces.append(Chunk(data.decode('utf-8', errors='replace'), len(piece_tokens)))
+        if carry:
+            pieces[-1] = Chunk(pieces[-1] + carry.decode('utf-8', errors='replace'), pieces[-1].token_count)
+        return pieces
+    
+    def _iter_by_tokens(self, paragraphs):
+        """Yield segments of at most max_tokens tokens
+        
+        Each paragraph is encoded exactly once; the returned Chunk objects
+        carry the sum of their paragraphs' token counts.
+        """
+        current_segment = []
+        current_token_count = 0
+        
+        for paragraph in paragraphs:
+            tokens = self.tokenizer.encode(paragraph, disallowed_special=())
+            paragraph_tokens = len(tokens) + self.SEPARATOR_TOKENS
+            
+            # If adding this paragraph exceeds max_tokens and we already have content,
+            # finish the current segment and start a new one
+            if current_token_count + paragraph_tokens > self.max_tokens and current_segment:
+                yield Chunk('\n\n'.join(current_segment) + '\n\n', current_token_count)
+                current_segment = []
+                current_token_count = 0
+            
+            # Paragraphs that are larger than max_tokens on their own are cut into pieces
+            if paragraph_tokens > self.max_tokens:
+                pieces = self._split_tokens(tokens)
+                for piece in pieces[:-1]:
+                    yield Chunk(piece + '\n\n', piece.token_count + self.SEPARATOR_TOKENS)
+                current_segment = [str(pieces[-1])]
+                current_token_count = pieces[-1].token_count + self.SEPARATOR_TOKENS
+            else:
+                # Add paragraph to the current segment
+                current_segment.append(paragraph)
+                current_token_count += paragraph_tokens
+        
+        # Add the last segment if it has content
+        if current_segment:
+            yield Chunk('\n\n'.join(current_segment) + '\n\n', current_token_count)
+    
+    def _iter_blocks(self, lines):
+        """Yield (kind, lines) for every Markdown block in a single pass over the lines
+        
+        kind is one of 'code', 'math', 'table', 'heading' or 'paragraph'. Blank
+        lines separate paragraphs but are kept inside code and math blocks.
+        """
+        block = []
+        kind = None
+        fence = None
+        
+        for line in lines:
+            stripped = line.strip()
+            
+            # Inside a fenced code block or display math everything belongs to the block
+            if fence is not None:
+                block.append(line)
+                if kind == 'code':
+                    closed = stripped.startswith(fence) and set(stripped) == {fence[0]}
+                else:
+                    closed = stripped.endswith('$$')
+                if closed:
+                    yield kind, block
+                    block, kind, fence = [], None, None
+                continue
+            
+            if not stripped:
+                if block:
+                    yield kind, block
+                    block, kind = [], None
+                continue
+            
+            fence_match = self.FENCE_RE.match(line)
+            if fence_match or stripped.startswith('$$') or self.HEADING_RE.match(line):
+                if block:
+                    yield kind, block
+                if fence_match:
+                    block, kind, fence = [line], 'code', fence_match.group(1)
+                elif stripped.startswith('$$'):
+                    block, kind = [line], 'math'
+                    # $$ ... $$ on a single line is already complete
+                    if len(stripped) >= 4 and stripped.endswith('$$'):
+                        yield kind, block
+                        block, kind = [], None
+                    else:
+                        fence = '$$'
+                else:
+                    yield 'heading', [line]
+                    block, kind = [], None
+                continue
+            
+            is_table_row = stripped.startswith('|')
+            if block and (kind == 'table') != is_table_row:
+                # A table starts or ends without a blank line in between
+                yield kind, block
+                block, kind = [], None
+            block.append(line)
+            kind = 'table' if is_table_row else 'paragraph'
+        
+        if block:
+            yield kind, block
+    
+    def _line_size(self, line):
+        """Budget units of one line: tokens (including its newline) or words"""
+        if self.max_tokens is not None:
+            return len(self.tokenizer.encode(line, disallowed_special=())) + 1
+        return len(line.split())
+    
+    def _split_long_line(self, line, budget):
+        """Yield (text, size) pieces of a single line that exceeds the budget on its own"""
+        if self.max_tokens is not None:
+            for piece in self._split_tokens(self.tokenizer.encode(line, disallowed_special=()), budget):
+                yield str(piece), piece.token_count + 1
+        else:
+            words = line.split()
+            for start in range(0, len(words), budget):
+                piece = words[start:start + budget]
+                yield ' '.join(piece), len(piece)
+    
+    def _block_delimiters(self, kind, lines):
+        """Return (opening, closing) delimiter lines of a code or display math block
+        
+        Either is None when the block has no delimiter on a line of its own.
+        """
+        if len(lines) < 2:
+            return None, None
+        first, last = lines[0].strip(), lines[-1].strip()
+        if kind == 'code':
+            fence = self.FENCE_RE.match(lines[0]).group(1)
+            closed = last.startswith(fence) and set(last) == {fence[0]}
+            return lines[0], (lines[-1] if closed else None)
+        if kind == 'math' and first == '$$':
+            return lines[0], (lines[-1] if last == '$$' else None)
+        return None, None
+    
+    def _split_block(self, kind, lines, sizes, budget):
+        """Split an oversized block at line boundaries into (lines, size) pieces
+        
+        Code fences and $$ delimiters are closed at the end of each piece and
+        reopened at the start of the next, so every segment stays valid Markdown.
+        """
+        opening, closing = self._block_delimiters(kind, lines)
+        wrap_before, wrap_after, wrap_size = [], [], 0
+        if opening is not None:
+            lines, sizes = lines[1:], sizes[1:]
+            if closing is not None:
+                lines, sizes = lines[:-1], sizes[:-1]
+            else:
+                # An unterminated block still gets closed in every piece
+                closing = opening.strip() if kind == 'math' else self.FENCE_RE.match(opening).group(1)
+            wrap_before, wrap_after = [opening], [closing]
+            wrap_size = self._line_size(opening) + self._line_size(closing)
+            budget = max(1, budget - wrap_size)
+        
+        pieces = []
+        current, current_size = [], 0
+        for line, size in zip(lines, sizes):
+            parts = [(line, size)] if size <= budget else list(self._split_long_line(line, budget))
+            for part, part_size in parts:
+                if current and current_size + part_size > budget:
+                    pieces.append((current, current_size))
+                    current, current_size = [], 0
+                current.append(part)
+                current_size += part_size
+        if current or not pieces:
+            pieces.append((current, current_size))
+        
+        return [(wrap_before + piece + wrap_after, size + wrap_size) for piece, size in pieces]
+    
+    def _iter_markdown(self, source_lines):
+        """Yield segments on Markdown block boundaries in one linear pass over the lines
+        
+        Code blocks, tables and display math are never cut unless a single
+        block exceeds the budget, in which case it is cut between lines.
+        Segments are preferably closed before a heading, and a heading is
+        never left dangling at the end of a segment.
+        """
+        budget = self.max_tokens if self.max_tokens is not None else self.max_words
+        separator = self.SEPARATOR_TOKENS if self.max_tokens is not None else 0
+        
+        segments = []
+        current = []  # (kind, text, size) of the blocks in the current segment
+        current_size = 0
+        
+        def finish_segment(blocks):
+            if not blocks:
+                return
+            size = sum(block_size for _, _, block_size in blocks)
+            token_count = size if self.max_tokens is not None else None
+            segments.append(Chunk('\n\n'.join(block_text for _, block_text, _ in blocks) + '\n\n', token_count))
+        
+        def finish_keeping_headings(blocks):
+            """Finish a segment but return its trailing headings to start the next one"""
+            carried = []
+            while len(blocks) > 1 and blocks[-1][0] == 'heading':
+                carried.append(blocks.pop())
+            carried.reverse()
+            finish_segment(blocks)
+            return carried, sum(size for _, _, size in carried)
+        
+        for kind, lines in self._iter_blocks(source_lines):
+            # Segments finished by the previous block can be handed out already
+            yield from segments
+            segments.clear()
+            
+            sizes = [self._line_size(line) for line in lines]
+            block_size = sum(sizes) + separator
+            
+            if kind == 'heading' and current_size >= budget * self.HEADING_BREAK_FILL:
+                finish_segment(current)
+                current, current_size = [], 0
+            
+            if block_size > budget:
+                # The first piece shares its segment with any heading introducing it
+                current, current_size = finish_keeping_headings(current)
+                piece_budget = budget - separator - current_size
+                if piece_budget <= 0:
+                    # The headings alone fill the budget: they get a segment of their own
+                    finish_segment(current)
+                    current, current_size = [], 0
+                    piece_budget = budget - separator
+                # A budget smaller than the separator still makes progress, one unit at a time
+                pieces = self._split_block(kind, lines, sizes, max(1, piece_budget))
+                for piece_lines, piece_size in pieces:
+                    current.append((kind, '\n'.join(piece_lines), piece_size + separator))
+                    finish_segment(current)
+                    current = []
+                current_size = 0
+                continue
+            
+            if current and current_size + block_size > budget:
+                # Trailing headings move to the next segment to stay with their content
+                current, current_size = finish_keeping_headings(current)
+            
+            current.append((kind, '\n'.join(lines), block_size))
+            current_size += block_size
         
-        return segments
+        finish_segment(current)
+        yield from segments